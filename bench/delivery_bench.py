@@ -0,0 +1,331 @@
+"""
+Сквозной нагрузочный бенчмарк доставки против заглушки Bot API.
+
+Заполняет users.db синтетическими пользователями (bench/seed_users.py),
+запускает заглушку (bench/fake_bot_api.py) отдельным процессом и прогоняет
+драйверы:
+
+    scheduled  — send_due_horoscopes_job для самого населенного слота (UTC-минуты)
+    broadcast  — run_broadcast по всем активным пользователям
+    callbacks  — main.py в режиме webhook и поток нажатий «ежедневный гороскоп»
+
+Для каждого драйвера печатаются пропускная способность, перцентили задержки
+(scheduled/broadcast — от начала рассылки до доставки, callbacks — от POST
+обновления до первого ответа бота), пиковая память и суммарное время, на которое
+занимались соединения SQLite (статистика db_pool). Это время удержания соединения,
+а не работы SQLite: при загруженном цикле событий в него входит ожидание очереди
+цикла после каждого перехода в поток aiosqlite. --json сохраняет отчет,
+--baseline сравнивает с сохраненным и завершается с кодом 1 при регрессии
+больше REGRESSION_THRESHOLD.
+
+    python bench/delivery_bench.py --users 5000 --hot-share 0.2 --latency-ms 30 --forbidden-rate 0.01
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+os.environ.setdefault('BOT_TOKEN', '1:bench')
+
+from seed_users import seed_users, USER_ID_BASE
+
+API_PORT = 8082
+WEBHOOK_PORT = 8445
+METRICS_PORT = 9109
+WEBHOOK_SECRET = 'bench-secret'
+DRIVERS = ['scheduled', 'broadcast', 'callbacks']
+REGRESSION_THRESHOLD = 0.10
+READY_TIMEOUT = 60
+BROADCAST_TEXT = "Синтетическая массовая рассылка для нагрузочного теста."
+# Модули бота читают адрес Bot API при импорте: направляем их на заглушку до первого импорта
+os.environ['TELEGRAM_API_URL'] = f'http://127.0.0.1:{API_PORT}/bot'
+
+# --- ЗАГЛУШКА BOT API ---
+async def start_fake_api(args):
+    process = subprocess.Popen([
+        sys.executable, os.path.join(BENCH_DIR, 'fake_bot_api.py'), '--port', str(API_PORT),
+        '--latency-ms', str(args.latency_ms), '--throttle-rate', str(args.throttle_rate),
+        '--forbidden-rate', str(args.forbidden_rate), '--seed', str(args.seed),
+    ], stdout=subprocess.DEVNULL)
+    async with aiohttp.ClientSession() as session:
+        for _ in range(100):
+            try:
+                await api_call(session, 'GET', '/_stats')
+                return process
+            except aiohttp.ClientError:
+                await asyncio.sleep(0.1)
+    process.kill()
+    raise SystemExit("Заглушка Bot API не запустилась")
+
+async def api_call(session, method: str, path: str):
+    async with session.request(method, f'http://127.0.0.1:{API_PORT}{path}') as resp:
+        resp.raise_for_status()
+        return await resp.json()
+
+# --- ИЗМЕРЕНИЯ ---
+def percentiles(values) -> dict:
+    values = sorted(values)
+    if not values:
+        return {'p50': 0.0, 'p95': 0.0, 'p99': 0.0, 'max': 0.0}
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+    return {'p50': pick(0.5), 'p95': pick(0.95), 'p99': pick(0.99), 'max': values[-1]}
+
+def sqlite_seconds() -> float:
+    """Суммарное время запросов по пулам соединений этого процесса."""
+    from db_pool import get_pool_stats
+    return sum(stats['query']['avg_ms'] * stats['query']['count'] for stats in get_pool_stats().values()) / 1000
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def summarize(driver: str, started: float, finished: float, latencies_ms, api_stats, sqlite_s: float, rss_mb: float) -> dict:
+    return {
+        'driver': driver,
+        'delivered': len(latencies_ms),
+        'throughput': len(latencies_ms) / (finished - started) if finished > started else 0.0,
+        **{f'lag_{name}_ms': value for name, value in percentiles(latencies_ms).items()},
+        'throttled': api_stats['outcomes']['throttled'],
+        'blocked': api_stats['outcomes']['blocked'],
+        'peak_rss_mb': rss_mb,
+        'sqlite_s': sqlite_s,
+    }
+
+def delivery_lags_ms(sent, started: float):
+    """Задержки от начала рассылки до доставки по ответу /_sent заглушки."""
+    return [(at - started) * 1000 for _, at in sent]
+
+# --- ДРАЙВЕРЫ ---
+async def drive_scheduled(args, session, bot) -> dict:
+    from db_pool import users_pool
+    from database import flush_user_updates
+    from scheduler import send_due_horoscopes_job
+
+    async with users_pool.reader() as db:
+        cursor = await db.execute(
+            """SELECT utc_minute, COUNT(*) FROM users WHERE is_active = TRUE AND zodiac_sign IS NOT NULL
+               GROUP BY utc_minute ORDER BY COUNT(*) DESC LIMIT 1"""
+        )
+        utc_minute, due = await cursor.fetchone()
+    print(f"scheduled: слот {utc_minute // 60:02d}:{utc_minute % 60:02d} UTC, {due} подписчиков", flush=True)
+
+    await api_call(session, 'POST', '/_reset')
+    sqlite_before = sqlite_seconds()
+    started = time.time()
+    await send_due_horoscopes_job(utc_minute)
+    finished = time.time()
+    await flush_user_updates()
+    sent = await api_call(session, 'GET', '/_sent')
+    api_stats = await api_call(session, 'GET', '/_stats')
+    # Каждый подписчик слота должен получить сообщение или заблокировать бота (403);
+    # иначе рассылка теряет сообщения, и скорость сравнивать бессмысленно
+    handled = len(sent) + api_stats['outcomes']['blocked']
+    if handled < due:
+        raise SystemExit(f"scheduled: доставлено {len(sent)}, заблокировано {api_stats['outcomes']['blocked']} "
+                         f"из {due} подписчиков — рассылка теряет сообщения")
+    return summarize('scheduled', started, finished, delivery_lags_ms(sent, started), api_stats,
+                     sqlite_seconds() - sqlite_before, peak_rss_mb())
+
+async def drive_broadcast(args, session, bot) -> dict:
+    from broadcast import init_broadcast_db, create_broadcast, run_broadcast
+    from database import flush_user_updates
+
+    await init_broadcast_db()
+    await api_call(session, 'POST', '/_reset')
+    sqlite_before = sqlite_seconds()
+    started = time.time()
+    broadcast_id = await create_broadcast(BROADCAST_TEXT)
+    await run_broadcast(bot, broadcast_id, concurrency=args.broadcast_concurrency)
+    finished = time.time()
+    await flush_user_updates()
+    sent = await api_call(session, 'GET', '/_sent')
+    return summarize('broadcast', started, finished, delivery_lags_ms(sent, started), await api_call(session, 'GET', '/_stats'),
+                     sqlite_seconds() - sqlite_before, peak_rss_mb())
+
+def make_callback_update(update_id: int, user_id: int) -> dict:
+    user = {'id': user_id, 'is_bot': False, 'first_name': 'Load'}
+    return {'update_id': update_id, 'callback_query': {
+        'id': str(update_id), 'from': user, 'chat_instance': str(user_id), 'data': 'h_type_daily',
+        'message': {'message_id': 1, 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'},
+                    'from': {'id': 1, 'is_bot': True, 'first_name': 'Bench'}, 'text': 'Какой гороскоп хотите получить?'},
+    }}
+
+async def bot_sqlite_seconds(session) -> float:
+    """Суммарное время запросов SQLite в процессе бота по его /metrics."""
+    async with session.get(f'http://127.0.0.1:{METRICS_PORT}/metrics') as resp:
+        text = await resp.text()
+    values = dict(line.rsplit(' ', 1) for line in text.splitlines() if line and not line.startswith('#'))
+    return sum(
+        float(value) * float(values[name.replace('_query_avg_ms', '_query_count')])
+        for name, value in values.items() if name.endswith('_query_avg_ms')
+    ) / 1000
+
+def process_peak_rss_mb(pid: int) -> float:
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+async def drive_callbacks(args, session, workdir: str) -> dict:
+    env = {
+        **os.environ,
+        'TELEGRAM_GLOBAL_RATE': str(args.rate),
+        'UPDATE_MODE': 'webhook',
+        'WEBHOOK_URL': f'http://127.0.0.1:{WEBHOOK_PORT}',
+        'WEBHOOK_PORT': str(WEBHOOK_PORT),
+        'WEBHOOK_SECRET': WEBHOOK_SECRET,
+        'METRICS_PORT': str(METRICS_PORT),
+        'GENERATION_BACKEND': '',
+    }
+    with open(os.path.join(workdir, 'bot_callbacks.log'), 'w') as log:
+        process = subprocess.Popen([sys.executable, os.path.join(ROOT_DIR, 'main.py')],
+                                   cwd=workdir, env=env, stdout=log, stderr=log)
+    try:
+        deadline = time.monotonic() + READY_TIMEOUT
+        while not (await api_call(session, 'GET', '/_stats'))['webhook_url']:
+            if process.poll() is not None or time.monotonic() > deadline:
+                raise SystemExit(f"Бот не запустился, см. {workdir}/bot_callbacks.log")
+            await asyncio.sleep(0.1)
+        await asyncio.sleep(args.warmup)
+
+        await api_call(session, 'POST', '/_reset')
+        sqlite_before = await bot_sqlite_seconds(session)
+        rng = random.Random(args.seed)
+        user_ids = rng.sample(range(USER_ID_BASE, USER_ID_BASE + args.users), min(args.callbacks, args.users))
+        pushed_at = {}
+        pending = iter(enumerate(user_ids, 1))
+        headers = {'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET}
+
+        async def sender():
+            for update_id, user_id in pending:
+                pushed_at[user_id] = time.time()
+                async with session.post(f'http://127.0.0.1:{WEBHOOK_PORT}/telegram',
+                                        json=make_callback_update(update_id, user_id), headers=headers) as resp:
+                    resp.raise_for_status()
+
+        started = time.time()
+        await asyncio.gather(*(sender() for _ in range(args.senders)))
+        deadline = time.monotonic() + args.timeout
+        while True:
+            sent = dict(await api_call(session, 'GET', '/_sent'))
+            if len(sent) >= len(user_ids) or time.monotonic() > deadline:
+                break
+            await asyncio.sleep(0.2)
+        answered = {chat_id: at for chat_id, at in sent.items() if chat_id in pushed_at}
+        finished = max(answered.values(), default=started)
+        latencies = [(at - pushed_at[user_id]) * 1000 for user_id, at in answered.items()]
+        return summarize('callbacks', started, finished, latencies, await api_call(session, 'GET', '/_stats'),
+                         await bot_sqlite_seconds(session) - sqlite_before, process_peak_rss_mb(process.pid))
+    finally:
+        if process.poll() is None:
+            process.send_signal(signal.SIGTERM)
+            process.wait()
+
+# --- ОТЧЕТ ---
+def print_report(results):
+    print(f"{'драйвер':<10} {'доставлено':>10} {'сообщ./с':>9} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9} "
+          f"{'429':>5} {'403':>5} {'RSS, МБ':>8} {'SQLite, с':>9}")
+    for r in results:
+        print(f"{r['driver']:<10} {r['delivered']:>10} {r['throughput']:>9.1f} {r['lag_p50_ms']:>9.0f} "
+              f"{r['lag_p95_ms']:>9.0f} {r['lag_p99_ms']:>9.0f} {r['throttled']:>5} {r['blocked']:>5} "
+              f"{r['peak_rss_mb']:>8.1f} {r['sqlite_s']:>9.3f}")
+
+def compare(results, baseline_path: str) -> bool:
+    """Печатает отклонения от сохраненного отчета; True, если есть регрессия."""
+    with open(baseline_path) as f:
+        baseline = {r['driver']: r for r in json.load(f)['results']}
+    regressed = False
+    for r in results:
+        base = baseline.get(r['driver'])
+        if not base:
+            continue
+        checks = [
+            ('throughput', base['throughput'] and (base['throughput'] - r['throughput']) / base['throughput']),
+            ('lag_p95_ms', base['lag_p95_ms'] and (r['lag_p95_ms'] - base['lag_p95_ms']) / base['lag_p95_ms']),
+            ('sqlite_s', base['sqlite_s'] and (r['sqlite_s'] - base['sqlite_s']) / base['sqlite_s']),
+        ]
+        for metric, worse_by in checks:
+            if worse_by and worse_by > REGRESSION_THRESHOLD:
+                regressed = True
+                print(f"РЕГРЕССИЯ {r['driver']}.{metric}: {base[metric]:.3f} -> {r[metric]:.3f} ({worse_by:+.0%})")
+    if not regressed:
+        print(f"Регрессий больше {REGRESSION_THRESHOLD:.0%} относительно {baseline_path} нет.")
+    return regressed
+
+async def run(args, workdir: str):
+    os.chdir(workdir)
+    print(f"Заполнение {args.users} пользователей в {workdir}...", flush=True)
+    await seed_users(args.users, args.hot_share, args.seed)
+
+    from db_pool import close_all_pools
+    from outbound import get_bot, rate_limiter
+    rate_limiter.rate = args.rate
+
+    api_process = await start_fake_api(args)
+    results = []
+    try:
+        async with aiohttp.ClientSession() as session:
+            bot = get_bot()
+            async with bot:
+                for driver in ('scheduled', 'broadcast'):
+                    if driver in args.drivers:
+                        results.append(await globals()[f'drive_{driver}'](args, session, bot))
+            # Бот в отдельном процессе пишет в ту же БД: свои соединения закрываем заранее
+            await close_all_pools()
+            if 'callbacks' in args.drivers:
+                results.append(await drive_callbacks(args, session, workdir))
+    finally:
+        api_process.terminate()
+        api_process.wait()
+        await close_all_pools()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--drivers', nargs='+', choices=DRIVERS, default=DRIVERS)
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--hot-share', type=float, default=0.2, help="доля пользователей в одном слоте")
+    parser.add_argument('--rate', type=float, default=1000.0,
+                        help="сообщений в секунду для ограничителя outbound (в бою — TELEGRAM_GLOBAL_RATE)")
+    parser.add_argument('--latency-ms', type=float, default=30.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--forbidden-rate', type=float, default=0.01)
+    parser.add_argument('--broadcast-concurrency', type=int, default=50)
+    parser.add_argument('--callbacks', type=int, default=2000, help="число нажатий в драйвере callbacks")
+    parser.add_argument('--senders', type=int, default=40, help="параллельных POST-запросов на webhook")
+    parser.add_argument('--warmup', type=float, default=3.0)
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help="каталог для data/ (по умолчанию новый временный)")
+    parser.add_argument('--json', help="сохранить отчет в файл")
+    parser.add_argument('--baseline', help="сравнить с сохраненным отчетом")
+    args = parser.parse_args()
+
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='delivery_bench_'))
+    # run() переходит в workdir: пути отчетов считаем от исходного каталога
+    args.json = args.json and os.path.abspath(args.json)
+    args.baseline = args.baseline and os.path.abspath(args.baseline)
+    os.makedirs(workdir, exist_ok=True)
+    results = asyncio.run(run(args, workdir))
+
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2, ensure_ascii=False)
+    if args.baseline and compare(results, args.baseline):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
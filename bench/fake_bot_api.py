@@ -0,0 +1,166 @@
+"""
+Локальная заглушка Bot API для бенчмарков.
+
+Отвечает на методы, которые вызывает бот (getMe, setWebhook, sendMessage, ...),
+отдает обновления через getUpdates из собственной очереди и запоминает время
+(time.time()) каждого доставленного сообщения по chat_id. Для отправок можно
+задать задержку ответа и долю ответов 429 (retry_after) и 403 (бот заблокирован).
+Бот направляется сюда через TELEGRAM_API_URL=http://127.0.0.1:<port>/bot.
+
+Можно запустить отдельным процессом, чтобы заглушка не делила процессор
+с измеряемым кодом; тогда счетчики доступны по HTTP:
+
+    python bench/fake_bot_api.py --port 8081 --latency-ms 30 --throttle-rate 0.01 --forbidden-rate 0.02
+    GET /_stats    — вызовы по методам и исходы отправок
+    GET /_sent     — [[chat_id, время доставки], ...]
+    POST /_reset   — обнулить счетчики
+"""
+import argparse
+import asyncio
+import random
+import time
+from aiohttp import web
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+SEND_METHODS = {'sendMessage', 'editMessageText'}
+RETRY_AFTER = 1
+
+class FakeBotApi:
+    def __init__(self, host: str = '127.0.0.1', port: int = 8081, latency_ms: float = 0.0,
+                 throttle_rate: float = 0.0, forbidden_rate: float = 0.0, seed: int = None):
+        self.host = host
+        self.port = port
+        self.latency = latency_ms / 1000
+        self.throttle_rate = throttle_rate
+        self.forbidden_rate = forbidden_rate
+        self._random = random.Random(seed)
+        self.webhook_url = None
+        self._updates = []
+        self._update_id = 0
+        self._new_updates = asyncio.Event()
+        self._message_id = 0
+        self._runner = None
+        self.reset()
+
+    def reset(self):
+        self.calls = {}           # метод -> число вызовов
+        self.outcomes = {'sent': 0, 'throttled': 0, 'blocked': 0}
+        self.sent_at = {}         # chat_id -> время первого доставленного сообщения
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/bot"
+
+    def push_update(self, payload: dict) -> dict:
+        """Ставит обновление в очередь getUpdates; возвращает его с присвоенным update_id."""
+        self._update_id += 1
+        update = {'update_id': self._update_id, **payload}
+        self._updates.append(update)
+        self._new_updates.set()
+        return update
+
+    async def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        timeout = float(params.get('timeout') or 0)
+        limit = int(params.get('limit') or 100)
+        self._updates = [u for u in self._updates if u['update_id'] >= offset]
+        if not self._updates and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:limit]
+
+    def _message(self, params) -> dict:
+        self._message_id += 1
+        chat_id = int(params['chat_id'])
+        self.sent_at.setdefault(chat_id, time.time())
+        return {
+            'message_id': self._message_id, 'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'}, 'text': params.get('text', ''),
+        }
+
+    def _send(self, params):
+        """Исход отправки: ошибка Bot API (dict для json_response, HTTP-статус) или сообщение."""
+        roll = self._random.random()
+        if roll < self.throttle_rate:
+            self.outcomes['throttled'] += 1
+            return {'ok': False, 'error_code': 429, 'description': f'Too Many Requests: retry after {RETRY_AFTER}',
+                    'parameters': {'retry_after': RETRY_AFTER}}, 429
+        if roll < self.throttle_rate + self.forbidden_rate:
+            self.outcomes['blocked'] += 1
+            return {'ok': False, 'error_code': 403, 'description': 'Forbidden: bot was blocked by the user'}, 403
+        self.outcomes['sent'] += 1
+        return {'ok': True, 'result': self._message(params)}, 200
+
+    async def _handle(self, request: web.Request):
+        method = request.match_info['method']
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if request.content_type == 'application/json':
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        if self.latency and method != 'getUpdates':
+            await asyncio.sleep(self._random.uniform(0.5, 1.5) * self.latency)
+
+        if method in SEND_METHODS:
+            body, status = self._send(params)
+            return web.json_response(body, status=status)
+        if method == 'getMe':
+            result = BOT_USER
+        elif method == 'getUpdates':
+            result = await self._get_updates(params)
+        elif method == 'setWebhook':
+            self.webhook_url = params.get('url')
+            result = True
+        elif method == 'deleteWebhook':
+            self.webhook_url = None
+            result = True
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def _handle_stats(self, request: web.Request):
+        return web.json_response({'calls': self.calls, 'outcomes': self.outcomes, 'webhook_url': self.webhook_url})
+
+    async def _handle_sent(self, request: web.Request):
+        return web.json_response(list(self.sent_at.items()))
+
+    async def _handle_reset(self, request: web.Request):
+        self.reset()
+        return web.json_response({'ok': True})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self._handle)
+        app.router.add_get('/_stats', self._handle_stats)
+        app.router.add_get('/_sent', self._handle_sent)
+        app.router.add_post('/_reset', self._handle_reset)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+async def _serve(args):
+    api = FakeBotApi(args.host, args.port, args.latency_ms, args.throttle_rate, args.forbidden_rate, args.seed)
+    await api.start()
+    print(f"Заглушка Bot API: {api.base_url}", flush=True)
+    await asyncio.Event().wait()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency-ms', type=float, default=0.0, help="средняя задержка ответа (±50%%)")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="доля отправок с ответом 429")
+    parser.add_argument('--forbidden-rate', type=float, default=0.0, help="доля отправок с ответом 403")
+    parser.add_argument('--seed', type=int)
+    try:
+        asyncio.run(_serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,69 @@
+"""
+Офлайн-бенчмарк извлечения гороскопа из HTML.
+
+Прогоняет сохраненные страницы из bench/fixtures через все движки
+horoscope_extract.extract_horoscope, проверяет, что результаты совпадают,
+и печатает скорость (страниц/с) и пиковую память для каждого движка.
+
+    python bench/parse_benchmark.py [--iterations N]
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from horoscope_extract import extract_horoscope, EXTRACT_ENGINES
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def load_fixtures():
+    pages = {}
+    for name in sorted(os.listdir(FIXTURES_DIR)):
+        if name.endswith('.html'):
+            with open(os.path.join(FIXTURES_DIR, name), encoding='utf-8') as f:
+                pages[name] = f.read()
+    return pages
+
+def check_identical(pages):
+    reference_engine, *other_engines = EXTRACT_ENGINES
+    for name, html in pages.items():
+        expected = extract_horoscope(html, engine=reference_engine)
+        for engine in other_engines:
+            actual = extract_horoscope(html, engine=engine)
+            if actual != expected:
+                raise SystemExit(f"{name}: результат '{engine}' отличается от '{reference_engine}':\n{actual}\n{expected}")
+    print(f"Результаты всех движков совпадают на {len(pages)} страницах.")
+
+def benchmark(engine, pages, iterations):
+    htmls = list(pages.values())
+    started = time.perf_counter()
+    for _ in range(iterations):
+        for html in htmls:
+            extract_horoscope(html, engine=engine)
+    elapsed = time.perf_counter() - started
+
+    # Память меряем отдельным проходом: tracemalloc сильно замедляет разбор
+    tracemalloc.start()
+    for html in htmls:
+        extract_horoscope(html, engine=engine)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(htmls) * iterations / elapsed, peak
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=50)
+    args = parser.parse_args()
+
+    pages = load_fixtures()
+    check_identical(pages)
+    print(f"{'движок':<10} {'стр./с':>10} {'пик памяти, КБ':>16}")
+    for engine in EXTRACT_ENGINES:
+        pages_per_sec, peak = benchmark(engine, pages, args.iterations)
+        print(f"{engine:<10} {pages_per_sec:>10.1f} {peak / 1024:>16.0f}")
+
+if __name__ == "__main__":
+    main()
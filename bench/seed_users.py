@@ -0,0 +1,101 @@
+"""
+Заполняет БД бота синтетическими пользователями для бенчмарков.
+
+Пользователи равномерно распределяются по TIMEZONES, NOTIFICATION_TIMES и
+знакам зодиака; --hot-share переносит долю пользователей в один слот
+(UTC+3, 09:00), чтобы смоделировать пик «в начале часа». Заодно в
+horoscopes.db пишутся ежедневные гороскопы на сегодня, чтобы рассылка шла
+по основному пути, а не по заглушке «еще не готов», и транзиты на вчера,
+сегодня и завтра — как после fill_transit_window, с которым рассылка читает
+транзиты и ищет персональный текст.
+Пути к БД берутся из constants (data/...) относительно текущего каталога.
+
+    python bench/seed_users.py --users 100000 [--hot-share 0.2] [--workdir DIR]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import json
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('BOT_TOKEN', '1:bench')
+
+USER_ID_BASE = 1_000_000
+HOT_SLOT = ('UTC+3', '09:00')
+INSERT_BATCH = 10_000
+HOROSCOPE_TEXT = "Синтетический гороскоп для нагрузочного теста. " * 8
+TRANSIT_DAYS = (-1, 0, 1)    # местная дата пользователей бывает вчерашней или завтрашней
+
+async def seed_users(count: int, hot_share: float = 0.0, seed: int = 0) -> int:
+    """Добавляет count пользователей с ID от USER_ID_BASE (существующие заменяются); возвращает count."""
+    from constants import TIMEZONES, NOTIFICATION_TIMES, ZODIAC_SIGNS_EN, ZODIAC_MAP
+    from database import init_user_db, utc_minute_for
+    from db_pool import users_pool
+    from parser_utils import init_horoscope_db, insert_horoscopes
+    from personal_horoscopes import init_personal_db
+
+    os.makedirs('data', exist_ok=True)
+    await init_user_db()
+    rng = random.Random(seed)
+    for start in range(0, count, INSERT_BATCH):
+        rows = []
+        for user_id in range(USER_ID_BASE + start, USER_ID_BASE + min(count, start + INSERT_BATCH)):
+            if rng.random() < hot_share:
+                tz, time = HOT_SLOT
+            else:
+                tz, time = rng.choice(TIMEZONES), rng.choice(NOTIFICATION_TIMES)
+            rows.append((user_id, f"user{user_id}", rng.choice(ZODIAC_SIGNS_EN), tz, time, utc_minute_for(tz, time)))
+        async with users_pool.writer() as db:
+            await db.executemany(
+                """INSERT OR REPLACE INTO users
+                   (user_id, first_name, zodiac_sign, timezone, notification_time, utc_minute, is_active)
+                   VALUES (?, ?, ?, ?, ?, ?, TRUE)""",
+                rows
+            )
+
+    await init_horoscope_db()
+    await init_personal_db()    # как при старте бота
+    data = {'general_text': HOROSCOPE_TEXT, 'love_text': HOROSCOPE_TEXT, 'love_rating': '4'}
+    await insert_horoscopes([(sign_id, 'daily', date.today(), data) for sign_id in ZODIAC_MAP.values()])
+    await seed_transits(rng)
+    return count
+
+async def seed_transits(rng: random.Random):
+    """Синтетические строки transits_cache в формате compute_transits (без kerykeion)."""
+    from constants import ZODIAC_SIGNS_EN
+    from db_pool import horoscopes_pool
+    from transits import PLANETS
+
+    rows = []
+    for offset in TRANSIT_DAYS:
+        planet_data = {
+            planet.capitalize(): {'sign': rng.choice(ZODIAC_SIGNS_EN)[:3], 'lon': round(rng.uniform(0, 30), 2)}
+            for planet in PLANETS
+        }
+        rows.append((date.today() + timedelta(days=offset), json.dumps(planet_data)))
+    async with horoscopes_pool.writer() as db:
+        await db.executemany(
+            "INSERT OR REPLACE INTO transits_cache (transit_date, planet_data) VALUES (?, ?)", rows
+        )
+
+async def _main(args):
+    from db_pool import close_all_pools
+    try:
+        await seed_users(args.users, args.hot_share, args.seed)
+        print(f"Добавлено {args.users} пользователей в {os.path.abspath('data')}")
+    finally:
+        await close_all_pools()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--hot-share', type=float, default=0.0, help="доля пользователей в слоте UTC+3 09:00")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', default='.', help="каталог, в котором лежит (или будет создан) data/")
+    args = parser.parse_args()
+    os.makedirs(args.workdir, exist_ok=True)
+    os.chdir(args.workdir)
+    asyncio.run(_main(args))
@@ -0,0 +1,219 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.ext import ExtBot
+from database import save_user_data
+from db_pool import users_pool
+from outbound import PRIORITY_BROADCAST
+
+logger = logging.getLogger(__name__)
+
+# --- ДВИЖОК МАССОВЫХ РАССЫЛОК ---
+# Получатели рассылки хранятся в таблице broadcast_outbox. Пакет получателей
+# помечается 'inflight' до отправки, поэтому после падения процесса
+# прерванный пакет не отправляется повторно (статус 'unknown'),
+# а остальные получатели продолжают рассылку с места остановки. Итоги
+# отправок пишутся каждые RESULT_WRITE_CHUNK сообщений, так что при падении
+# 'unknown' становятся не больше CLAIM_BATCH_SIZE получателей.
+# Скорость и повторы после RetryAfter обеспечивает ограничитель outbound.get_bot();
+# если их не хватило (долгий flood-wait, сеть), получатель получает статус
+# 'retry' и снова ставится в очередь в конце прохода и при --resume,
+# пока у него не наберется MAX_SEND_ATTEMPTS попыток.
+DEFAULT_CONCURRENCY = 10
+CLAIM_BATCH_SIZE = 50
+RESULT_WRITE_CHUNK = 10
+MAX_SEND_ATTEMPTS = 3
+PROGRESS_INTERVAL = 10       # секунды между отчетами о прогрессе
+
+async def init_broadcast_db():
+    async with users_pool.writer() as db:
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                broadcast_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                text TEXT,
+                created_at TIMESTAMP,
+                finished_at TIMESTAMP
+            )
+        ''')
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_outbox (
+                broadcast_id INTEGER,
+                user_id INTEGER,
+                status TEXT DEFAULT 'pending', -- pending/inflight/sent/blocked/retry/failed/unknown
+                error TEXT,
+                attempts INTEGER DEFAULT 0,
+                PRIMARY KEY (broadcast_id, user_id)
+            ) WITHOUT ROWID
+        ''')
+        cursor = await db.execute("PRAGMA table_info(broadcast_outbox)")
+        if 'attempts' not in [row[1] for row in await cursor.fetchall()]:
+            await db.execute("ALTER TABLE broadcast_outbox ADD COLUMN attempts INTEGER DEFAULT 0")
+        await db.execute('''
+            CREATE INDEX IF NOT EXISTS idx_outbox_status
+            ON broadcast_outbox (broadcast_id, status, user_id)
+        ''')
+
+async def create_broadcast(text: str) -> int:
+    """Создает рассылку и ставит в очередь всех активных пользователей."""
+    async with users_pool.writer() as db:
+        cursor = await db.execute(
+            "INSERT INTO broadcasts (text, created_at) VALUES (?, ?)",
+            (text, datetime.now())
+        )
+        broadcast_id = cursor.lastrowid
+        await db.execute(
+            """INSERT INTO broadcast_outbox (broadcast_id, user_id)
+               SELECT ?, user_id FROM users WHERE is_active = TRUE""",
+            (broadcast_id,)
+        )
+    logger.info("Создана рассылка #%s.", broadcast_id)
+    return broadcast_id
+
+async def get_broadcast_counts(broadcast_id: int) -> dict:
+    async with users_pool.reader() as db:
+        cursor = await db.execute(
+            "SELECT status, COUNT(*) FROM broadcast_outbox WHERE broadcast_id = ? GROUP BY status",
+            (broadcast_id,)
+        )
+        return {row[0]: row[1] for row in await cursor.fetchall()}
+
+class _Progress:
+    def __init__(self, total: int):
+        self.total = total
+        self.done = 0
+        self.started_at = time.monotonic()
+        self.reported_at = self.started_at
+
+    def report(self, counts: dict, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self.reported_at < PROGRESS_INTERVAL:
+            return
+        self.reported_at = now
+        elapsed = now - self.started_at
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        eta = (self.total - self.done) / rate if rate > 0 else float('inf')
+        logger.info(
+            "Прогресс: %s/%s, %.1f сообщ./с, осталось ~%.1f мин. %s",
+            self.done, self.total, rate, eta / 60, counts
+        )
+
+async def _claim_batch(broadcast_id: int):
+    """Забирает следующий пакет получателей и помечает его 'inflight'."""
+    async with users_pool.writer() as db:
+        cursor = await db.execute(
+            """SELECT user_id FROM broadcast_outbox
+               WHERE broadcast_id = ? AND status = 'pending'
+               ORDER BY user_id LIMIT ?""",
+            (broadcast_id, CLAIM_BATCH_SIZE)
+        )
+        user_ids = [row[0] for row in await cursor.fetchall()]
+        await db.executemany(
+            "UPDATE broadcast_outbox SET status = 'inflight' WHERE broadcast_id = ? AND user_id = ?",
+            [(broadcast_id, user_id) for user_id in user_ids]
+        )
+    return user_ids
+
+async def _send_one(bot: ExtBot, user_id: int, text: str):
+    """Отправляет одно сообщение; возвращает (статус, ошибка). 'retry' — временная ошибка."""
+    try:
+        await bot.send_message(chat_id=user_id, text=text, rate_limit_args={'priority': PRIORITY_BROADCAST})
+        return 'sent', None
+    except Forbidden:
+        return 'blocked', None
+    except RetryAfter as e:
+        return 'retry', f"RetryAfter {e.retry_after}: превышено число попыток"
+    except BadRequest as e:
+        # Подкласс NetworkError, но повтор не поможет
+        return 'failed', str(e)
+    except NetworkError as e:
+        return 'retry', str(e)
+    except Exception as e:
+        return 'failed', str(e)
+
+async def _requeue_retries(broadcast_id: int) -> int:
+    """Возвращает в очередь получателей с временной ошибкой; исчерпавшие MAX_SEND_ATTEMPTS — 'failed'."""
+    async with users_pool.writer() as db:
+        await db.execute(
+            """UPDATE broadcast_outbox SET status = 'failed'
+               WHERE broadcast_id = ? AND status = 'retry' AND attempts >= ?""",
+            (broadcast_id, MAX_SEND_ATTEMPTS)
+        )
+        cursor = await db.execute(
+            "UPDATE broadcast_outbox SET status = 'pending' WHERE broadcast_id = ? AND status = 'retry'",
+            (broadcast_id,)
+        )
+        return cursor.rowcount
+
+async def _write_results(broadcast_id: int, results):
+    """results — [(user_id, статус, ошибка)]; попытка засчитывается каждой отправке."""
+    async with users_pool.writer() as db:
+        await db.executemany(
+            """UPDATE broadcast_outbox SET status = ?, error = ?, attempts = attempts + 1
+               WHERE broadcast_id = ? AND user_id = ?""",
+            [(status, error, broadcast_id, user_id) for user_id, status, error in results]
+        )
+    # Деактивация заблокировавших бота уходит в очередь отложенной записи одним пакетом
+    for user_id, status, _ in results:
+        if status == 'blocked':
+            await save_user_data(user_id, is_active=False)
+
+async def run_broadcast(bot: ExtBot, broadcast_id: int, concurrency: int = DEFAULT_CONCURRENCY):
+    """Отправляет рассылку всем получателям со статусом 'pending'. Можно вызывать повторно."""
+    async with users_pool.writer() as db:
+        cursor = await db.execute("SELECT text FROM broadcasts WHERE broadcast_id = ?", (broadcast_id,))
+        row = await cursor.fetchone()
+        if not row:
+            raise ValueError(f"Рассылка #{broadcast_id} не найдена")
+        text = row[0]
+        # Пакет, прерванный падением процесса, мог быть частично отправлен — не повторяем его
+        cursor = await db.execute(
+            "UPDATE broadcast_outbox SET status = 'unknown' WHERE broadcast_id = ? AND status = 'inflight'",
+            (broadcast_id,)
+        )
+        if cursor.rowcount:
+            logger.warning("%s получателей прерванного пакета помечены 'unknown'.", cursor.rowcount)
+    requeued = await _requeue_retries(broadcast_id)
+    if requeued:
+        logger.info("%s получателей с временной ошибкой снова в очереди.", requeued)
+
+    counts = await get_broadcast_counts(broadcast_id)
+    progress = _Progress(counts.get('pending', 0))
+    logger.info("Рассылка #%s: к отправке %s, потоков %s.", broadcast_id, progress.total, concurrency)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    session_counts = {}
+    unwritten = []
+
+    async def send(user_id: int):
+        nonlocal unwritten
+        async with semaphore:
+            status, error = await _send_one(bot, user_id, text)
+        progress.done += 1
+        session_counts[status] = session_counts.get(status, 0) + 1
+        progress.report(session_counts)
+        unwritten.append((user_id, status, error))
+        if len(unwritten) >= RESULT_WRITE_CHUNK:
+            results, unwritten = unwritten, []
+            await _write_results(broadcast_id, results)
+
+    while True:
+        user_ids = await _claim_batch(broadcast_id)
+        if not user_ids:
+            # Конец прохода: получатели с временной ошибкой идут на следующий круг
+            if not await _requeue_retries(broadcast_id):
+                break
+            continue
+        await asyncio.gather(*(send(user_id) for user_id in user_ids))
+        if unwritten:
+            results, unwritten = unwritten, []
+            await _write_results(broadcast_id, results)
+
+    async with users_pool.writer() as db:
+        await db.execute(
+            "UPDATE broadcasts SET finished_at = ? WHERE broadcast_id = ?",
+            (datetime.now(), broadcast_id)
+        )
+    progress.report(session_counts, force=True)
+    return await get_broadcast_counts(broadcast_id)
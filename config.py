@@ -5,3 +5,35 @@ load_dotenv()
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 if not BOT_TOKEN:
     raise ValueError("Не найден BOT_TOKEN в .env файле!")
+
+# Режим ежедневной рассылки:
+# 'slots' — одна задача на слот (часовой пояс, время), 'per_user' — одна задача на пользователя.
+# При смене режима задачи другого режима удаляются и пересоздаются при старте
+DELIVERY_MODE = os.getenv('DELIVERY_MODE', 'slots')
+
+# Адрес Bot API (можно указать локальный сервер для тестов)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org/bot')
+# Общий лимит исходящих сообщений одного процесса, сообщений в секунду
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', 28))
+
+# Генерация персональных гороскопов: '' — выключена, 'gemini' или 'fake' (локальная заглушка для тестов)
+GENERATION_BACKEND = os.getenv('GENERATION_BACKEND', '')
+GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
+GEMINI_MODEL = os.getenv('GEMINI_MODEL', 'gemini-1.5-flash')
+
+# Прием обновлений: 'polling' — getUpdates, 'webhook' — локальный aiohttp-сервер,
+# на который Telegram присылает обновления (WEBHOOK_URL — внешний адрес, например за nginx)
+UPDATE_MODE = os.getenv('UPDATE_MODE', 'polling')
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', 64))   # обработчиков, выполняемых одновременно
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40))  # параллельных запросов от Telegram (1..100)
+if UPDATE_MODE == 'webhook' and not WEBHOOK_URL:
+    raise ValueError("Для UPDATE_MODE=webhook нужен WEBHOOK_URL в .env файле!")
+
+# Эндпоинт /metrics в формате Prometheus; 0 — выключен
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9108))
@@ -24,9 +24,20 @@ RUSSIAN_SIGNS = {
     'Capricorn': 'Козерог', 'Aquarius': 'Водолей', 'Pisces': 'Рыбы'
 }
 
+# Horoscope types
+HOROSCOPE_TYPES_RUS = {
+    "daily": "ежедневный",
+    "weekly": "еженедельный",
+    "monthly": "ежемесячный",
+    "yearly": "годовой"
+}
+
 # Timezones
 TIMEZONES = [f"UTC{i:+d}" for i in range(-12, 15)]
 
+# Время уведомлений (совпадает с кнопками в keyboards.get_time_keyboard)
+NOTIFICATION_TIMES = [f"{h:02d}:00" for h in range(24)]
+
 # Database Paths
 DB_USERS = 'data/users.db'
 DB_HOROSCOPES = 'data/horoscopes.db'
@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import random
+import time
+from contextlib import asynccontextmanager
+
+# Дочерний логгер парсеров: сообщения попадают в их обработчики (logs/parsers.log)
+logger = logging.getLogger('ParserRunner.crawl')
+
+# --- АДАПТИВНАЯ СКОРОСТЬ ОБХОДА САЙТА ---
+# Вместо фиксированной паузы 3–7 с после каждого запроса контроллер подстраивает
+# число одновременных запросов и интервал между их началами (AIMD):
+# каждый быстрый успешный ответ прибавляет к частоте запросов RATE_STEP, а ошибки,
+# медленные ответы и 429 сразу вдвое ее снижают (не чаще раза за интервал). Retry-After от сайта останавливает все запросы.
+# Границы вежливости ниже контроллер не переходит ни при каких ответах.
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 4
+MIN_DELAY = 0.5              # минимальный интервал между началами запросов, с
+MAX_DELAY = 15.0
+INITIAL_CONCURRENCY = 2
+INITIAL_DELAY = 2.0
+RATE_STEP = 0.05             # прибавка к частоте (запр./с) после каждого быстрого ответа
+SLOW_RESPONSE = 5.0          # ответ дольше этого считается признаком перегрузки сайта
+DELAY_JITTER = 0.2           # ±20% к интервалу, чтобы запросы не шли строго по таймеру
+DEFAULT_RETRY_AFTER = 30.0   # пауза после 429 без заголовка Retry-After
+MAX_RETRY_AFTER = 300.0
+
+class CrawlController:
+    """Ограничивает запросы к одному сайту и подстраивает скорость по его ответам."""
+
+    def __init__(self, concurrency: int = INITIAL_CONCURRENCY, delay: float = INITIAL_DELAY):
+        self.concurrency = concurrency
+        self.delay = delay
+        self._active = 0
+        self._condition = asyncio.Condition()
+        self._next_start = 0.0
+        self._paused_until = 0.0
+        self._decreased_at = 0.0
+        self._successes = 0
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self._latency_total = 0.0
+        self._started_at = time.monotonic()
+
+    @asynccontextmanager
+    async def slot(self):
+        """Место для одного запроса: ждет свободного потока, интервала и конца паузы."""
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._active < self.concurrency)
+            self._active += 1
+        try:
+            now = time.monotonic()
+            start = max(now, self._next_start, self._paused_until)
+            self._next_start = start + self.delay * random.uniform(1 - DELAY_JITTER, 1 + DELAY_JITTER)
+            if start > now:
+                await asyncio.sleep(start - now)
+            yield
+        finally:
+            async with self._condition:
+                self._active -= 1
+                self._condition.notify_all()
+
+    def record_success(self, latency: float):
+        self.requests += 1
+        self._latency_total += latency
+        if latency > SLOW_RESPONSE:
+            self._decrease(f"медленный ответ {latency:.1f} с")
+            return
+        self.delay = max(MIN_DELAY, 1 / (1 / self.delay + RATE_STEP))
+        # Один дополнительный поток за каждое «окно» успешных ответов
+        self._successes += 1
+        if self._successes >= self.concurrency and self.concurrency < MAX_CONCURRENCY:
+            self.concurrency += 1
+            self._successes = 0
+
+    def record_error(self, latency: float):
+        self.requests += 1
+        self.errors += 1
+        self._latency_total += latency
+        self._decrease("ошибка запроса")
+
+    def record_throttled(self, retry_after: float = None):
+        self.requests += 1
+        self.throttled += 1
+        pause = min(MAX_RETRY_AFTER, retry_after if retry_after is not None else DEFAULT_RETRY_AFTER)
+        self._paused_until = max(self._paused_until, time.monotonic() + pause)
+        self._decrease(f"сайт просит подождать {pause:.0f} с")
+
+    def _decrease(self, reason: str):
+        # Одновременные запросы часто получают отказ из-за одной и той же перегрузки
+        now = time.monotonic()
+        if now - self._decreased_at < self.delay:
+            return
+        self._decreased_at = now
+        self.concurrency = max(MIN_CONCURRENCY, self.concurrency // 2)
+        self.delay = min(MAX_DELAY, self.delay * 2)
+        self._successes = 0
+        logger.info("Замедляю обход (%s): потоков %s, интервал %.2f с", reason, self.concurrency, self.delay)
+
+    def stats(self):
+        elapsed = time.monotonic() - self._started_at
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "throttled": self.throttled,
+            "elapsed_s": round(elapsed, 1),
+            "rate_per_s": round(self.requests / elapsed, 3) if elapsed > 0 else 0.0,
+            "avg_latency_ms": round(self._latency_total / self.requests * 1000, 1) if self.requests else 0.0,
+            "concurrency": self.concurrency,
+            "delay_s": round(self.delay, 2),
+        }
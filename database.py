@@ -1,12 +1,146 @@
-import aiosqlite
+import asyncio
 import logging
-import sqlite3 # Импортируем для detect_types
-from constants import DB_USERS
+import sys
+import time
+from collections import OrderedDict
+from db_pool import users_pool
+from metrics import track_db, measure, DB_CALL_SECONDS, DB_CALL_ERRORS
 
 logger = logging.getLogger(__name__)
 
+# --- ОТЛОЖЕННАЯ ЗАПИСЬ (write-behind) ДЛЯ save_user_data ---
+USER_FLUSH_INTERVAL = 0.5   # секунды между записями очереди
+USER_FLUSH_BATCH = 500      # при стольких пользователях в очереди пишем сразу
+USER_FLUSH_MAX_BACKOFF = 60 # потолок паузы между повторами после ошибок записи, с
+
+_user_columns = None
+_pending_updates = {}       # user_id -> {колонка: значение}, еще не записано
+_flushing_updates = {}      # пакет, который записывается прямо сейчас
+_flush_task = None
+_flush_lock = None
+_batch_full = None
+_flush_generation = 0       # увеличивается после каждой успешной записи очереди
+_flush_failures = 0         # ошибок записи подряд
+_flush_last_error = None    # текст последней ошибки: одинаковые ошибки подряд не логируются заново
+
+# --- КЭШ ПРОФИЛЕЙ ПОЛЬЗОВАТЕЛЕЙ (LRU + TTL) ---
+USER_CACHE_TTL = 300                      # секунды
+USER_CACHE_MAX_ENTRIES = 50_000
+USER_CACHE_MAX_BYTES = 64 * 1024 * 1024   # приблизительная оценка памяти
+
+class _UserCache:
+    """LRU-кэш строк users с ограничением по времени жизни, числу записей и памяти."""
+
+    def __init__(self, ttl: float, max_entries: int, max_bytes: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # user_id -> (expires_at, size, user)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _sizeof(user: dict) -> int:
+        return sys.getsizeof(user) + sum(sys.getsizeof(v) for v in user.values())
+
+    def get(self, user_id: int):
+        entry = self._entries.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                self._remove(user_id)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[2]
+
+    def put(self, user_id: int, user: dict):
+        if user_id in self._entries:
+            self._remove(user_id)
+        size = self._sizeof(user)
+        self._entries[user_id] = (time.monotonic() + self.ttl, size, user)
+        self.bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self.bytes > self.max_bytes):
+            oldest_id = next(iter(self._entries))
+            self._remove(oldest_id)
+            self.evictions += 1
+
+    def update(self, user_id: int, updates: dict):
+        """Применяет запись к закэшированной строке, не продлевая TTL."""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return
+        expires_at, size, user = entry
+        user.update(updates)
+        new_size = self._sizeof(user)
+        self._entries[user_id] = (expires_at, new_size, user)
+        self.bytes += new_size - size
+
+    def _remove(self, user_id: int):
+        _, size, _ = self._entries.pop(user_id)
+        self.bytes -= size
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / requests, 4) if requests else 0.0,
+            "evictions": self.evictions,
+        }
+
+_user_cache = _UserCache(USER_CACHE_TTL, USER_CACHE_MAX_ENTRIES, USER_CACHE_MAX_BYTES)
+_update_listeners = []      # вызываются с (user_id, обновления) после постановки в очередь
+
+def add_user_update_listener(callback):
+    """Регистрирует callback(user_id, updates), вызываемый при каждом save_user_data."""
+    _update_listeners.append(callback)
+
+def get_user_cache_stats():
+    return _user_cache.stats()
+
+# (колонка, тип) — добавляются в users через ALTER TABLE, если их еще нет
+USER_COLUMN_MIGRATIONS = [
+    ('birth_tz', 'TEXT'),       # часовой пояс места рождения (IANA или UTC±N)
+    ('natal_hash', 'TEXT'),     # ключ натальной карты в natal_charts
+    ('utc_minute', 'INTEGER'),  # минута суток по UTC для ежедневной рассылки
+]
+
+# --- РАСПИСАНИЕ РАССЫЛКИ ---
+# timezone ('UTC+3') и notification_time ('09:00') хранятся текстом; для выборки
+# подписчиков по минуте рассылки они сводятся в utc_minute (0..1439). Колонка
+# пересчитывается в SQL при записи очереди обновлений, если изменился часовой
+# пояс или время, поэтому совпадает с utc_minute_for() без чтения строки в Python.
+SCHEDULE_COLUMNS = {'timezone', 'notification_time'}
+UTC_MINUTE_SQL = '''CASE WHEN timezone LIKE 'UTC%' AND notification_time LIKE '__:__' THEN
+    ((CAST(substr(notification_time, 1, 2) AS INTEGER) * 60 + CAST(substr(notification_time, 4, 2) AS INTEGER)
+      - CAST(substr(timezone, 4) AS INTEGER) * 60) % 1440 + 1440) % 1440 END'''
+USER_MIGRATION_CHUNK = 5000   # строк на транзакцию при заполнении utc_minute
+DUE_USERS_PAGE_SIZE = 1000
+
+USER_INDEXES = [
+    # Частичные индексы: пользователи без знака зодиака не получают рассылку
+    # и не попадают в статистику по знакам. user_id (rowid) входит в индекс неявно,
+    # поэтому выборка страницы по user_id > ? — только по индексу, без таблицы.
+    "CREATE INDEX IF NOT EXISTS idx_users_due ON users (is_active, utc_minute) WHERE zodiac_sign IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS idx_users_sign ON users (is_active, zodiac_sign) WHERE zodiac_sign IS NOT NULL",
+]
+
+def utc_minute_for(timezone: str, notification_time: str):
+    """Минута суток по UTC для пары ('UTC+3', '09:00'); то же, что UTC_MINUTE_SQL."""
+    if not timezone or not notification_time or not timezone.startswith('UTC'):
+        return None
+    hour, minute = map(int, notification_time.split(':'))
+    return (hour * 60 + minute - int(timezone[3:]) * 60) % 1440
+
+@track_db
 async def init_user_db():
-    async with aiosqlite.connect(DB_USERS) as db:
+    global _user_columns
+    async with users_pool.writer() as db:
         await db.execute('''
             CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
@@ -28,48 +162,272 @@ async def init_user_db():
                 birth_lon REAL   -- Долгота
             )
         ''')
-        await db.commit()
+        cursor = await db.execute("PRAGMA table_info(users)")
+        _user_columns = [row[1] for row in await cursor.fetchall()]
+        # Колонки, появившиеся после создания таблицы у существующих установок
+        for column, column_type in USER_COLUMN_MIGRATIONS:
+            if column not in _user_columns:
+                await db.execute(f"ALTER TABLE users ADD COLUMN {column} {column_type}")
+                _user_columns.append(column)
+                logger.info("В таблицу users добавлена колонка %s.", column)
+        for statement in USER_INDEXES:
+            await db.execute(statement)
+    await _backfill_utc_minute()
     logger.info("База данных пользователей инициализирована.")
 
+async def _backfill_utc_minute():
+    """
+    Заполняет utc_minute у строк, где он еще не посчитан. Пачками по
+    USER_MIGRATION_CHUNK в отдельных транзакциях, чтобы не держать блокировку
+    записи живой базы; повторный запуск продолжает с оставшихся строк.
+    """
+    total = 0
+    while True:
+        async with users_pool.writer() as db:
+            cursor = await db.execute(
+                f"""UPDATE users SET utc_minute = {UTC_MINUTE_SQL}
+                   WHERE user_id IN (
+                       SELECT user_id FROM users
+                       WHERE utc_minute IS NULL AND timezone LIKE 'UTC%' AND notification_time LIKE '__:__'
+                       LIMIT ?)""",
+                (USER_MIGRATION_CHUNK,)
+            )
+            updated = cursor.rowcount
+        total += updated
+        if updated < USER_MIGRATION_CHUNK:
+            break
+        # Между пачками отдаем цикл событий обработчикам бота
+        await asyncio.sleep(0)
+    if total:
+        logger.info("utc_minute заполнен у %s пользователей.", total)
+
+async def _get_user_columns():
+    """Набор колонок таблицы users; читается из БД один раз за процесс."""
+    global _user_columns
+    if _user_columns is None:
+        async with users_pool.reader() as db:
+            cursor = await db.execute("PRAGMA table_info(users)")
+            _user_columns = [row[1] for row in await cursor.fetchall()]
+    return _user_columns
+
+def _get_pending_updates(user_id: int):
+    """Обновления пользователя, которые еще не записаны в БД."""
+    updates = {}
+    for source in (_flushing_updates, _pending_updates):
+        if user_id in source:
+            updates.update(source[user_id])
+    return updates
+
+@track_db
 async def get_user_data(user_id: int):
-    # Используем detect_types для авто-преобразования DATE/TIME
-    async with aiosqlite.connect(DB_USERS, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-        row = await cursor.fetchone()
-        return dict(row) if row else None
+    cached = _user_cache.get(user_id)
+    if cached is not None:
+        return dict(cached)
+
+    generation = _flush_generation
+    # Соединения пула открыты с detect_types для авто-преобразования DATE/TIME.
+    # execute_fetchall — один переход в поток aiosqlite вместо двух (execute, fetchone):
+    # под нагрузкой каждый переход ждет очереди цикла событий, пока соединение занято
+    async with users_pool.reader() as db:
+        rows = await db.execute_fetchall("SELECT * FROM users WHERE user_id = ?", (user_id,))
+    row = rows[0] if rows else None
+
+    # Накладываем отложенные записи поверх строки из БД (или поверх новой пустой строки)
+    pending = _get_pending_updates(user_id)
+    if row:
+        user = dict(row)
+    elif pending:
+        user = {column: None for column in await _get_user_columns()}
+        user.update(user_id=user_id, is_active=True)
+    else:
+        return None
+    user.update(pending)
 
+    # Если очередь записалась во время чтения, строка могла устареть — не кэшируем
+    if generation == _flush_generation:
+        _user_cache.put(user_id, user)
+    return dict(user)
+
+@track_db
 async def save_user_data(user_id: int, **kwargs):
+    """
+    Ставит обновление в очередь отложенной записи. Обновления одного
+    пользователя сливаются, а очередь записывается одной транзакцией
+    раз в USER_FLUSH_INTERVAL секунд или при накоплении USER_FLUSH_BATCH пользователей.
+    """
     if not kwargs: return
-    async with aiosqlite.connect(DB_USERS) as db:
-        await db.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
-        
-        # --- УЛУЧШЕНИЕ: Адаптивная проверка колонок ---
-        cursor = await db.execute(f"PRAGMA table_info(users)")
-        existing_columns = {row[1] for row in await cursor.fetchall()}
-        
-        # Фильтруем kwargs, оставляя только те, что есть в таблице
-        valid_kwargs = {k: v for k, v in kwargs.items() if k in existing_columns}
-        if not valid_kwargs:
-            logger.warning(f"Нет валидных колонок для обновления у {user_id}")
+
+    # --- УЛУЧШЕНИЕ: Адаптивная проверка колонок ---
+    existing_columns = await _get_user_columns()
+
+    # Фильтруем kwargs, оставляя только те, что есть в таблице
+    valid_kwargs = {k: v for k, v in kwargs.items() if k in existing_columns}
+    if not valid_kwargs:
+        logger.warning("Нет валидных колонок для обновления у %s", user_id)
+        return
+    # --- Конец улучшения ---
+
+    _pending_updates.setdefault(user_id, {}).update(valid_kwargs)
+    _user_cache.update(user_id, valid_kwargs)
+    logger.debug("Данные для %s поставлены в очередь на запись: %s", user_id, valid_kwargs)
+    for callback in _update_listeners:
+        try:
+            callback(user_id, valid_kwargs)
+        except Exception as e:
+            logger.error("Ошибка в обработчике обновления пользователя: %s", e, exc_info=True)
+
+    global _flush_task
+    if len(_pending_updates) >= USER_FLUSH_BATCH:
+        _get_batch_full_event().set()
+    if _flush_task is None or _flush_task.done():
+        _flush_task = asyncio.create_task(_flush_loop())
+
+def _get_batch_full_event():
+    global _batch_full
+    if _batch_full is None:
+        _batch_full = asyncio.Event()
+    return _batch_full
+
+def _flush_delay() -> float:
+    """Пауза до следующей записи: USER_FLUSH_INTERVAL, после ошибок — вдвое больше за каждую, до USER_FLUSH_MAX_BACKOFF."""
+    return min(USER_FLUSH_MAX_BACKOFF, USER_FLUSH_INTERVAL * 2 ** _flush_failures)
+
+async def _flush_loop():
+    batch_full = _get_batch_full_event()
+    while _pending_updates:
+        if _flush_failures:
+            # БД недоступна: полный пакет не повод повторять раньше срока
+            await asyncio.sleep(_flush_delay())
+        else:
+            try:
+                await asyncio.wait_for(batch_full.wait(), USER_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+        batch_full.clear()
+        await flush_user_updates()
+
+@track_db
+async def flush_user_updates():
+    """Записывает все накопленные обновления пользователей одной транзакцией."""
+    global _pending_updates, _flushing_updates, _flush_lock, _flush_generation, _flush_failures, _flush_last_error
+    if _flush_lock is None:
+        _flush_lock = asyncio.Lock()
+
+    async with _flush_lock:
+        if not _pending_updates:
             return
-        # --- Конец улучшения ---
+        batch, _pending_updates = _pending_updates, {}
+        _flushing_updates = batch
+
+        # executemany требует одинаковый SQL, поэтому группируем по набору колонок
+        groups = {}
+        for user_id, updates in batch.items():
+            columns = tuple(sorted(updates))
+            groups.setdefault(columns, []).append(tuple(updates[c] for c in columns) + (user_id,))
 
-        set_clause = ', '.join([f"{key} = ?" for key in valid_kwargs])
-        values = list(valid_kwargs.values()) + [user_id]
-        
-        await db.execute(f"UPDATE users SET {set_clause} WHERE user_id = ?", tuple(values))
-        await db.commit()
-        logger.info(f"Данные для {user_id} сохранены: {valid_kwargs}")
+        try:
+            async with users_pool.writer() as db:
+                await db.executemany(
+                    "INSERT OR IGNORE INTO users (user_id) VALUES (?)",
+                    [(user_id,) for user_id in batch]
+                )
+                for columns, rows in groups.items():
+                    set_clause = ', '.join([f"{column} = ?" for column in columns])
+                    await db.executemany(f"UPDATE users SET {set_clause} WHERE user_id = ?", rows)
+                # Минута рассылки зависит от обеих колонок, поэтому считается по строке в БД
+                rescheduled = [(user_id,) for user_id, updates in batch.items() if SCHEDULE_COLUMNS & updates.keys()]
+                if rescheduled:
+                    await db.executemany(f"UPDATE users SET utc_minute = {UTC_MINUTE_SQL} WHERE user_id = ?", rescheduled)
+            # Увеличиваем после commit, до очистки _flushing_updates (без await между ними)
+            _flush_generation += 1
+            if _flush_failures:
+                logger.info("Запись обновлений пользователей восстановлена после %s ошибок подряд.", _flush_failures)
+            _flush_failures, _flush_last_error = 0, None
+            logger.info("Записаны обновления %s пользователей (%s групп колонок).", len(batch), len(groups))
+        except Exception as e:
+            # Возвращаем пакет в очередь; более новые обновления важнее
+            for user_id, updates in batch.items():
+                _pending_updates[user_id] = {**updates, **_pending_updates.get(user_id, {})}
+            _flush_failures += 1
+            if str(e) != _flush_last_error:
+                _flush_last_error = str(e)
+                logger.error("Ошибка записи обновлений пользователей: %s", e, exc_info=True)
+            # Ход повторов — на 1-й, 2-й, 4-й, 8-й... ошибке подряд, а не на каждой
+            if _flush_failures & (_flush_failures - 1) == 0:
+                logger.warning(
+                    "Запись обновлений %s пользователей не удалась (%s раз подряд), повтор через %.1f с.",
+                    len(_pending_updates), _flush_failures, _flush_delay()
+                )
+        finally:
+            _flushing_updates = {}
 
+@track_db
 async def get_all_active_users():
     """Возвращает список ID всех активных пользователей."""
     user_ids = []
-    async with aiosqlite.connect(DB_USERS) as db:
-        db.row_factory = aiosqlite.Row
+    async with users_pool.reader() as db:
         cursor = await db.execute("SELECT user_id FROM users WHERE is_active = TRUE")
         rows = await cursor.fetchall()
         if rows:
             user_ids = [row['user_id'] for row in rows]
-    logger.info(f"Найдено {len(user_ids)} активных пользователей для рассылки.")
+    logger.info("Найдено %s активных пользователей для рассылки.", len(user_ids))
     return user_ids
+
+async def iter_due_users(utc_minute: int, page_size: int = DUE_USERS_PAGE_SIZE):
+    """
+    Асинхронно выдает страницы ID активных подписчиков с минутой рассылки utc_minute.
+    Keyset-пагинация по user_id через idx_users_due: каждая страница — короткое
+    чтение, весь список в память не загружается.
+    """
+    last_id = 0
+    while True:
+        # Асинхронный генератор не оборачивается декоратором: замеряется каждая страница
+        with measure(DB_CALL_SECONDS, 'iter_due_users', errors=DB_CALL_ERRORS):
+            async with users_pool.reader() as db:
+                rows = await db.execute_fetchall(
+                    """SELECT user_id FROM users INDEXED BY idx_users_due
+                       WHERE is_active = TRUE AND utc_minute = ? AND zodiac_sign IS NOT NULL AND user_id > ?
+                       ORDER BY user_id LIMIT ?""",
+                    (utc_minute, last_id, page_size)
+                )
+                user_ids = [row[0] for row in rows]
+        if not user_ids:
+            return
+        yield user_ids
+        if len(user_ids) < page_size:
+            return
+        last_id = user_ids[-1]
+
+async def iter_scheduled_users(page_size: int = DUE_USERS_PAGE_SIZE):
+    """
+    Асинхронно выдает страницы (user_id, timezone, notification_time) активных
+    подписчиков с заполненными настройками — для пересборки задач режима per_user.
+    """
+    last_id = 0
+    while True:
+        with measure(DB_CALL_SECONDS, 'iter_scheduled_users', errors=DB_CALL_ERRORS):
+            async with users_pool.reader() as db:
+                cursor = await db.execute(
+                    """SELECT user_id, timezone, notification_time FROM users
+                       WHERE is_active = TRUE AND zodiac_sign IS NOT NULL AND utc_minute IS NOT NULL AND user_id > ?
+                       ORDER BY user_id LIMIT ?""",
+                    (last_id, page_size)
+                )
+                rows = [(row[0], row[1], row[2]) for row in await cursor.fetchall()]
+        if not rows:
+            return
+        yield rows
+        if len(rows) < page_size:
+            return
+        last_id = rows[-1][0]
+
+@track_db
+async def get_active_sign_counts():
+    """Число активных пользователей по знакам зодиака (по индексу idx_users_sign)."""
+    async with users_pool.reader() as db:
+        cursor = await db.execute(
+            """SELECT zodiac_sign, COUNT(*) FROM users
+               WHERE is_active = TRUE AND zodiac_sign IS NOT NULL
+               GROUP BY zodiac_sign"""
+        )
+        return {row[0]: row[1] for row in await cursor.fetchall()}
@@ -0,0 +1,144 @@
+import aiosqlite
+import asyncio
+import logging
+import sqlite3
+import time
+from contextlib import asynccontextmanager
+from constants import DB_USERS, DB_HOROSCOPES
+
+logger = logging.getLogger(__name__)
+
+# --- ПУЛ СОЕДИНЕНИЙ SQLITE ---
+# На каждую БД держим несколько долгоживущих соединений для чтения
+# и одно соединение для записи. WAL позволяет читать, пока парсеры пишут,
+# а кэш подготовленных выражений sqlite3 живет столько же, сколько соединение.
+READER_COUNT = 4
+STATEMENT_CACHE_SIZE = 256
+DETECT_TYPES = sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
+
+PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",     # в режиме WAL безопасно и без fsync на каждый commit
+    "PRAGMA cache_size=-16000",      # 16 МБ страничного кэша на соединение
+    "PRAGMA mmap_size=268435456",    # 256 МБ
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",      # ждем блокировку писателя из другого процесса
+]
+
+class _Timing:
+    """Счетчик длительностей: количество, сумма и максимум в секундах."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def as_dict(self):
+        avg = self.total / self.count if self.count else 0.0
+        return {"count": self.count, "avg_ms": round(avg * 1000, 3), "max_ms": round(self.max * 1000, 3)}
+
+class ConnectionPool:
+    """
+    Пул соединений одной БД: READER_COUNT читателей и один писатель.
+    Соединения открываются при первом обращении.
+
+        async with pool.reader() as db: ...   # только чтение
+        async with pool.writer() as db: ...   # commit при выходе, rollback при ошибке
+    """
+
+    def __init__(self, path: str, readers: int = READER_COUNT):
+        self.path = path
+        self.reader_count = readers
+        self._readers = None
+        self._all = []
+        self._writer = None
+        self._writer_lock = None
+        self._open_lock = None
+        self.wait = _Timing()
+        self.query = _Timing()
+
+    async def _connect(self):
+        db = await aiosqlite.connect(self.path, detect_types=DETECT_TYPES, cached_statements=STATEMENT_CACHE_SIZE)
+        db.row_factory = aiosqlite.Row
+        for pragma in PRAGMAS:
+            await db.execute(pragma)
+        self._all.append(db)
+        return db
+
+    async def _ensure_open(self):
+        if self._writer is not None:
+            return
+        if self._open_lock is None:
+            self._open_lock = asyncio.Lock()
+        async with self._open_lock:
+            if self._writer is not None:
+                return
+            # Писатель открывается первым: он включает WAL для файла БД
+            writer = await self._connect()
+            self._readers = asyncio.Queue()
+            for _ in range(self.reader_count):
+                self._readers.put_nowait(await self._connect())
+            self._writer_lock = asyncio.Lock()
+            self._writer = writer
+            logger.info("Пул соединений %s открыт: %s читателей, 1 писатель.", self.path, self.reader_count)
+
+    @asynccontextmanager
+    async def reader(self):
+        await self._ensure_open()
+        started = time.perf_counter()
+        db = await self._readers.get()
+        acquired = time.perf_counter()
+        self.wait.add(acquired - started)
+        try:
+            yield db
+        finally:
+            self.query.add(time.perf_counter() - acquired)
+            self._readers.put_nowait(db)
+
+    @asynccontextmanager
+    async def writer(self):
+        await self._ensure_open()
+        started = time.perf_counter()
+        async with self._writer_lock:
+            acquired = time.perf_counter()
+            self.wait.add(acquired - started)
+            try:
+                yield self._writer
+                await self._writer.commit()
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            finally:
+                self.query.add(time.perf_counter() - acquired)
+
+    async def close(self):
+        for db in self._all:
+            await db.close()
+        self._all = []
+        self._readers = None
+        self._writer = None
+
+    def stats(self):
+        return {
+            "readers_idle": self._readers.qsize() if self._readers else 0,
+            "wait": self.wait.as_dict(),
+            "query": self.query.as_dict(),
+        }
+
+users_pool = ConnectionPool(DB_USERS)
+horoscopes_pool = ConnectionPool(DB_HOROSCOPES)
+
+def get_pool_stats():
+    """Время ожидания соединения и длительность запросов по каждой БД."""
+    return {pool.path: pool.stats() for pool in (users_pool, horoscopes_pool)}
+
+async def close_all_pools():
+    """Закрывает соединения; потоки aiosqlite иначе не дадут процессу завершиться."""
+    for pool in (users_pool, horoscopes_pool):
+        await pool.close()
@@ -0,0 +1,253 @@
+import argparse
+import logging
+import mmap
+import os
+import struct
+import time
+from bisect import bisect_left
+from collections import namedtuple
+from itertools import groupby
+from logging_setup import setup_logging
+
+logger = logging.getLogger(__name__)
+
+# --- ОФЛАЙН-ГЕОКОДЕР ГОРОДОВ ---
+# Справочник городов (geodata/cities.tsv) собирается в бинарный индекс
+# data/geo_index.bin, который открывается через mmap. Индекс — массив ключей
+# (нормализованные русские, латинские и альтернативные названия), отсортированный
+# по байтам UTF-8, поэтому поиск по префиксу — двоичный поиск и короткий проход
+# вперед. Для коротких префиксов, под которые попадает больше MAX_SCAN ключей,
+# индекс хранит готовый список самых крупных городов (TOP_CITIES), так что
+# «Са» предлагает Санкт-Петербург, а не первые по алфавиту поселки. Сеть не
+# нужна, кэша по пользователям нет. Индекс пересобирается автоматически, если
+# справочник новее или собран в старом формате.
+GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'geodata', 'cities.tsv')
+GEO_INDEX_PATH = os.path.join('data', 'geo_index.bin')
+SUGGESTION_LIMIT = 8
+MAX_SCAN = 200               # ключей, просматриваемых на один префикс; для более длинных диапазонов — TOP_CITIES
+TOP_CITIES = SUGGESTION_LIMIT  # городов в готовом списке префикса
+
+_MAGIC = b'GEO2'
+_HEADER = struct.Struct('<4sIIIII')          # magic, записей, ключей, часовых поясов, префиксов, городов в списке
+_NO_RECORD = 0xFFFF                          # пустое место в списке префикса
+_RECORD = struct.Struct('<ffIIHIH2sH')       # lat, lon, население (тыс.), ru (смещение, длина), en (смещение, длина), страна, пояс
+_KEY = struct.Struct('<IHH')                 # ключ (смещение, длина), номер записи
+_STRING = struct.Struct('<IH')               # строка часового пояса (смещение, длина)
+
+class City(namedtuple('City', ['id', 'name_ru', 'name_en', 'country', 'lat', 'lon', 'timezone', 'population'])):
+    __slots__ = ()
+
+    def birth_fields(self) -> dict:
+        """Поля users для save_user_data, если это город рождения."""
+        return {'birth_city': self.name_ru, 'birth_lat': self.lat, 'birth_lon': self.lon, 'birth_tz': self.timezone}
+
+def normalize(text: str) -> str:
+    """Ключ поиска: без регистра, ё → е, дефисы и повторные пробелы → один пробел."""
+    text = text.casefold().replace('ё', 'е').replace('-', ' ')
+    return ' '.join(text.split())
+
+def _read_gazetteer(path: str):
+    cities = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip() or line.startswith('#'):
+                continue
+            name_ru, name_en, country, lat, lon, tz, population, alt_names = line.rstrip('\n').split('\t')
+            cities.append((name_ru, name_en, country, float(lat), float(lon), tz, int(population),
+                           [name for name in alt_names.split(',') if name]))
+    return cities
+
+def build_geo_index(src: str = GAZETTEER_PATH, dst: str = GEO_INDEX_PATH):
+    """Собирает бинарный индекс из справочника; запись атомарная."""
+    cities = _read_gazetteer(src)
+    strings = bytearray()
+    string_offsets = {}
+
+    def add_string(text: str):
+        data = text.encode('utf-8')
+        if data not in string_offsets:
+            string_offsets[data] = len(strings)
+            strings.extend(data)
+        return string_offsets[data], len(data)
+
+    timezones = sorted({city[5] for city in cities})
+    tz_ids = {tz: i for i, tz in enumerate(timezones)}
+    records = bytearray()
+    keys = []
+    for record_id, (name_ru, name_en, country, lat, lon, tz, population, alt_names) in enumerate(cities):
+        records += _RECORD.pack(lat, lon, population, *add_string(name_ru), *add_string(name_en),
+                                country.encode('ascii'), tz_ids[tz])
+        for key in {normalize(name) for name in [name_ru, name_en, *alt_names]}:
+            keys.append((key.encode('utf-8'), -population, record_id))
+    # Байтовый порядок UTF-8 совпадает с порядком кодовых точек; при равных ключах — крупнее город
+    keys.sort()
+
+    key_table = bytearray()
+    for key, _, record_id in keys:
+        key_table += _KEY.pack(*add_string(key.decode('utf-8')), record_id)
+
+    # Префиксы, под которые попадает больше MAX_SCAN ключей: поиск не дойдет до конца
+    # диапазона, поэтому крупнейшие города для них выбираются заранее. Ключи отсортированы,
+    # так что ключи с общим префиксом идут подряд.
+    top_lists = []
+    length = 1
+    while True:
+        long_ranges = 0
+        for prefix, group in groupby(keys, key=lambda item: item[0].decode('utf-8')[:length]):
+            group = list(group)
+            if len(prefix) < length or len(group) <= MAX_SCAN:
+                continue
+            long_ranges += 1
+            top = sorted({record_id: population for _, population, record_id in group}.items(),
+                         key=lambda item: (item[1], item[0]))[:TOP_CITIES]
+            record_ids = [record_id for record_id, _ in top]
+            record_ids += [_NO_RECORD] * (TOP_CITIES - len(record_ids))
+            top_lists.append((prefix.encode('utf-8'), record_ids))
+        if not long_ranges:
+            break
+        length += 1
+    # Поиск списка — двоичный, поэтому таблица упорядочена по байтам префикса, как ключи
+    top_lists.sort()
+    top_entry = struct.Struct(f'<IH{TOP_CITIES}H')
+    top_table = bytearray()
+    for prefix, record_ids in top_lists:
+        top_table += top_entry.pack(*add_string(prefix.decode('utf-8')), *record_ids)
+    tz_table = bytearray()
+    for tz in timezones:
+        tz_table += _STRING.pack(*add_string(tz))
+
+    os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+    tmp_path = f"{dst}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(_MAGIC, len(cities), len(keys), len(timezones), len(top_lists), TOP_CITIES))
+        f.write(records)
+        f.write(key_table)
+        f.write(tz_table)
+        f.write(top_table)
+        f.write(strings)
+    os.replace(tmp_path, dst)
+    logger.info("Индекс городов собран: %s городов, %s ключей, %s байт.", len(cities), len(keys), os.path.getsize(dst))
+
+class _GeoIndex:
+    """Индекс, открытый через mmap; все чтения — срезы отображенного файла."""
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, = struct.unpack_from('<4s', self._mm, 0)
+        if magic != _MAGIC:
+            self._mm.close()
+            raise ValueError(f"{path}: не индекс городов или старый формат")
+        magic, self.n_records, self.n_keys, n_timezones, self.n_prefixes, top_cities = _HEADER.unpack_from(self._mm, 0)
+        self._top_entry = struct.Struct(f'<IH{top_cities}H')
+        self._records_at = _HEADER.size
+        self._keys_at = self._records_at + self.n_records * _RECORD.size
+        self._tz_at = self._keys_at + self.n_keys * _KEY.size
+        self._top_at = self._tz_at + n_timezones * _STRING.size
+        self._strings_at = self._top_at + self.n_prefixes * self._top_entry.size
+        # Часовых поясов несколько десятков — их проще держать строками
+        self._timezones = [self._string(*_STRING.unpack_from(self._mm, self._tz_at + i * _STRING.size))
+                           for i in range(n_timezones)]
+
+    def _string_bytes(self, offset: int, length: int) -> bytes:
+        start = self._strings_at + offset
+        return self._mm[start:start + length]
+
+    def _string(self, offset: int, length: int) -> str:
+        return self._string_bytes(offset, length).decode('utf-8')
+
+    def _key(self, i: int):
+        offset, length, record_id = _KEY.unpack_from(self._mm, self._keys_at + i * _KEY.size)
+        return self._string_bytes(offset, length), record_id
+
+    def _top(self, i: int):
+        offset, length, *record_ids = self._top_entry.unpack_from(self._mm, self._top_at + i * self._top_entry.size)
+        return self._string_bytes(offset, length), [record_id for record_id in record_ids if record_id != _NO_RECORD]
+
+    def _top_cities(self, prefix: bytes):
+        """Готовый список крупнейших городов префикса или None, если диапазон префикса короткий."""
+        i = bisect_left(range(self.n_prefixes), prefix, key=lambda i: self._top(i)[0])
+        if i < self.n_prefixes:
+            top_prefix, record_ids = self._top(i)
+            if top_prefix == prefix:
+                return record_ids
+        return None
+
+    def city(self, record_id: int) -> City:
+        lat, lon, population, ru_offset, ru_length, en_offset, en_length, country, tz_id = \
+            _RECORD.unpack_from(self._mm, self._records_at + record_id * _RECORD.size)
+        return City(record_id, self._string(ru_offset, ru_length), self._string(en_offset, en_length),
+                    country.decode('ascii'), round(lat, 4), round(lon, 4), self._timezones[tz_id], population)
+
+    def search(self, prefix: bytes, limit: int):
+        # Двоичный поиск первого ключа >= prefix по ключам прямо из mmap
+        lo = bisect_left(range(self.n_keys), prefix, key=lambda i: self._key(i)[0])
+        matches = {}   # record_id -> ключ совпал целиком
+        top = self._top_cities(prefix)
+        if top is not None:
+            # Длинный диапазон: точные совпадения идут первыми в нем, остальное — из готового списка
+            for i in range(lo, self.n_keys):
+                key, record_id = self._key(i)
+                if key != prefix:
+                    break
+                matches[record_id] = True
+            for record_id in top:
+                matches.setdefault(record_id, False)
+        else:
+            for i in range(lo, min(lo + MAX_SCAN, self.n_keys)):
+                key, record_id = self._key(i)
+                if not key.startswith(prefix):
+                    break
+                matches[record_id] = matches.get(record_id, False) or key == prefix
+        cities = [self.city(record_id) for record_id in matches]
+        # Сначала точные совпадения, затем крупные города
+        cities.sort(key=lambda city: (not matches[city.id], -city.population))
+        return cities[:limit]
+
+    def close(self):
+        self._mm.close()
+
+_index = None
+
+def _get_index() -> _GeoIndex:
+    global _index
+    if _index is None:
+        if not os.path.exists(GEO_INDEX_PATH) or os.path.getmtime(GEO_INDEX_PATH) < os.path.getmtime(GAZETTEER_PATH):
+            build_geo_index()
+        try:
+            _index = _GeoIndex(GEO_INDEX_PATH)
+        except ValueError as e:
+            logger.warning("%s — пересобираю индекс городов.", e)
+            build_geo_index()
+            _index = _GeoIndex(GEO_INDEX_PATH)
+    return _index
+
+def search_cities(query: str, limit: int = SUGGESTION_LIMIT):
+    """Города, название которых начинается с query (русское, латинское или альтернативное)."""
+    prefix = normalize(query)
+    if not prefix:
+        return []
+    return _get_index().search(prefix.encode('utf-8'), limit)
+
+def get_city(city_id: int):
+    """Город по id из search_cities (например, из callback_data кнопки) или None."""
+    index = _get_index()
+    if not 0 <= city_id < index.n_records:
+        return None
+    return index.city(city_id)
+
+if __name__ == "__main__":
+    setup_logging()
+    parser = argparse.ArgumentParser(description="Офлайн-поиск городов.")
+    parser.add_argument('query', nargs='?', help="начало названия города")
+    parser.add_argument('--build', action='store_true', help="пересобрать индекс из справочника")
+    args = parser.parse_args()
+    if args.build:
+        build_geo_index()
+    if args.query:
+        started = time.perf_counter()
+        cities = search_cities(args.query)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        for city in cities:
+            print(f"{city.id:>4}  {city.name_ru} / {city.name_en}, {city.country}  {city.lat}, {city.lon}  {city.timezone}")
+        print(f"{len(cities)} городов за {elapsed_ms:.3f} мс")
@@ -0,0 +1,76 @@
+from bs4 import BeautifulSoup, SoupStrainer
+from constants import GENERAL_BLOCK_CLASS, SUB_CONTAINER_CLASS, BUSINESS_BLOCK_CLASS, RATE_BLOCK_CLASS, HOROSCOPE_ITEMS_CLASS
+
+# --- ИЗВЛЕЧЕНИЕ ДАННЫХ ИЗ HTML ---
+# Модуль выполняется в рабочих процессах пула разбора (spawn), поэтому при
+# импорте ничего не настраивает и не тянет БД, логирование и сеть.
+# 'strained' строит дерево только для блоков гороскопа (SoupStrainer), 'full' — для всей
+# страницы, как раньше; результат одинаковый. Сравнение: python bench/parse_benchmark.py
+EXTRACT_ENGINES = ('strained', 'full')
+
+_HOROSCOPE_STRAINER = SoupStrainer("div", class_=[GENERAL_BLOCK_CLASS, SUB_CONTAINER_CLASS])
+
+def extract_horoscope(text: str, engine: str = 'strained') -> dict:
+    """Извлекает поля гороскопа из HTML страницы."""
+    if engine == 'strained':
+        soup = BeautifulSoup(text, 'html.parser', parse_only=_HOROSCOPE_STRAINER)
+    else:
+        soup = BeautifulSoup(text, 'html.parser')
+    
+    # Инициализируем словарь для всех полей
+    result = {
+        "general_text": None, "business_text": None, "business_rating": None,
+        "health_text": None, "health_rating": None, "love_text": None,
+        "love_rating": None, "lunar_text": None, "lunar_rating": None,
+    }
+
+    # 1. Парсим общий гороскоп
+    general_block = soup.find("div", class_=GENERAL_BLOCK_CLASS)
+    if general_block:
+        result["general_text"] = general_block.get_text(" ", strip=True)
+
+    # 2. Парсим все остальные блоки (Бизнес, Здоровье и т.д.)
+    container = soup.find("div", class_=SUB_CONTAINER_CLASS)
+    if container:
+        blocks = container.find_all("div", class_=BUSINESS_BLOCK_CLASS)
+        for block in blocks:
+            title_elem = block.find("h2")
+            if not title_elem:
+                continue
+            title = title_elem.get_text(strip=True).lower()
+
+            # Извлекаем текст из параграфов <p>
+            items_block = block.find("div", class_=HOROSCOPE_ITEMS_CLASS)
+            text_parts = []
+            if items_block:
+                paragraphs = items_block.find_all("p")
+                for p in paragraphs:
+                    p_text = p.get_text(strip=True)
+                    # ИСПРАВЛЕНИЕ: Игнорируем лишний текст в лунном календаре
+                    if "лун" in title and p_text.startswith('Сегодня'):
+                        break
+                    text_parts.append(p_text)
+            text = " ".join(text_parts)
+
+            # Извлекаем рейтинг
+            rate_block = block.find("div", class_=RATE_BLOCK_CLASS)
+            rating = None
+            if rate_block:
+                rate_parts = [r.get_text(strip=True) for r in rate_block.find_all("div") if r.get_text(strip=True)]
+                rating = '/'.join(rate_parts)
+
+            # Распределяем данные по ключам
+            if "бизнес" in title:
+                result["business_text"] = text
+                result["business_rating"] = rating
+            elif "здоров" in title:
+                result["health_text"] = text
+                result["health_rating"] = rating
+            elif "любов" in title:
+                result["love_text"] = text
+                result["love_rating"] = rating
+            elif "лун" in title:
+                result["lunar_text"] = text
+                result["lunar_rating"] = rating
+                
+    return result
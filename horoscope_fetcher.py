@@ -1,29 +1,244 @@
 import aiosqlite
+import asyncio
+import json
 import logging
-import sqlite3 # ИСПРАВЛЕНИЕ: Импортируем для константы PARSE_DECLTYPES
-from constants import DB_HOROSCOPES, ZODIAC_MAP
+import os
+import time
+from array import array
+from collections import OrderedDict
+from datetime import timedelta
+from constants import DB_HOROSCOPES, ZODIAC_MAP, ZODIAC_SIGNS_EN
+from db_pool import horoscopes_pool
+from metrics import track_db
+from transits import PLANETS
 
 logger = logging.getLogger(__name__)
 
+# --- КЭШ ГОРОСКОПОВ В ПАМЯТИ ---
+# В БД нас интересуют только последние гороскопы: 12 знаков x 4 типа.
+# Кэш хранит их целиком и перечитывается, когда БД меняется на диске
+# (проверка mtime не чаще раза в CACHE_CHECK_INTERVAL секунд)
+# или когда insert_horoscopes вызывает invalidate_horoscope_cache().
+CACHE_CHECK_INTERVAL = 5
+
+_cache = {}                # (sign_id, type) -> dict строки
+_cache_valid = False
+_cache_version = None
+_cache_checked_at = 0.0
+_cache_generation = 0      # увеличивается при каждой инвалидации
+_reload_task = None
+_reload_listeners = []     # вызываются с новым содержимым кэша после загрузки
+
+def _db_version():
+    """Версия БД по mtime/размеру основного файла и WAL-журнала."""
+    version = []
+    for path in (DB_HOROSCOPES, DB_HOROSCOPES + '-wal'):
+        try:
+            st = os.stat(path)
+            version.append((st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            version.append(None)
+    return tuple(version)
+
+def add_cache_reload_listener(callback):
+    """Регистрирует callback(cache), вызываемый после каждой загрузки кэша."""
+    _reload_listeners.append(callback)
+
+def invalidate_horoscope_cache():
+    """Помечает кэш устаревшим: следующий запрос перечитает гороскопы из БД."""
+    global _cache_valid, _cache_generation
+    _cache_valid = False
+    _cache_generation += 1
+
+@track_db
+async def _load_cache():
+    global _cache, _cache_valid, _cache_version
+    generation = _cache_generation
+    version = _db_version()
+    new_cache = {}
+    try:
+        async with horoscopes_pool.reader() as db:
+            cursor = await db.execute(
+                '''SELECT h.* FROM horoscopes h
+                   JOIN (SELECT sign_id, type, MAX(date) AS max_date
+                         FROM horoscopes GROUP BY sign_id, type) latest
+                     ON h.sign_id = latest.sign_id AND h.type = latest.type
+                    AND h.date = latest.max_date'''
+            )
+            for row in await cursor.fetchall():
+                new_cache[(row['sign_id'], row['type'])] = dict(row)
+    except aiosqlite.Error as e:
+        logger.error("Ошибка БД при загрузке кэша гороскопов: %s", e)
+        return
+
+    _cache = new_cache
+    _cache_version = version
+    # Если во время загрузки пришла инвалидация, кэш остается устаревшим
+    _cache_valid = generation == _cache_generation
+    logger.info("Кэш гороскопов загружен: %s записей.", len(new_cache))
+    for callback in _reload_listeners:
+        try:
+            callback(new_cache)
+        except Exception as e:
+            logger.error("Ошибка в обработчике обновления кэша гороскопов: %s", e, exc_info=True)
+
+async def _reload_cache():
+    """Перечитывает кэш; одновременные вызовы ждут одну и ту же загрузку."""
+    global _reload_task
+    if _reload_task is None:
+        _reload_task = asyncio.ensure_future(_load_cache())
+
+        def _clear(_):
+            global _reload_task
+            _reload_task = None
+        _reload_task.add_done_callback(_clear)
+    await asyncio.shield(_reload_task)
+
+async def _ensure_cache_fresh():
+    global _cache_checked_at
+    now = time.monotonic()
+    if _cache_valid and now - _cache_checked_at < CACHE_CHECK_INTERVAL:
+        return
+    _cache_checked_at = now
+    if _cache_valid and _db_version() == _cache_version:
+        return
+    await _reload_cache()
+
+@track_db
+async def warm_horoscope_cache():
+    """Заполняет кэш при старте бота."""
+    await _reload_cache()
+
+@track_db
 async def get_horoscope_from_db(sign_name: str, horoscope_type: str):
     sign_id = ZODIAC_MAP.get(sign_name)
     if not sign_id:
-        logger.error(f"Неверное имя знака: {sign_name}")
+        logger.error("Неверное имя знака: %s", sign_name)
         return None
+
+    await _ensure_cache_fresh()
+    data = _cache.get((sign_id, horoscope_type))
+    if data:
+        return dict(data)
+    logger.warning("Гороскоп типа %s для %s не найден в БД.", horoscope_type, sign_name)
+    return None
+
+# --- ТРАНЗИТЫ ---
+# transits_cache хранит JSON на каждую дату; здесь он разбирается один раз
+# в компактный DayTransits и держится в LRU по датам, так что повторные
+# запросы транзитов (например, для персональных сообщений) — чтение из памяти.
+# Строки transits_cache после записи не меняются, поэтому кэш не инвалидируется;
+# отсутствующие даты не кэшируются — их может дописать расчет окна.
+TRANSIT_CACHE_SIZE = 64      # дат в памяти
+TRANSIT_PLANETS = tuple(p.capitalize() for p in PLANETS)   # Sun, Moon, ...
+_PLANET_INDEX = {name: i for i, name in enumerate(TRANSIT_PLANETS)}
+# kerykeion пишет знак сокращенно ('Ari'), ZODIAC_SIGNS_EN идет по порядку зодиака
+_SIGN_INDEX = {sign[:3]: i for i, sign in enumerate(ZODIAC_SIGNS_EN)}
+
+class DayTransits:
+    """
+    Транзиты на дату в порядке TRANSIT_PLANETS: signs — индексы знаков
+    в ZODIAC_SIGNS_EN, lons — градусы в знаке. Объект общий для всех
+    читателей кэша, изменять его нельзя.
+    """
+    __slots__ = ('date', 'signs', 'lons')
+
+    def __init__(self, transit_date, signs: bytes, lons: array):
+        self.date = transit_date
+        self.signs = signs
+        self.lons = lons
+
+    @classmethod
+    def from_json(cls, transit_date, planet_data: str):
+        data = json.loads(planet_data)
+        signs = bytes(_SIGN_INDEX[data[planet]['sign'][:3]] for planet in TRANSIT_PLANETS)
+        lons = array('f', (data[planet]['lon'] for planet in TRANSIT_PLANETS))
+        return cls(transit_date, signs, lons)
+
+    def sign(self, planet: str) -> str:
+        """Знак планеты ('Aries', ...), planet — 'Sun', 'Moon', ..."""
+        return ZODIAC_SIGNS_EN[self.signs[_PLANET_INDEX[planet]]]
+
+    def lon(self, planet: str) -> float:
+        """Градус планеты в знаке."""
+        return self.lons[_PLANET_INDEX[planet]]
+
+    def abs_lon(self, planet: str) -> float:
+        """Эклиптическая долгота планеты, 0–360."""
+        i = _PLANET_INDEX[planet]
+        return self.signs[i] * 30 + self.lons[i]
+
+    def to_dict(self):
+        """Тот же вид, что и planet_data в БД: {"Sun": {"sign": ..., "lon": ...}}."""
+        return {
+            planet: {"sign": ZODIAC_SIGNS_EN[self.signs[i]][:3], "lon": round(self.lons[i], 2)}
+            for i, planet in enumerate(TRANSIT_PLANETS)
+        }
+
+_transits_cache = OrderedDict()   # date -> DayTransits
+_transits_hits = 0
+_transits_misses = 0
+
+def _remember_transits(transits: DayTransits):
+    _transits_cache[transits.date] = transits
+    _transits_cache.move_to_end(transits.date)
+    while len(_transits_cache) > TRANSIT_CACHE_SIZE:
+        _transits_cache.popitem(last=False)
+
+@track_db
+async def get_transits_range(start, end):
+    """Транзиты на даты от start до end включительно: {date: DayTransits}; дат без расчета в ответе нет."""
+    global _transits_hits, _transits_misses
+    result = {}
+    missing = []
+    day = start
+    while day <= end:
+        transits = _transits_cache.get(day)
+        if transits:
+            _transits_cache.move_to_end(day)
+            result[day] = transits
+        else:
+            missing.append(day)
+        day += timedelta(days=1)
+    _transits_hits += len(result)
+    _transits_misses += len(missing)
+    if not missing:
+        return result
+
+    # Все недостающие даты — одним запросом
     try:
-        # ИСПРАВЛЕНИЕ: Добавлен detect_types
-        async with aiosqlite.connect(DB_HOROSCOPES, detect_types=sqlite3.PARSE_DECLTYPES) as db:
-            db.row_factory = aiosqlite.Row
+        async with horoscopes_pool.reader() as db:
             cursor = await db.execute(
-                'SELECT * FROM horoscopes WHERE sign_id = ? AND type = ? ORDER BY date DESC LIMIT 1',
-                (sign_id, horoscope_type)
+                "SELECT transit_date, planet_data FROM transits_cache WHERE transit_date BETWEEN ? AND ?",
+                (missing[0], missing[-1])
             )
-            data = await cursor.fetchone()
-            if data:
-                return dict(data)
-            else:
-                logger.warning(f"Гороскоп типа {horoscope_type} для {sign_name} не найден в БД.")
-                return None
+            rows = await cursor.fetchall()
     except aiosqlite.Error as e:
-        logger.error(f"Ошибка БД при получении гороскопа для {sign_name}: {e}")
-        return None
+        logger.error("Ошибка БД при чтении транзитов: %s", e)
+        return result
+
+    for transit_date, planet_data in rows:
+        if transit_date in result:
+            continue
+        try:
+            transits = DayTransits.from_json(transit_date, planet_data)
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error("Поврежденные транзиты на %s: %s", transit_date, e)
+            continue
+        _remember_transits(transits)
+        result[transit_date] = transits
+    return dict(sorted(result.items()))
+
+@track_db
+async def get_transits(transit_date):
+    """Транзиты на дату или None, если они еще не рассчитаны."""
+    global _transits_hits
+    transits = _transits_cache.get(transit_date)
+    if transits:
+        _transits_cache.move_to_end(transit_date)
+        _transits_hits += 1
+        return transits
+    return (await get_transits_range(transit_date, transit_date)).get(transit_date)
+
+def get_transit_cache_stats():
+    return {"hits": _transits_hits, "misses": _transits_misses, "size": len(_transits_cache)}
@@ -70,3 +70,12 @@ def get_horoscope_type_keyboard():
         [InlineKeyboardButton("Годовой", callback_data='h_type_yearly')]
     ]
     return InlineKeyboardMarkup(keyboard)
+
+def get_city_keyboard(cities):
+    """Подсказки городов из geocoder.search_cities; в callback_data — id города для geocoder.get_city."""
+    keyboard = [
+        [InlineKeyboardButton(f"{city.name_ru}, {city.country}", callback_data=f'city_{city.id}')]
+        for city in cities
+    ]
+    keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data=CbData.CANCEL)])
+    return InlineKeyboardMarkup(keyboard)
@@ -0,0 +1,96 @@
+import asyncio
+import atexit
+import logging
+import os
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+
+# --- НЕБЛОКИРУЮЩЕЕ ЛОГИРОВАНИЕ ---
+# Все логгеры процесса пишут в корневой QueueHandler: в цикле событий запись
+# только форматирует сообщение и кладет его в очередь, а вывод в консоль и
+# файлы делает фоновый поток QueueListener. Сообщения передаются в стиле
+# logger.info("... %s", x), чтобы строка не собиралась для отключенных уровней.
+# Частые успешные события (отправка одному пользователю) сворачиваются в
+# LogSummary — одну строку раз в SUMMARY_INTERVAL; ошибки пишутся полностью.
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_DIR = 'logs'
+LOG_BACKUP_DAYS = 7
+SUMMARY_INTERVAL = 60
+# Сторонние логгеры, пишущие INFO на каждый запрос
+NOISY_LOGGERS = ['httpx', 'apscheduler.executors.default']
+
+_listener = None
+_summaries = []
+
+def setup_logging(level: int = logging.INFO, log_file: str = None):
+    """
+    Направляет корневой логгер через очередь в фоновый поток: консоль и,
+    если задан log_file, файл в LOG_DIR с ротацией в полночь. Повторный вызов
+    ничего не меняет.
+    """
+    global _listener
+    if _listener is not None:
+        return
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        os.makedirs(LOG_DIR, exist_ok=True)
+        handlers.append(TimedRotatingFileHandler(
+            os.path.join(LOG_DIR, log_file), when='midnight', backupCount=LOG_BACKUP_DAYS, encoding='utf-8'
+        ))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(level)
+    for name in NOISY_LOGGERS:
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+def stop_logging():
+    """Выводит накопленные сводки и дожидается записи очереди. Вызывается при остановке процесса."""
+    global _listener
+    for summary in _summaries:
+        summary.flush()
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+class LogSummary:
+    """
+    Счетчик однотипных успешных событий: вместо строки на каждое событие —
+    одна строка "<message>: N за T с" раз в interval секунд.
+    """
+
+    def __init__(self, logger: logging.Logger, message: str, interval: float = SUMMARY_INTERVAL):
+        self.logger = logger
+        self.message = message
+        self.interval = interval
+        self.count = 0
+        self._started_at = None
+        _summaries.append(self)
+
+    def record(self, count: int = 1):
+        self.count += count
+        if self._started_at is None:
+            self._started_at = time.monotonic()
+            try:
+                asyncio.get_running_loop().call_later(self.interval, self.flush)
+            except RuntimeError:
+                pass   # вне цикла событий сводка выводится при следующем record после интервала
+        elif time.monotonic() - self._started_at >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if self.count:
+            self.logger.info("%s: %s за %.0f с", self.message, self.count, time.monotonic() - self._started_at)
+        self.count = 0
+        self._started_at = None
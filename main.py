@@ -1,30 +1,45 @@
+import time
+# Отсчет запуска — до импорта остальных модулей (см. startup.py)
+_started_at = time.perf_counter()
 import logging
 import asyncio
-import nest_asyncio 
+import importlib
 import os
+import signal
+from datetime import datetime
 from telegram import Update, BotCommand
 from telegram.ext import (
     Application, CommandHandler, CallbackContext,
-    CallbackQueryHandler, ConversationHandler
+    CallbackQueryHandler, ConversationHandler, TypeHandler
 )
 from warnings import filterwarnings
 from telegram.warnings import PTBUserWarning
 
 filterwarnings(action="ignore", message=r".*CallbackQueryHandler", category=PTBUserWarning)
 
-nest_asyncio.apply() 
-
-from config import BOT_TOKEN
+from config import DELIVERY_MODE, GENERATION_BACKEND, UPDATE_MODE, UPDATE_CONCURRENCY, METRICS_LISTEN, METRICS_PORT
 from keyboards import *
-from database import init_user_db, get_user_data, save_user_data
+from database import init_user_db, get_user_data, save_user_data, flush_user_updates, get_user_cache_stats
+from db_pool import close_all_pools, get_pool_stats
+from outbound import get_bot, get_outbound_stats
+from metrics import track_handler, register_stats, start_metrics_server
+from logging_setup import setup_logging
+from startup import StartupTimer
 
 # --- ИЗМЕНЕННЫЙ ИМПОРТ ИЗ SCHEDULER ---
-from scheduler import scheduler, update_user_jobs, format_horoscope_message, cache_daily_transits
+from scheduler import (
+    get_scheduler, start_scheduler, shutdown_scheduler, update_user_jobs, remove_user_jobs, setup_slot_jobs,
+    setup_user_jobs
+)
+from transits import fill_transit_window
+from natal import init_natal_db, shutdown_natal_executor, get_natal_cache_stats
+from personal_horoscopes import init_personal_db, generate_personal_horoscopes, get_personal_cache_stats
 # --- КОНЕЦ ИЗМЕНЕНИЯ ---
 
-from horoscope_fetcher import get_horoscope_from_db
+from horoscope_fetcher import warm_horoscope_cache, get_transit_cache_stats
+from message_cache import get_horoscope_message, get_message_cache_stats
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # Состояния для диалогов
@@ -33,10 +48,11 @@ SETTINGS_ROOT, SETTINGS_ZODIAC, SETTINGS_TIMEZONE, SETTINGS_TIME = range(3, 7)
 
 # === ОСНОВНЫЕ КОМАНДЫ И ГЛАВНОЕ МЕНЮ ===
 
+@track_handler
 async def start_command(update: Update, context: CallbackContext):
     """Начало диалога и сохранение основной информации о пользователе."""
     user = update.effective_user
-    logger.info(f"Команда /start от {user.id} ({user.username})")
+    logger.info("Команда /start от %s (%s)", user.id, user.username)
 
     # Собираем всю доступную информацию о пользователе
     user_info = {
@@ -57,23 +73,28 @@ async def start_command(update: Update, context: CallbackContext):
     await update.message.reply_text("Шаг 1: Выберите ваш знак зодиака:", reply_markup=get_zodiac_keyboard())
     return SETUP_ZODIAC
 
+@track_handler
 async def show_main_menu(update: Update, context: CallbackContext, text: str = "Главное меню:"):
     """Универсальная функция для показа главного меню."""
-    logger.info("Показ главного меню")
+    logger.debug("Показ главного меню")
     if update.callback_query:
         await update.callback_query.edit_message_text(text, reply_markup=get_main_menu_keyboard())
     else:
         await update.message.reply_text(text, reply_markup=get_main_menu_keyboard())
     return ConversationHandler.END
 
+@track_handler
+async def menu_command(update: Update, context: CallbackContext):
+    await update.message.reply_text("Главное меню:", reply_markup=get_main_menu_keyboard())
+
+@track_handler
 async def stop_command(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
     await save_user_data(user_id, is_active=False)
-    job_id = f'daily_{user_id}'
-    if scheduler.get_job(job_id):
-        scheduler.remove_job(job_id)
+    remove_user_jobs(user_id)
     await update.message.reply_text("🛑 Уведомления отключены. Чтобы включить, используйте /subscribe.")
     
+@track_handler
 async def subscribe_command(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
     user = await get_user_data(user_id)
@@ -86,18 +107,21 @@ async def subscribe_command(update: Update, context: CallbackContext):
 
 # === ДИАЛОГ ПЕРВОНАЧАЛЬНОЙ НАСТРОЙКИ ===
 
+@track_handler
 async def setup_select_zodiac(update: Update, context: CallbackContext):
     query = update.callback_query; await query.answer()
     context.user_data['zodiac'] = query.data.split('_')[1]
     await query.edit_message_text("Шаг 2: Выберите ваш часовой пояс.", reply_markup=get_timezone_keyboard())
     return SETUP_TIMEZONE
 
+@track_handler
 async def setup_select_timezone(update: Update, context: CallbackContext):
     query = update.callback_query; await query.answer()
     context.user_data['timezone'] = query.data.split('_')[1]
     await query.edit_message_text("Шаг 3: Выберите время для уведомлений.", reply_markup=get_time_keyboard())
     return SETUP_TIME
 
+@track_handler
 async def setup_select_time(update: Update, context: CallbackContext):
     query = update.callback_query; await query.answer()
     time = query.data.split('_')[1]
@@ -112,6 +136,7 @@ async def setup_select_time(update: Update, context: CallbackContext):
     context.user_data.clear()
     return ConversationHandler.END
 
+@track_handler
 async def cancel_setup(update: Update, context: CallbackContext):
     query = update.callback_query; await query.answer()
     await query.edit_message_text("Настройка отменена.")
@@ -120,18 +145,21 @@ async def cancel_setup(update: Update, context: CallbackContext):
 
 # === ДИАЛОГ ИЗМЕНЕНИЯ НАСТРОЕК ===
 
+@track_handler
 async def settings_start(update: Update, context: CallbackContext):
     """Вход в меню настроек."""
     query = update.callback_query; await query.answer()
-    logger.info("Вход в меню настроек")
+    logger.debug("Вход в меню настроек")
     await query.edit_message_text("⚙️ Здесь вы можете изменить свои настройки:", reply_markup=get_settings_menu_keyboard())
     return SETTINGS_ROOT
 
+@track_handler
 async def settings_ask_zodiac(update: Update, context: CallbackContext):
     query = update.callback_query; await query.answer()
     await query.edit_message_text("Выберите ваш новый знак зодиака:", reply_markup=get_zodiac_keyboard(is_settings=True))
     return SETTINGS_ZODIAC
 
+@track_handler
 async def settings_save_zodiac(update: Update, context: CallbackContext):
     query = update.callback_query; await query.answer()
     zodiac_sign = query.data.split('_')[1]
@@ -139,11 +167,13 @@ async def settings_save_zodiac(update: Update, context: CallbackContext):
     await query.edit_message_text(f"✅ Знак изменен на {RUSSIAN_SIGNS[zodiac_sign]}.\n\n⚙️ Настройки:", reply_markup=get_settings_menu_keyboard())
     return SETTINGS_ROOT
 
+@track_handler
 async def settings_ask_timezone(update: Update, context: CallbackContext):
     query = update.callback_query; await query.answer()
     await query.edit_message_text("Выберите ваш новый часовой пояс:", reply_markup=get_timezone_keyboard(is_settings=True))
     return SETTINGS_TIMEZONE
 
+@track_handler
 async def settings_save_timezone(update: Update, context: CallbackContext):
     query = update.callback_query; await query.answer()
     timezone = query.data.split('_')[1]
@@ -155,11 +185,13 @@ async def settings_save_timezone(update: Update, context: CallbackContext):
     await query.edit_message_text(f"✅ Часовой пояс изменен на {timezone}.\n\n⚙️ Настройки:", reply_markup=get_settings_menu_keyboard())
     return SETTINGS_ROOT
 
+@track_handler
 async def settings_ask_time(update: Update, context: CallbackContext):
     query = update.callback_query; await query.answer()
     await query.edit_message_text("Выберите новое время уведомлений:", reply_markup=get_time_keyboard(is_settings=True))
     return SETTINGS_TIME
 
+@track_handler
 async def settings_save_time(update: Update, context: CallbackContext):
     query = update.callback_query; await query.answer()
     time = query.data.split('_')[1]
@@ -173,67 +205,67 @@ async def settings_save_time(update: Update, context: CallbackContext):
 
 # === ОБРАБОТЧИКИ ОСТАЛЬНЫХ КНОПОК ===
 
+@track_handler
 async def get_now_handler(update: Update, context: CallbackContext):
     query = update.callback_query; await query.answer()
-    logger.info("Кнопка 'Получить гороскоп' нажата")
+    logger.debug("Кнопка 'Получить гороскоп' нажата")
     user = await get_user_data(query.from_user.id)
     if not user or not user.get('zodiac_sign'):
         await query.message.reply_text("Сначала пройдите настройку через /start.")
         return
     await query.message.reply_text("Какой гороскоп хотите получить?", reply_markup=get_horoscope_type_keyboard())
     
+@track_handler
 async def help_handler(update: Update, context: CallbackContext):
     query = update.callback_query; await query.answer()
-    logger.info("Кнопка 'Помощь' нажата")
+    logger.debug("Кнопка 'Помощь' нажата")
     help_text = "Это бот для гороскопов. Команда /start начинает настройку."
     await query.edit_message_text(help_text, reply_markup=get_main_menu_keyboard())
     
+@track_handler
 async def horoscope_type_handler(update: Update, context: CallbackContext):
     query = update.callback_query; await query.answer()
-    logger.info("Выбран тип гороскопа")
+    logger.debug("Выбран тип гороскопа")
     horoscope_type = query.data.split('_')[2]
     user = await get_user_data(query.from_user.id)
     if not user: return
     
     await query.edit_message_text("🔮 Ищу ваш гороскоп, минутку...")
-    horoscope_data = await get_horoscope_from_db(user['zodiac_sign'], horoscope_type)
+    message = await get_horoscope_message(user['zodiac_sign'], horoscope_type)
     
-    if not horoscope_data:
+    if not message:
         await query.edit_message_text(f"😔 Гороскоп типа {horoscope_type} не найден. Попробуйте позже.")
         await context.bot.send_message(chat_id=query.from_user.id, text="Главное меню:", reply_markup=get_main_menu_keyboard())
         return
         
-    h_type_rus = {
-        "daily": "ежедневный", 
-        "weekly": "еженедельный", 
-        "monthly": "ежемесячный",
-        "yearly": "годовой" 
-    }.get(horoscope_type, "неизвестный")
-    message = format_horoscope_message(horoscope_data, user['zodiac_sign'], h_type_rus)
     await query.edit_message_text(message, parse_mode='Markdown')
     await context.bot.send_message(chat_id=query.from_user.id, text="Главное меню:", reply_markup=get_main_menu_keyboard())
 
+
+def _log_background_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Ошибка фонового запуска: %s", task.exception(), exc_info=task.exception())
+
 async def main():
+    # --- ЗАПУСК ---
+    # До приема обновлений — только то, без чего их нельзя обработать: схема
+    # пользователей, getMe и запуск polling/webhook. Кэш гороскопов, натальные
+    # карты, хранилище задач и сервер метрик поднимаются в фоне; кэш гороскопов
+    # при обращении до прогрева загрузится сам, а изменения задач пользователей
+    # применятся после запуска планировщика.
+    startup = StartupTimer(_started_at)
+    startup.record('imports', _started_at)
     if not os.path.exists('data'): os.makedirs('data')
-    await init_user_db()
-    
-    # --- ДОБАВЛЯЕМ ЗАДАЧУ КЭШИРОВАНИЯ ---
-    # Добавляем задачу: Запускать каждый день в 00:05 (5 минут после полуночи)
-    scheduler.add_job(
-        cache_daily_transits,
-        'cron',
-        hour=0,
-        minute=5,
-        id='daily_transit_cacher',
-        misfire_grace_time=60*10 # 10 минут на случай, если бот спал
-    )
-    # Запускаем один раз сразу при старте бота, чтобы не ждать полуночи
-    await cache_daily_transits()
-    # --- КОНЕЦ ИЗМЕНЕНИЯ ---
+    async with startup.phase('user_db'):
+        await init_user_db()
 
-    scheduler.start()
-
-    application = Application.builder().token(BOT_TOKEN).concurrent_updates(True).build()
+    # Тот же бот, что и у планировщика: общий пул соединений и общий ограничитель отправок.
+    # В режиме webhook Updater не нужен: обновления кладет в очередь WebhookServer.
+    # JobQueue PTB не используется (задачи — в scheduler), без нее start() не запускает второй планировщик
+    builder = Application.builder().bot(get_bot()).concurrent_updates(UPDATE_CONCURRENCY).job_queue(None)
+    if UPDATE_MODE == 'webhook':
+        builder = builder.updater(None)
+    application = builder.build()
 
     commands = [
         BotCommand("start", "🚀 Запустить/перезапустить бота"),
@@ -241,7 +273,6 @@ async def main():
         BotCommand("subscribe", "🔔 Включить ежедневные уведомления"),
         BotCommand("stop", "🔕 Отключить уведомления")
     ]
-    await application.bot.set_my_commands(commands)
 
     setup_conv = ConversationHandler(
         entry_points=[CommandHandler('start', start_command)],
@@ -286,23 +317,123 @@ async def main():
     application.add_handler(CallbackQueryHandler(help_handler, pattern=f'^{CbData.HELP}$'))
     
     application.add_handler(CallbackQueryHandler(horoscope_type_handler, pattern='^h_type_'))
-    application.add_handler(CommandHandler('menu', lambda u, c: u.message.reply_text("Главное меню:", reply_markup=get_main_menu_keyboard())))
+    application.add_handler(CommandHandler('menu', menu_command))
     
     application.add_handler(CommandHandler('stop', stop_command))
     application.add_handler(CommandHandler('subscribe', subscribe_command))
 
-    logger.info("Бот запущен...")
+    async def mark_first_update(update: Update, context: CallbackContext):
+        # Группа -1 выполняется раньше остальных и не прерывает обработку обновления
+        if startup.mark('first_update'):
+            logger.info("Первое обновление через %.3f с после старта.", startup.marks['first_update'])
+    application.add_handler(TypeHandler(Update, mark_first_update), group=-1)
+
+    metrics_runner = None
+
+    async def background_startup():
+        nonlocal metrics_runner
+        # Тяжелые импорты — в потоке: цикл событий тем временем продолжает обрабатывать
+        # обновления. get_scheduler() импортирует SQLAlchemy и создает хранилище задач
+        async with startup.phase('jobstore_import'):
+            await asyncio.to_thread(get_scheduler)
+        if METRICS_PORT:
+            async with startup.phase('aiohttp_import'):
+                await asyncio.to_thread(importlib.import_module, 'aiohttp.web')
+        async with startup.phase('commands'):
+            await application.bot.set_my_commands(commands)
+        async with startup.phase('natal_db'):
+            await init_natal_db()
+        # Таблица нужна рассылке и без бэкенда: тексты могли сгенерировать отдельным запуском
+        async with startup.phase('personal_db'):
+            await init_personal_db()
+        async with startup.phase('horoscope_cache'):
+            await warm_horoscope_cache()
+
+        async with startup.phase('scheduler'):
+            scheduler = get_scheduler()
+            # Каждый день в 00:05 досчитываем окно транзитов вперед. next_run_time — первый
+            # запуск сразу после старта планировщика, в фоне: бот не ждет расчета.
+            scheduler.add_job(
+                fill_transit_window,
+                'cron',
+                hour=0,
+                minute=5,
+                id='daily_transit_cacher',
+                next_run_time=datetime.now(),
+                replace_existing=True,
+                misfire_grace_time=60*10 # 10 минут на случай, если бот спал
+            )
+            # Персональные гороскопы генерируются ночью, после расчета транзитов
+            if GENERATION_BACKEND:
+                scheduler.add_job(
+                    generate_personal_horoscopes, 'cron', hour=1, minute=0,
+                    id='personal_horoscopes', replace_existing=True, misfire_grace_time=60*60
+                )
+            start_scheduler()
+            if DELIVERY_MODE == 'slots':
+                setup_slot_jobs()
+            else:
+                await setup_user_jobs()
+
+        if METRICS_PORT:
+            async with startup.phase('metrics'):
+                for prefix, source in [
+                    ('db_pool', get_pool_stats), ('user_cache', get_user_cache_stats),
+                    ('outbound', get_outbound_stats), ('message_cache', get_message_cache_stats),
+                    ('transit_cache', get_transit_cache_stats), ('natal_cache', get_natal_cache_stats),
+                    ('personal_cache', get_personal_cache_stats), ('startup', startup.stats),
+                ]:
+                    register_stats(prefix, source)
+                metrics_runner = await start_metrics_server(METRICS_LISTEN, METRICS_PORT)
+        startup.log("Фоновый запуск завершен")
+
+    # Один цикл событий на весь процесс: жизненный цикл Application ведем вручную
+    # вместо run_polling, который создает и закрывает собственный цикл
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    webhook_server = None
+    background = None
     try:
-        await application.run_polling(drop_pending_updates=True)
-    except KeyboardInterrupt:
-        logger.info("Получен сигнал прерывания. Остановка бота...")
+        async with startup.phase('bot_init'):
+            await application.initialize()
+            await application.start()
+        async with startup.phase('receiving'):
+            if UPDATE_MODE == 'webhook':
+                from webhook_server import WebhookServer
+                webhook_server = WebhookServer(application)
+                await webhook_server.start()
+                register_stats('webhook', webhook_server.stats)
+            else:
+                # Обновления, пришедшие за время перезапуска, не сбрасываем
+                await application.updater.start_polling(drop_pending_updates=False, allowed_updates=Update.ALL_TYPES)
+        logger.info("Бот запущен (%s, до %s обновлений одновременно)...", UPDATE_MODE, UPDATE_CONCURRENCY)
+        startup.log("Бот принимает обновления")
+        background = asyncio.create_task(background_startup())
+        background.add_done_callback(_log_background_error)
+        await stop_event.wait()
+        logger.info("Получен сигнал остановки. Остановка бота...")
     finally:
-        try:
+        if background is not None and not background.done():
+            background.cancel()
+            await asyncio.gather(background, return_exceptions=True)
+        if webhook_server is not None:
+            await webhook_server.stop()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        if application.updater is not None and application.updater.running:
+            await application.updater.stop()
+        # stop() дожидается обработки уже принятых обновлений
+        if application.running:
             await application.stop()
-        except RuntimeError as e:
-            logger.warning(f"Ошибка при вызове application.stop(): {e}")
-            
-        scheduler.shutdown()
+        await application.shutdown()
+
+        shutdown_scheduler()
+        await flush_user_updates()
+        shutdown_natal_executor()
+        await close_all_pools()
         logger.info("Бот остановлен.")
 
 if __name__ == "__main__":
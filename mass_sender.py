@@ -1,14 +1,16 @@
+import argparse
 import asyncio
 import logging
-from telegram import Bot
-from telegram.error import Forbidden
 
 # Импортируем нужные компоненты из вашего проекта
-from config import BOT_TOKEN
-from database import get_all_active_users, save_user_data
+from database import init_user_db, flush_user_updates
+from db_pool import close_all_pools
+from broadcast import init_broadcast_db, create_broadcast, run_broadcast, DEFAULT_CONCURRENCY
+from outbound import get_bot, rate_limiter
+from logging_setup import setup_logging
 
 # Настройка логирования
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # Текст вашего сообщения
@@ -21,45 +23,34 @@ MESSAGE_TEXT = """
 Спасибо, что остаетесь с нами ✨
 """
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Массовая рассылка MESSAGE_TEXT всем активным пользователям.")
+    parser.add_argument('--resume', type=int, metavar='ID', help="продолжить прерванную рассылку с этим ID")
+    parser.add_argument('--rate', type=float, default=rate_limiter.rate,
+                        help="сообщений в секунду (бот в отдельном процессе расходует тот же лимит Telegram)")
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY, help="одновременных отправок")
+    return parser.parse_args()
+
 async def main():
     """
     Основная функция для выполнения рассылки.
     """
-    bot = Bot(token=BOT_TOKEN)
+    args = parse_args()
+    rate_limiter.rate = args.rate
+    bot = get_bot()
     logger.info("Начинаем рассылку...")
 
-    user_ids = await get_all_active_users()
-    if not user_ids:
-        logger.info("Активных пользователей для рассылки не найдено.")
-        return
-
-    total_users = len(user_ids)
-    sent_count = 0
-    blocked_count = 0
-
-    for user_id in user_ids:
-        try:
-            await bot.send_message(chat_id=user_id, text=MESSAGE_TEXT)
-            sent_count += 1
-            logger.info(f"Сообщение успешно отправлено пользователю {user_id}")
-        except Forbidden:
-            # Если пользователь заблокировал бота
-            blocked_count += 1
-            logger.warning(f"Пользователь {user_id} заблокировал бота. Деактивируем.")
-            await save_user_data(user_id, is_active=False)
-        except Exception as e:
-            logger.error(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
-        
-        # Печатаем прогресс в консоль
-        progress = f"Прогресс: {sent_count + blocked_count}/{total_users} (Отправлено: {sent_count}, Заблокировали: {blocked_count})"
-        print(progress)
-
-        # САМАЯ ВАЖНАЯ ЧАСТЬ: задержка для защиты от бана
-        # 1 секунда — безопасная задержка. Не делайте ее меньше.
-        await asyncio.sleep(1)
-
-    logger.info("Рассылка завершена.")
-    logger.info(f"Всего отправлено: {sent_count}. Пользователей заблокировало бота: {blocked_count}.")
+    try:
+        await init_user_db()
+        await init_broadcast_db()
+        broadcast_id = args.resume or await create_broadcast(MESSAGE_TEXT)
+        async with bot:
+            counts = await run_broadcast(bot, broadcast_id, concurrency=args.concurrency)
+        logger.info("Рассылка завершена.")
+        logger.info("Итоги рассылки #%s: %s. Продолжить при сбое: --resume %s", broadcast_id, counts, broadcast_id)
+    finally:
+        await flush_user_updates()
+        await close_all_pools()
 
 
 if __name__ == "__main__":
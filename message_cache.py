@@ -0,0 +1,111 @@
+import logging
+from telegram.helpers import escape_markdown
+from constants import RUSSIAN_SIGNS, ZODIAC_MAP, HOROSCOPE_TYPES_RUS
+from horoscope_fetcher import get_horoscope_from_db, add_cache_reload_listener
+
+logger = logging.getLogger(__name__)
+
+# --- КЭШ ГОТОВЫХ СООБЩЕНИЙ ---
+# За день существует не больше 48 разных сообщений (12 знаков x 4 типа),
+# поэтому они форматируются один раз при загрузке новых гороскопов,
+# а рассылка и обработчики бота берут готовую строку по (знак, тип, дата).
+# Рядом с сообщением хранится строка БД, из которой оно собрано: если парсер
+# перезаписал гороскоп на ту же дату, сообщение собирается заново.
+SIGN_BY_ID = {sign_id: sign_name for sign_name, sign_id in ZODIAC_MAP.items()}
+
+_messages = {}  # (sign_name, type, date) -> (строка гороскопа, сообщение)
+_stats = {"hits": 0, "misses": 0, "rendered": 0}
+
+def format_horoscope_message(horoscope_data, sign_name, h_type_rus):
+    """Создает красивое форматированное сообщение для отправки в Telegram."""
+    sign_name_rus = RUSSIAN_SIGNS.get(sign_name, sign_name)
+
+    if not horoscope_data or not horoscope_data.get('general_text'):
+        return f"К сожалению, {h_type_rus} гороскоп для знака {sign_name_rus} еще не готов. Попробуйте позже."
+
+    horoscope_date = horoscope_data['date']
+
+    if h_type_rus == 'ежедневный':
+        date_display = horoscope_date.strftime('%d.%m.%Y')
+    elif h_type_rus == 'еженедельный':
+        date_display = f"неделю с {horoscope_date.strftime('%d.%m.%Y')}"
+    elif h_type_rus == 'ежемесячный':
+        date_display = horoscope_date.strftime('%Y-%m')
+    elif h_type_rus == 'годовой':
+        date_display = f"{horoscope_date.year} год"
+    else:
+        date_display = horoscope_date.strftime('%Y-%m-%d')
+
+    message_parts = [
+        f"🔮 *{h_type_rus.capitalize()} гороскоп для знака {sign_name_rus} на {date_display}*\n",
+        f"*{horoscope_data.get('general_text', 'Нет данных.')}*\n"
+    ]
+
+    sections = {
+        "business": f"💼 *Бизнес ({horoscope_data.get('business_rating', '-')})*",
+        "health": f"💪 *Здоровье ({horoscope_data.get('health_rating', '-')})*",
+        "love": f"❤️ *Любовь ({horoscope_data.get('love_rating', '-')})*",
+        "lunar": f"🌙 *Лунный календарь ({horoscope_data.get('lunar_rating', '-')})*"
+    }
+
+    for key, title in sections.items():
+        text_key = f"{key}_text"
+        if horoscope_data.get(text_key):
+            message_parts.append(f"{title}\n{horoscope_data[text_key]}\n")
+
+    return "\n".join(message_parts)
+
+def format_personal_message(sign_name: str, horoscope_date, text: str) -> str:
+    """Сообщение с персональным гороскопом; сгенерированный текст экранируется для Markdown."""
+    sign_name_rus = RUSSIAN_SIGNS.get(sign_name, sign_name)
+    return (
+        f"🔮 *Персональный гороскоп для знака {sign_name_rus} на {horoscope_date.strftime('%d.%m.%Y')}*\n\n"
+        f"{escape_markdown(text)}"
+    )
+
+def _render(sign_name: str, horoscope_type: str, horoscope_data: dict) -> str:
+    _stats["rendered"] += 1
+    h_type_rus = HOROSCOPE_TYPES_RUS.get(horoscope_type, "неизвестный")
+    return format_horoscope_message(horoscope_data, sign_name, h_type_rus)
+
+def _prerender(cache: dict):
+    """Перестраивает все сообщения после загрузки кэша гороскопов."""
+    global _messages
+    messages = {}
+    for (sign_id, horoscope_type), horoscope_data in cache.items():
+        sign_name = SIGN_BY_ID.get(sign_id)
+        if not sign_name:
+            continue
+        key = (sign_name, horoscope_type, horoscope_data['date'])
+        entry = _messages.get(key)
+        if entry is None or entry[0] != horoscope_data:
+            entry = (horoscope_data, _render(sign_name, horoscope_type, horoscope_data))
+        messages[key] = entry
+    _messages = messages
+    logger.info("Кэш сообщений обновлен: %s сообщений.", len(messages))
+
+add_cache_reload_listener(_prerender)
+
+async def get_horoscope_message(sign_name: str, horoscope_type: str):
+    """
+    Возвращает готовое сообщение с последним гороскопом знака
+    или None, если гороскопа в БД нет.
+    """
+    horoscope_data = await get_horoscope_from_db(sign_name, horoscope_type)
+    if not horoscope_data:
+        return None
+
+    key = (sign_name, horoscope_type, horoscope_data['date'])
+    entry = _messages.get(key)
+    if entry is not None and entry[0] == horoscope_data:
+        _stats["hits"] += 1
+        return entry[1]
+
+    _stats["misses"] += 1
+    message = _render(sign_name, horoscope_type, horoscope_data)
+    _messages[key] = (horoscope_data, message)
+    return message
+
+def get_message_cache_stats():
+    """Счетчики кэша: hits/misses запросов, rendered — сколько раз сообщение форматировалось."""
+    return {**_stats, "size": len(_messages)}
@@ -0,0 +1,178 @@
+import functools
+import inspect
+import logging
+import re
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# --- МЕТРИКИ ---
+# Счетчики и гистограммы в памяти процесса. Запись — несколько операций со
+# словарем и списком без блокировок (все в одном цикле событий), чтение —
+# HTTP-эндпоинт в текстовом формате Prometheus. Готовые счетчики модулей
+# (пулы БД, кэши, ограничитель отправок) подключаются через register_stats
+# и отдаются как gauge при каждом запросе /metrics.
+METRICS_PREFIX = 'horoscope_'
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LAG_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+
+_registry = {}          # имя -> Counter | Histogram
+_stats_sources = {}     # префикс -> функция, возвращающая (вложенный) dict чисел
+
+def _format_labels(labelnames, labelvalues, extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_value(value) -> str:
+    return repr(float(value)) if value != float('inf') else '+Inf'
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = METRICS_PREFIX + name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def inc(self, *labelvalues, amount: float = 1):
+        self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        for labelvalues, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}"
+
+class Histogram:
+    """Гистограмма с фиксированными границами; observe — один bisect и два сложения."""
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = METRICS_PREFIX + name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}      # labelvalues -> [счетчики по корзинам..., +Inf, сумма]
+
+    def observe(self, value: float, *labelvalues):
+        series = self._series.get(labelvalues)
+        if series is None:
+            series = self._series[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        for labelvalues, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series):
+                cumulative += count
+                labels = _format_labels(self.labelnames, labelvalues, f'le="{_format_value(bound)}"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, labelvalues)
+            yield f"{self.name}_sum{labels} {_format_value(series[-1])}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+def counter(name: str, documentation: str, labelnames=()) -> Counter:
+    if name not in _registry:
+        _registry[name] = Counter(name, documentation, labelnames)
+    return _registry[name]
+
+def histogram(name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS) -> Histogram:
+    if name not in _registry:
+        _registry[name] = Histogram(name, documentation, labelnames, buckets)
+    return _registry[name]
+
+HANDLER_SECONDS = histogram('handler_seconds', "Длительность обработчиков обновлений", ['handler'])
+HANDLER_ERRORS = counter('handler_errors_total', "Исключения в обработчиках обновлений", ['handler'])
+DB_CALL_SECONDS = histogram('db_call_seconds', "Длительность функций доступа к БД", ['function'])
+DB_CALL_ERRORS = counter('db_call_errors_total', "Исключения в функциях доступа к БД", ['function'])
+DELIVERY_SECONDS = histogram('delivery_seconds', "Длительность отправки ежедневного гороскопа", ['result'])
+DELIVERY_LAG_SECONDS = histogram(
+    'delivery_lag_seconds', "Опоздание ежедневного гороскопа относительно времени пользователя", buckets=LAG_BUCKETS
+)
+
+@contextmanager
+def measure(metric: Histogram, *labelvalues, errors: Counter = None):
+    """Замеряет блок кода (в том числе с await внутри) в гистограмму metric."""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        if errors is not None:
+            errors.inc(*labelvalues)
+        raise
+    finally:
+        metric.observe(time.perf_counter() - started, *labelvalues)
+
+def timed(metric: Histogram, errors: Counter = None, label: str = None):
+    """Декоратор для обычных и async-функций; метка по умолчанию — имя функции."""
+    def decorator(func):
+        name = label or func.__name__
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with measure(metric, name, errors=errors):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with measure(metric, name, errors=errors):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+track_handler = timed(HANDLER_SECONDS, HANDLER_ERRORS)
+track_db = timed(DB_CALL_SECONDS, DB_CALL_ERRORS)
+
+# --- ЭКСПОРТ ---
+def register_stats(prefix: str, source):
+    """Подключает функцию статистики модуля (например, get_pool_stats); числовые поля отдаются как gauge."""
+    _stats_sources[prefix] = source
+
+def _metric_name(*parts) -> str:
+    return METRICS_PREFIX + re.sub(r'[^a-zA-Z0-9_]', '_', '_'.join(str(part) for part in parts))
+
+def _flatten(prefix: str, stats: dict):
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            yield from _flatten(f"{prefix}_{key}", value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield _metric_name(prefix, key), value
+
+def render() -> str:
+    """Все метрики в текстовом формате Prometheus."""
+    lines = []
+    for metric in list(_registry.values()):
+        lines.extend(metric.collect())
+    for prefix, source in list(_stats_sources.items()):
+        try:
+            stats = source()
+        except Exception as e:
+            logger.error("Ошибка сбора статистики '%s': %s", prefix, e)
+            continue
+        for name, value in _flatten(prefix, stats):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {_format_value(value)}")
+    return '\n'.join(lines) + '\n'
+
+async def _handle_metrics(request):
+    from aiohttp import web
+    return web.Response(body=render().encode('utf-8'),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+async def start_metrics_server(host: str, port: int):
+    """Запускает HTTP-сервер с /metrics; возвращает runner для остановки через cleanup()."""
+    # Импорт здесь: aiohttp нужен только серверу метрик, а модуль импортируется при старте
+    from aiohttp import web
+    app = web.Application()
+    app.router.add_get('/metrics', _handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Метрики доступны на http://%s:%s/metrics", host, port)
+    return runner
@@ -0,0 +1,330 @@
+import argparse
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import time
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+from constants import ZODIAC_SIGNS_EN
+from database import init_user_db, get_user_data, save_user_data, flush_user_updates, add_user_update_listener
+from db_pool import users_pool, close_all_pools
+from geocoder import search_cities
+from transits import PLANETS
+from logging_setup import setup_logging
+
+logger = logging.getLogger(__name__)
+
+# --- НАТАЛЬНЫЕ КАРТЫ ---
+# Карта считается kerykeion в пуле процессов и хранится в natal_charts
+# по хэшу входных данных рождения (дата, время, координаты, часовой пояс),
+# поэтому пользователи с одинаковыми данными делят одну карту.
+# users.natal_hash указывает на карту пользователя; он пересчитывается, только
+# когда save_user_data меняет поля рождения. Существующих пользователей
+# досчитывает пакетный прогон: python natal.py --backfill
+NATAL_WORKERS = 2
+NATAL_CACHE_SIZE = 10_000    # карт в памяти
+NATAL_BATCH_SIZE = 500       # пользователей за шаг пакетного прогона
+NATAL_UPDATE_DELAY = 1.0     # секунды: изменения полей рождения собираются в один пересчет
+# Поля, от которых зависит карта. Часовой пояс рассылки (timezone) сюда не входит:
+# он не обязан совпадать с поясом места рождения. Без birth_tz пояс берется из
+# геокодера по birth_city, а если город не найти — карта не строится.
+BIRTH_FIELDS = {'birth_date', 'birth_time', 'birth_lat', 'birth_lon', 'birth_tz', 'birth_city'}
+DEFAULT_BIRTH_HOUR = 12      # если время рождения неизвестно — полдень, без асцендента
+COORD_PRECISION = 2          # ~1 км: различия точнее на карту не влияют
+CITY_MATCH_DEGREES = 0.5     # город геокодера считается местом рождения, если он не дальше этого по широте и долготе
+
+NATAL_PLANETS = tuple(p.capitalize() for p in PLANETS)   # Sun, Moon, ...
+_PLANET_INDEX = {name: i for i, name in enumerate(NATAL_PLANETS)}
+
+async def init_natal_db():
+    async with users_pool.writer() as db:
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS natal_charts (
+                natal_hash TEXT PRIMARY KEY,
+                signs BLOB,      -- индексы знаков планет в ZODIAC_SIGNS_EN, по байту на планету
+                lons BLOB,       -- градусы планет в знаке, float32
+                asc_sign INTEGER,
+                asc_lon REAL,
+                computed_at TIMESTAMP
+            ) WITHOUT ROWID
+        ''')
+
+class NatalChart:
+    """Натальная карта в порядке NATAL_PLANETS. Объект общий для всех читателей кэша, изменять его нельзя."""
+    __slots__ = ('natal_hash', 'signs', 'lons', 'asc_sign', 'asc_lon')
+
+    def __init__(self, natal_hash: str, signs: bytes, lons: array, asc_sign=None, asc_lon=None):
+        self.natal_hash = natal_hash
+        self.signs = signs
+        self.lons = lons
+        self.asc_sign = asc_sign
+        self.asc_lon = asc_lon
+
+    @classmethod
+    def from_row(cls, row):
+        lons = array('f')
+        lons.frombytes(row['lons'])
+        return cls(row['natal_hash'], bytes(row['signs']), lons, row['asc_sign'], row['asc_lon'])
+
+    def sign(self, planet: str) -> str:
+        """Знак планеты ('Aries', ...), planet — 'Sun', 'Moon', ..."""
+        return ZODIAC_SIGNS_EN[self.signs[_PLANET_INDEX[planet]]]
+
+    def lon(self, planet: str) -> float:
+        return self.lons[_PLANET_INDEX[planet]]
+
+    def abs_lon(self, planet: str) -> float:
+        """Эклиптическая долгота планеты, 0–360."""
+        i = _PLANET_INDEX[planet]
+        return self.signs[i] * 30 + self.lons[i]
+
+    @property
+    def ascendant(self):
+        """Знак асцендента или None, если время рождения неизвестно."""
+        return ZODIAC_SIGNS_EN[self.asc_sign] if self.asc_sign is not None else None
+
+def _geocoded_tz(user: dict):
+    """Часовой пояс города рождения из геокодера; город должен совпасть по названию и координатам."""
+    if not user.get('birth_city'):
+        return None
+    lat, lon = float(user['birth_lat']), float(user['birth_lon'])
+    for city in search_cities(user['birth_city']):
+        if abs(city.lat - lat) <= CITY_MATCH_DEGREES and abs(city.lon - lon) <= CITY_MATCH_DEGREES:
+            return city.timezone
+    return None
+
+def _tz_name(user: dict):
+    tz = user.get('birth_tz') or _geocoded_tz(user)
+    if not tz:
+        return None
+    if tz.startswith('UTC'):
+        # Формат бота 'UTC+3'; Etc/GMT имеет обратный знак: Etc/GMT-3 это UTC+3.
+        # Для часового пояса пользователя это приближение: история переходов на летнее время не учитывается.
+        offset = int(tz[3:] or 0)
+        return f"Etc/GMT{-offset:+d}"
+    return tz
+
+def natal_inputs(user: dict):
+    """Нормализованные данные рождения (дата, время или None, широта, долгота, пояс) или None, если их не хватает."""
+    if not user.get('birth_date') or user.get('birth_lat') is None or user.get('birth_lon') is None:
+        return None
+    tz = _tz_name(user)
+    if not tz:
+        return None
+    birth_time = user.get('birth_time')
+    return (
+        str(user['birth_date'])[:10],
+        str(birth_time)[:5] if birth_time else None,
+        round(float(user['birth_lat']), COORD_PRECISION),
+        round(float(user['birth_lon']), COORD_PRECISION),
+        tz,
+    )
+
+def natal_hash(inputs) -> str:
+    return hashlib.blake2b('|'.join(map(str, inputs)).encode('utf-8'), digest_size=10).hexdigest()
+
+def compute_natal_chart(inputs):
+    """Считает карту; возвращает (signs, lons, asc_sign, asc_lon) для natal_charts. Выполняется в дочернем процессе."""
+    # Импорт здесь: kerykeion тяжелый и нужен только рабочим процессам
+    from kerykeion import AstrologicalSubjectFactory
+
+    birth_date, birth_time, lat, lon, tz = inputs
+    day = date.fromisoformat(birth_date)
+    hour, minute = map(int, birth_time.split(':')) if birth_time else (DEFAULT_BIRTH_HOUR, 0)
+    subject = AstrologicalSubjectFactory.from_birth_data(
+        "Natal", day.year, day.month, day.day, hour, minute,
+        lng=lon, lat=lat, tz_str=tz, online=False
+    )
+    planets = [getattr(subject, p) for p in PLANETS]
+    signs = bytes(planet.sign_num for planet in planets)
+    lons = array('f', (planet.position for planet in planets)).tobytes()
+    if birth_time is None:
+        return signs, lons, None, None
+    return signs, lons, subject.ascendant.sign_num, round(subject.ascendant.position, 2)
+
+_executor = None
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        # spawn: дочерние процессы не наследуют потоки aiosqlite родителя
+        _executor = ProcessPoolExecutor(max_workers=NATAL_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return _executor
+
+def shutdown_natal_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown()
+        _executor = None
+
+async def _existing_hashes(hashes) -> set:
+    hashes = list(hashes)
+    existing = set()
+    async with users_pool.reader() as db:
+        for i in range(0, len(hashes), NATAL_BATCH_SIZE):
+            chunk = hashes[i:i + NATAL_BATCH_SIZE]
+            cursor = await db.execute(
+                f"SELECT natal_hash FROM natal_charts WHERE natal_hash IN ({', '.join('?' * len(chunk))})",
+                chunk
+            )
+            existing.update(row[0] for row in await cursor.fetchall())
+    return existing
+
+async def _compute_missing(inputs_by_hash: dict) -> set:
+    """Считает карты, которых нет в natal_charts, и пишет их одной транзакцией; возвращает хэши доступных карт."""
+    existing = await _existing_hashes(inputs_by_hash)
+    missing = [h for h in inputs_by_hash if h not in existing]
+    if not missing:
+        return existing
+
+    loop = asyncio.get_running_loop()
+    executor = _get_executor()
+    results = await asyncio.gather(
+        *(loop.run_in_executor(executor, compute_natal_chart, inputs_by_hash[h]) for h in missing),
+        return_exceptions=True
+    )
+    rows = []
+    computed_at = datetime.now()
+    for h, result in zip(missing, results):
+        if isinstance(result, Exception):
+            logger.error("Ошибка расчета натальной карты %s: %s", inputs_by_hash[h], result)
+        else:
+            rows.append((h, *result, computed_at))
+    if rows:
+        async with users_pool.writer() as db:
+            await db.executemany(
+                """INSERT OR IGNORE INTO natal_charts (natal_hash, signs, lons, asc_sign, asc_lon, computed_at)
+                   VALUES (?, ?, ?, ?, ?, ?)""",
+                rows
+            )
+    return existing | {row[0] for row in rows}
+
+async def _apply_natal_hashes(users) -> int:
+    """Обновляет natal_hash пользователей по их данным рождения; возвращает число измененных."""
+    new_hashes = {}
+    inputs_by_hash = {}
+    for user in users:
+        inputs = natal_inputs(user)
+        new_hash = natal_hash(inputs) if inputs else None
+        if new_hash != user.get('natal_hash'):
+            new_hashes[user['user_id']] = new_hash
+            if new_hash:
+                inputs_by_hash[new_hash] = inputs
+
+    available = await _compute_missing(inputs_by_hash) if inputs_by_hash else set()
+    updated = 0
+    for user_id, new_hash in new_hashes.items():
+        # Если карту не удалось посчитать, оставляем прежний хэш: следующий прогон попробует снова
+        if new_hash is None or new_hash in available:
+            await save_user_data(user_id, natal_hash=new_hash)
+            updated += 1
+    return updated
+
+async def update_natal_charts(user_ids) -> int:
+    """Пересчитывает карты указанных пользователей (с учетом еще не записанных обновлений)."""
+    users = [user for user in [await get_user_data(user_id) for user_id in user_ids] if user]
+    return await _apply_natal_hashes(users)
+
+# --- ПЕРЕСЧЕТ ПРИ ИЗМЕНЕНИИ ДАННЫХ РОЖДЕНИЯ ---
+_dirty_users = set()
+_update_task = None
+
+async def _update_loop():
+    global _dirty_users
+    while _dirty_users:
+        await asyncio.sleep(NATAL_UPDATE_DELAY)
+        batch, _dirty_users = _dirty_users, set()
+        try:
+            await update_natal_charts(batch)
+        except Exception as e:
+            logger.error("Ошибка пересчета натальных карт: %s", e, exc_info=True)
+
+def _on_user_update(user_id: int, updates: dict):
+    global _update_task
+    if BIRTH_FIELDS.isdisjoint(updates):
+        return
+    _dirty_users.add(user_id)
+    if _update_task is None or _update_task.done():
+        _update_task = asyncio.create_task(_update_loop())
+
+add_user_update_listener(_on_user_update)
+
+# --- ЧТЕНИЕ КАРТ ---
+_chart_cache = OrderedDict()   # natal_hash -> NatalChart
+_chart_hits = 0
+_chart_misses = 0
+
+async def get_natal_chart_by_hash(chart_hash: str):
+    global _chart_hits, _chart_misses
+    chart = _chart_cache.get(chart_hash)
+    if chart:
+        _chart_cache.move_to_end(chart_hash)
+        _chart_hits += 1
+        return chart
+    _chart_misses += 1
+    async with users_pool.reader() as db:
+        cursor = await db.execute("SELECT * FROM natal_charts WHERE natal_hash = ?", (chart_hash,))
+        row = await cursor.fetchone()
+    if not row:
+        return None
+    chart = NatalChart.from_row(row)
+    _chart_cache[chart_hash] = chart
+    if len(_chart_cache) > NATAL_CACHE_SIZE:
+        _chart_cache.popitem(last=False)
+    return chart
+
+async def get_natal_chart(user_id: int):
+    """Натальная карта пользователя или None, если данных рождения нет или карта еще не посчитана."""
+    user = await get_user_data(user_id)
+    if not user or not user.get('natal_hash'):
+        return None
+    return await get_natal_chart_by_hash(user['natal_hash'])
+
+def get_natal_cache_stats():
+    return {"hits": _chart_hits, "misses": _chart_misses, "size": len(_chart_cache)}
+
+# --- ПАКЕТНЫЙ ПРОГОН ---
+async def backfill_natal_charts(batch_size: int = NATAL_BATCH_SIZE):
+    """Досчитывает карты всем пользователям с данными рождения, у которых natal_hash отсутствует или устарел."""
+    started = time.perf_counter()
+    last_user_id = 0
+    scanned = updated = 0
+    while True:
+        async with users_pool.reader() as db:
+            cursor = await db.execute(
+                """SELECT * FROM users
+                   WHERE user_id > ? AND (birth_date IS NOT NULL OR natal_hash IS NOT NULL)
+                   ORDER BY user_id LIMIT ?""",
+                (last_user_id, batch_size)
+            )
+            users = [dict(row) for row in await cursor.fetchall()]
+        if not users:
+            break
+        last_user_id = users[-1]['user_id']
+        scanned += len(users)
+        updated += await _apply_natal_hashes(users)
+        logger.info("Натальные карты: проверено %s, обновлено %s", scanned, updated)
+    logger.info("Пакетный прогон натальных карт завершен за %.1f с: проверено %s, обновлено %s.",
+                time.perf_counter() - started, scanned, updated)
+    return updated
+
+async def _main(args):
+    try:
+        await init_user_db()
+        await init_natal_db()
+        if args.backfill:
+            await backfill_natal_charts(args.batch_size)
+    finally:
+        await flush_user_updates()
+        shutdown_natal_executor()
+        await close_all_pools()
+
+if __name__ == "__main__":
+    setup_logging()
+    parser = argparse.ArgumentParser(description="Натальные карты пользователей.")
+    parser.add_argument('--backfill', action='store_true', help="досчитать карты существующим пользователям")
+    parser.add_argument('--batch-size', type=int, default=NATAL_BATCH_SIZE)
+    asyncio.run(_main(parser.parse_args()))
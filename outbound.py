@@ -0,0 +1,217 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter, ExtBot
+from telegram.request import HTTPXRequest
+from config import BOT_TOKEN, TELEGRAM_API_URL, TELEGRAM_GLOBAL_RATE
+
+logger = logging.getLogger(__name__)
+
+# --- ЕДИНЫЙ СЛОЙ ИСХОДЯЩИХ ЗАПРОСОВ К TELEGRAM ---
+# Все отправки процесса (ответы бота, ежедневная рассылка, массовые рассылки)
+# идут через один ExtBot с общим пулом HTTP-соединений и общим ограничителем.
+# Приоритет передается через rate_limit_args={'priority': ...}; по умолчанию — интерактивный.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_SCHEDULED = 1
+PRIORITY_BROADCAST = 2
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_SCHEDULED: "scheduled", PRIORITY_BROADCAST: "broadcast"}
+
+PER_CHAT_RATE = 1.0          # сообщений в секунду в один личный чат...
+PER_CHAT_BURST = 3           # ...с запасом на короткую серию (ответ + меню)
+GROUP_CHAT_RATE = 20 / 60    # в группы Telegram разрешает ~20 сообщений в минуту
+MAX_RETRIES = 2
+# Запросов к Bot API одновременно (кроме долгого опроса getUpdates). Лишние ждут
+# на семафоре, а не в очереди пула httpcore: тот при каждом запросе перебирает все
+# ожидающие запросы по всем соединениям, и под нагрузкой это занимало больше
+# трети процессора бота. Значение — с запасом над SLOT_SEND_CONCURRENCY планировщика;
+# при задержке Bot API 30 мс это ~800 запросов в секунду.
+MAX_IN_FLIGHT = 24
+CONNECTION_POOL_SIZE = MAX_IN_FLIGHT   # больше соединений семафор все равно не пропустит
+CHAT_STATE_LIMIT = 100_000   # после этого размера забываем давно неактивные чаты
+
+# Эти методы не отправляют сообщений и не расходуют общий лимит
+UNLIMITED_ENDPOINTS = {
+    'getMe', 'getUpdates', 'setWebhook', 'deleteWebhook', 'getWebhookInfo',
+    'setMyCommands', 'answerCallbackQuery', 'close', 'logOut',
+}
+
+class TokenBucket:
+    """Ограничитель скорости: rate токенов в секунду, запас не больше capacity."""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+
+    def pause(self, seconds: float):
+        """Останавливает выдачу токенов (например, после RetryAfter)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class PriorityRateLimiter(BaseRateLimiter[dict]):
+    """
+    Ограничитель для ExtBot: общий бюджет сообщений в секунду,
+    лимит на каждый чат и очередь с приоритетами
+    (интерактивные ответы → ежедневная рассылка → массовые рассылки).
+    """
+
+    def __init__(self, rate: float = TELEGRAM_GLOBAL_RATE):
+        self._bucket = TokenBucket(rate)
+        self._heap = []              # (priority, seq, future)
+        self._seq = itertools.count()
+        self._has_waiters = None
+        self._dispatcher = None
+        self._chats = {}             # chat_id -> (tokens, updated_at)
+        self._in_flight = asyncio.Semaphore(MAX_IN_FLIGHT)
+        self.queue_depth = {p: 0 for p in PRIORITY_NAMES}
+        self.sent = {p: 0 for p in PRIORITY_NAMES}
+        self.retries = 0
+        self._latency = {p: [0, 0.0, 0.0] for p in PRIORITY_NAMES}  # count, total, max
+
+    @property
+    def rate(self) -> float:
+        return self._bucket.rate
+
+    @rate.setter
+    def rate(self, value: float):
+        self._bucket.rate = value
+        self._bucket.capacity = value
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+
+    async def _dispatch(self):
+        while True:
+            await self._has_waiters.wait()
+            await self._bucket.acquire()
+            while self._heap:
+                priority, _, future = heapq.heappop(self._heap)
+                self.queue_depth[priority] -= 1
+                if not future.done():
+                    future.set_result(None)
+                    break
+            if not self._heap:
+                self._has_waiters.clear()
+
+    async def _acquire_global(self, priority: int):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._has_waiters = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (priority, next(self._seq), future))
+        self.queue_depth[priority] += 1
+        self._has_waiters.set()
+        await future
+
+    async def _acquire_chat(self, chat_id):
+        """Токен-бакет на чат; состояние хранится кортежем, чтобы не держать объект на каждого пользователя."""
+        is_group = isinstance(chat_id, int) and chat_id < 0
+        rate = GROUP_CHAT_RATE if is_group else PER_CHAT_RATE
+        burst = 1 if is_group else PER_CHAT_BURST
+        now = time.monotonic()
+        tokens, updated_at = self._chats.get(chat_id, (burst, now))
+        tokens = min(burst, tokens + (now - updated_at) * rate) - 1
+        self._chats[chat_id] = (tokens, now)
+        if tokens < 0:
+            await asyncio.sleep(-tokens / rate)
+        if len(self._chats) > CHAT_STATE_LIMIT:
+            self._forget_idle_chats(now)
+
+    def _forget_idle_chats(self, now: float):
+        idle_after = PER_CHAT_BURST / PER_CHAT_RATE
+        self._chats = {
+            chat_id: state for chat_id, state in self._chats.items()
+            if now - state[1] < idle_after
+        }
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = (rate_limit_args or {}).get('priority', PRIORITY_INTERACTIVE)
+        chat_id = data.get('chat_id')
+        started = time.perf_counter()
+        for attempt in range(MAX_RETRIES + 1):
+            if endpoint not in UNLIMITED_ENDPOINTS:
+                if chat_id is not None:
+                    await self._acquire_chat(chat_id)
+                await self._acquire_global(priority)
+            try:
+                if endpoint == 'getUpdates':
+                    # Долгий опрос идет отдельным соединением и не должен занимать место
+                    result = await callback(*args, **kwargs)
+                else:
+                    async with self._in_flight:
+                        result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                # Telegram сам сообщил, что лимит превышен: останавливаем все отправки
+                logger.warning("RetryAfter %s с на %s (попытка %s).", e.retry_after, endpoint, attempt + 1)
+                self._bucket.pause(e.retry_after)
+                self.retries += 1
+                if attempt == MAX_RETRIES:
+                    raise
+                continue
+            self._record(priority, time.perf_counter() - started)
+            return result
+
+    def _record(self, priority: int, seconds: float):
+        self.sent[priority] += 1
+        latency = self._latency[priority]
+        latency[0] += 1
+        latency[1] += seconds
+        latency[2] = max(latency[2], seconds)
+
+    def stats(self):
+        """Глубина очереди и задержка отправки (от вызова до ответа Telegram) по классам приоритета."""
+        return {
+            "rate": self.rate,
+            "retries": self.retries,
+            "tracked_chats": len(self._chats),
+            **{
+                name: {
+                    "queue_depth": self.queue_depth[p],
+                    "sent": self.sent[p],
+                    "avg_latency_ms": round(self._latency[p][1] / self._latency[p][0] * 1000, 3) if self._latency[p][0] else 0.0,
+                    "max_latency_ms": round(self._latency[p][2] * 1000, 3),
+                }
+                for p, name in PRIORITY_NAMES.items()
+            },
+        }
+
+rate_limiter = PriorityRateLimiter()
+_bot = None
+
+def get_bot() -> ExtBot:
+    """Общий для процесса бот: один пул HTTP-соединений и один ограничитель."""
+    global _bot
+    if _bot is None:
+        _bot = ExtBot(
+            token=BOT_TOKEN,
+            base_url=TELEGRAM_API_URL,
+            request=HTTPXRequest(connection_pool_size=CONNECTION_POOL_SIZE, pool_timeout=10.0),
+            rate_limiter=rate_limiter,
+        )
+    return _bot
+
+def get_outbound_stats():
+    return rate_limiter.stats()
@@ -0,0 +1,126 @@
+import asyncio
+import gzip
+import logging
+import os
+import time
+from datetime import date, datetime, timedelta, timezone
+from db_pool import horoscopes_pool
+
+logger = logging.getLogger(__name__)
+
+# --- АРХИВ ЗАГРУЖЕННЫХ СТРАНИЦ ---
+# Страницы хранятся сжатыми по хэшу содержимого (objects/ab/abcdef….html.gz),
+# поэтому одинаковые месячные и годовые страницы занимают место один раз.
+# Таблица page_archive связывает (тип, знак, дата загрузки) с хэшем.
+ARCHIVE_DIR = os.path.join('data', 'archive')
+ARCHIVE_KEEP_DAYS = 90
+# Файл записывается (store_page) раньше, чем ссылка на него попадает в индекс,
+# поэтому очистка не трогает файлы моложе этого срока: их может ждать
+# незавершенная транзакция парсера.
+ARCHIVE_PRUNE_GRACE = 6 * 3600   # секунд
+
+async def init_archive_db():
+    async with horoscopes_pool.writer() as db:
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS page_archive (
+                type TEXT,
+                sign_id INTEGER,
+                fetch_date DATE,
+                fetched_at TEXT, -- ISO-время загрузки в UTC, нужно правилам даты при воспроизведении
+                content_hash TEXT,
+                PRIMARY KEY (type, sign_id, fetch_date)
+            )
+        ''')
+        await db.execute('CREATE INDEX IF NOT EXISTS idx_page_archive_hash ON page_archive (content_hash)')
+
+def _object_path(content_hash: str) -> str:
+    return os.path.join(ARCHIVE_DIR, 'objects', content_hash[:2], f"{content_hash}.html.gz")
+
+def _write_object(content_hash: str, text: str):
+    path = _object_path(content_hash)
+    if os.path.exists(path):
+        # Повторное использование файла продлевает ему срок защиты от очистки
+        try:
+            os.utime(path)
+            return
+        except FileNotFoundError:
+            pass   # файл удалила очистка между проверкой и utime — запишем заново
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+def _read_object(content_hash: str) -> str:
+    with gzip.open(_object_path(content_hash), 'rt', encoding='utf-8') as f:
+        return f.read()
+
+async def store_page(content_hash: str, text: str):
+    """Записывает файл страницы; вызывать до транзакции, чтобы не держать блокировку записи на диск."""
+    await asyncio.to_thread(_write_object, content_hash, text)
+
+async def archive_page(db, horoscope_type: str, sign_id: int, fetched_at: datetime, content_hash: str, text: str = None):
+    """
+    Сохраняет страницу в архив. text можно не передавать, если файл страницы
+    уже записан (store_page). Индекс пишется в транзакции соединения db.
+    """
+    if text is not None:
+        await store_page(content_hash, text)
+    fetched_at = fetched_at.astimezone(timezone.utc)
+    await db.execute(
+        """INSERT OR REPLACE INTO page_archive (type, sign_id, fetch_date, fetched_at, content_hash)
+           VALUES (?, ?, ?, ?, ?)""",
+        (horoscope_type, sign_id, fetched_at.date(), fetched_at.isoformat(), content_hash)
+    )
+
+async def load_archived_pages(horoscope_type: str, fetch_date: date):
+    """Возвращает [(sign_id, fetched_at, text)] за дату загрузки (UTC)."""
+    async with horoscopes_pool.reader() as db:
+        cursor = await db.execute(
+            "SELECT sign_id, fetched_at, content_hash FROM page_archive WHERE type = ? AND fetch_date = ?",
+            (horoscope_type, fetch_date)
+        )
+        rows = await cursor.fetchall()
+
+    pages = []
+    for row in rows:
+        try:
+            text = await asyncio.to_thread(_read_object, row['content_hash'])
+        except FileNotFoundError:
+            logger.warning("В архиве нет файла страницы %s/%s за %s", horoscope_type, row['sign_id'], fetch_date)
+            continue
+        pages.append((row['sign_id'], datetime.fromisoformat(row['fetched_at']), text))
+    return pages
+
+def _remove_unreferenced(referenced: set, older_than: float) -> int:
+    removed = 0
+    objects_dir = os.path.join(ARCHIVE_DIR, 'objects')
+    for root, _, files in os.walk(objects_dir):
+        for name in files:
+            if name.split('.', 1)[0] in referenced:
+                continue
+            path = os.path.join(root, name)
+            try:
+                if os.path.getmtime(path) >= older_than:
+                    continue
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            removed += 1
+    return removed
+
+async def prune_archive(keep_days: int = ARCHIVE_KEEP_DAYS):
+    """
+    Удаляет записи архива старше keep_days дней и файлы, на которые больше никто
+    не ссылается и которые не менялись дольше ARCHIVE_PRUNE_GRACE.
+    """
+    cutoff = datetime.now(timezone.utc).date() - timedelta(days=keep_days)
+    # Срок отсчитывается до чтения индекса: файл, записанный после этого момента, не удаляется
+    older_than = time.time() - ARCHIVE_PRUNE_GRACE
+    async with horoscopes_pool.writer() as db:
+        cursor = await db.execute("DELETE FROM page_archive WHERE fetch_date < ?", (cutoff,))
+        deleted = cursor.rowcount
+        cursor = await db.execute("SELECT DISTINCT content_hash FROM page_archive")
+        referenced = {row[0] for row in await cursor.fetchall()}
+    removed = await asyncio.to_thread(_remove_unreferenced, referenced, older_than)
+    logger.info("Архив очищен: удалено записей %s, файлов %s (хранение %s дн.)", deleted, removed, keep_days)
@@ -0,0 +1,298 @@
+import argparse
+import asyncio
+import logging
+import os
+import time
+from collections import Counter, namedtuple
+from datetime import date, datetime, timedelta, timezone
+import pytz
+import aiohttp
+from crawl_control import CrawlController, MAX_CONCURRENCY
+from constants import DAILY_BASE_URL, WEEKLY_BASE_URL, MONTHLY_BASE_URL, YEARLY_BASE_URL, ZODIAC_MAP
+from db_pool import horoscopes_pool, close_all_pools
+from horoscope_fetcher import invalidate_horoscope_cache
+from page_archive import init_archive_db, store_page, archive_page, load_archived_pages, prune_archive, ARCHIVE_KEEP_DAYS
+from parser_utils import (
+    setup_parser_logger, init_horoscope_db, fetch_page, Throttled, extract_horoscope_async, shutdown_parse_executor, content_hash,
+    insert_horoscopes, load_fetch_state, save_fetch_states, get_stored_sign_ids
+)
+
+# Обработчики логов ставятся только при запуске скрипта: рабочие процессы пула
+# разбора (spawn) импортируют этот модуль как __mp_main__
+logger = logging.getLogger('ParserRunner')
+
+# --- ЕДИНЫЙ ЗАПУСК ПАРСЕРОВ ---
+# Все типы гороскопов парсятся в одном процессе: одна HTTP-сессия с keep-alive,
+# один адаптивный ограничитель скорости к сайту (crawl_control) и одна транзакция БД
+# на весь запуск, чтобы бот не увидел наполовину обновленный день. Тип, у
+# которого не загрузился хотя бы один знак, в этом запуске не обновляется.
+# С --archive загруженные страницы сохраняются в page_archive, а --replay
+# разбирает их заново без сети (например, после исправления селекторов).
+
+# Правила даты получают момент загрузки (aware datetime) и возвращают дату гороскопа
+def _daily_date(fetched_at: datetime) -> date:
+    # Сайт публикует гороскоп на "завтра" по московскому времени
+    return fetched_at.astimezone(pytz.timezone('Europe/Moscow')).date() + timedelta(days=1)
+
+def _weekly_date(fetched_at: datetime) -> date:
+    today = fetched_at.astimezone().date()
+    return today - timedelta(days=today.weekday())
+
+def _monthly_date(fetched_at: datetime) -> date:
+    today = fetched_at.astimezone().date()
+    return date(today.year, today.month, 1)
+
+def _yearly_date(fetched_at: datetime) -> date:
+    today = fetched_at.astimezone().date()
+    return date(today.year, 1, 1)
+
+ParserSpec = namedtuple('ParserSpec', ['type', 'base_url', 'date_rule', 'label'])
+
+PARSER_SPECS = {
+    spec.type: spec for spec in [
+        ParserSpec('daily', DAILY_BASE_URL, _daily_date, 'ежедневных'),
+        ParserSpec('weekly', WEEKLY_BASE_URL, _weekly_date, 'еженедельных'),
+        ParserSpec('monthly', MONTHLY_BASE_URL, _monthly_date, 'ежемесячных'),
+        ParserSpec('yearly', YEARLY_BASE_URL, _yearly_date, 'годовых'),
+    ]
+}
+
+CONNECTION_LIMIT = MAX_CONCURRENCY
+FETCH_RETRIES = 2            # повторы знака после 429 или сетевой ошибки; паузу перед повтором задает контроллер
+
+# text и page_hash есть у каждой загруженной страницы, в том числе у той, которую
+# не удалось разобрать: такие страницы тоже попадают в архив для --replay
+SignResult = namedtuple('SignResult', ['outcome', 'sign_id', 'data', 'state', 'text', 'page_hash'])
+
+async def _fetch_sign(spec: ParserSpec, session, controller: CrawlController, sign_name: str, sign_id: int, fetch_state):
+    """
+    Загружает страницу через контроллер скорости. После 429 и сетевых ошибок
+    повторяет запрос в новом месте контроллера: каждая попытка учитывается им
+    и замедляет обход, а пауза перед повтором не занимает место.
+    """
+    for attempt in range(FETCH_RETRIES + 1):
+        async with controller.slot():
+            logger.info("[%s] Начинаю парсинг для знака: %s", spec.type, sign_name)
+            started = time.monotonic()
+            try:
+                result = await fetch_page(sign_id, spec.base_url, session, fetch_state)
+            except Throttled as e:
+                controller.record_throttled(e.retry_after)
+                logger.warning("[%s] %s: сайт ограничил запросы (%s), попытка %s", spec.type, sign_name, e, attempt + 1)
+                if attempt == FETCH_RETRIES:
+                    raise
+                continue
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                controller.record_error(time.monotonic() - started)
+                logger.warning("[%s] %s: ошибка запроса (%s), попытка %s", spec.type, sign_name, e, attempt + 1)
+                if attempt == FETCH_RETRIES:
+                    raise
+                continue
+            except Exception:
+                controller.record_error(time.monotonic() - started)
+                raise
+            controller.record_success(time.monotonic() - started)
+            return result
+
+async def _parse_sign(spec: ParserSpec, session, controller: CrawlController, sign_name: str, sign_id: int, fetch_state, is_stored: bool):
+    """
+    Загружает и разбирает страницу знака. Исходы: 'fetched' — страница загружена
+    и разобрана, 'not_modified' — сервер ответил 304, 'skipped' — содержимое
+    совпало с прошлой загрузкой, 'failed' — ошибка.
+    """
+    # Условный запрос допустим, только если гороскоп на текущую дату уже есть в БД:
+    # иначе нам нужен текст страницы, даже если он не менялся
+    fetch_state = fetch_state if is_stored else None
+    try:
+        status, text, etag, last_modified = await _fetch_sign(spec, session, controller, sign_name, sign_id, fetch_state)
+        if status == 304:
+            return SignResult('not_modified', sign_id, None, None, None, None)
+
+        page_hash = content_hash(text)
+        new_state = (etag, last_modified, page_hash)
+        if fetch_state and fetch_state['content_hash'] == page_hash:
+            return SignResult('skipped', sign_id, None, new_state, text, page_hash)
+
+        data = await extract_horoscope_async(text)
+        if data and data.get('general_text'):
+            return SignResult('fetched', sign_id, data, new_state, text, page_hash)
+        # Состояние загрузки не сохраняем, чтобы следующий запуск снова загрузил и разобрал страницу
+        logger.warning("[%s] Не удалось получить данные для %s", spec.type, sign_name)
+        return SignResult('failed', sign_id, None, None, text, page_hash)
+    except Exception as e:
+        logger.error("[%s] Ошибка при парсинге %s: %s", spec.type, sign_name, e, exc_info=True)
+    return SignResult('failed', sign_id, None, None, None, None)
+
+# Результат парсинга одного типа; запись в БД — одна на весь запуск
+ParserRun = namedtuple('ParserRun', ['spec', 'fetched_at', 'horoscope_date', 'results', 'counts'])
+
+async def run_parser(spec: ParserSpec, session, controller: CrawlController):
+    """Загружает и разбирает все знаки одного типа, ничего не записывая в БД."""
+    logger.info("Запуск парсинга %s гороскопов", spec.label)
+    fetched_at = datetime.now(timezone.utc)
+    horoscope_date = spec.date_rule(fetched_at)
+    fetch_states = await load_fetch_state(spec.type)
+    stored_ids = await get_stored_sign_ids(spec.type, horoscope_date)
+
+    results = await asyncio.gather(*(
+        _parse_sign(spec, session, controller, name, sign_id, fetch_states.get(sign_id), sign_id in stored_ids)
+        for name, sign_id in ZODIAC_MAP.items()
+    ))
+    counts = Counter(result.outcome for result in results)
+    logger.info(
+        "Парсинг %s гороскопов завершен (%s): загружено %s, "
+        "не изменилось (304) %s, пропущено (тот же контент) %s, ошибок %s",
+        spec.label, horoscope_date, counts['fetched'], counts['not_modified'], counts['skipped'], counts['failed']
+    )
+    return ParserRun(spec, fetched_at, horoscope_date, results, counts)
+
+async def _write_runs(runs, archive: bool):
+    """
+    Записывает результаты всех типов одной транзакцией: бот видит либо прежние
+    гороскопы, либо все новые сразу, но не смесь вчерашних и сегодняшних знаков.
+    Тип, у которого хотя бы один знак не загружен, не записывается вовсе (кроме
+    архива страниц): пусть лучше весь тип останется на прошлой дате.
+    """
+    horoscope_rows, state_rows, archive_rows = [], [], []
+    for run in runs:
+        complete = not run.counts['failed']
+        if not complete:
+            logger.error(
+                "[%s] Не загружено знаков: %s из %s — гороскопы на %s не записаны, остаются прежние",
+                run.spec.type, run.counts['failed'], len(run.results), run.horoscope_date
+            )
+        for result in run.results:
+            if complete and result.outcome == 'fetched':
+                horoscope_rows.append((result.sign_id, run.spec.type, run.horoscope_date, result.data))
+            if complete and result.state:
+                etag, last_modified, page_hash = result.state
+                state_rows.append((run.spec.type, result.sign_id, etag, last_modified, page_hash))
+            # В архив — и страницы, которые не удалось разобрать: их и нужно переразбирать после правки селекторов
+            if archive and result.text is not None:
+                # Файлы страниц пишем до транзакции, в ней остается только индекс
+                await store_page(result.page_hash, result.text)
+                archive_rows.append((run.spec.type, result.sign_id, run.fetched_at, result.page_hash))
+    if not (horoscope_rows or state_rows or archive_rows):
+        return
+
+    started = time.perf_counter()
+    async with horoscopes_pool.writer() as db:
+        written = await insert_horoscopes(horoscope_rows, db=db)
+        await save_fetch_states(db, state_rows)
+        for row in archive_rows:
+            await archive_page(db, *row)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if written:
+        invalidate_horoscope_cache()
+    logger.info(
+        "Записано гороскопов: %s, состояний загрузки: %s, в архив: %s — одна транзакция, %.1f мс",
+        written, len(state_rows), len(archive_rows), elapsed_ms
+    )
+
+async def replay_parser(spec: ParserSpec, fetch_date):
+    """
+    Повторно разбирает страницы типа из архива за дату загрузки; возвращает
+    ParserRun для _write_runs или None, если страниц нет. Знак без страницы или
+    с неразобранной страницей считается 'failed', как при обычном запуске.
+    """
+    pages = await load_archived_pages(spec.type, fetch_date)
+    if not pages:
+        logger.warning("[%s] В архиве нет страниц за %s", spec.type, fetch_date)
+        return None
+    fetched_at = max(page_fetched_at for _, page_fetched_at, _ in pages)
+    horoscope_date = spec.date_rule(fetched_at)
+    texts = {}
+    for sign_id, page_fetched_at, text in pages:
+        # Страницы разных запусков одного дня могут относиться к разным датам гороскопа
+        if spec.date_rule(page_fetched_at) == horoscope_date:
+            texts[sign_id] = text
+        else:
+            logger.warning("[%s] Архивная страница знака %s относится к другой дате гороскопа", spec.type, sign_id)
+
+    results = []
+    for sign_id in ZODIAC_MAP.values():
+        text = texts.get(sign_id)
+        data = await extract_horoscope_async(text) if text is not None else None
+        if data and data.get('general_text'):
+            results.append(SignResult('fetched', sign_id, data, None, None, None))
+        else:
+            if text is not None:
+                logger.warning("[%s] В архивной странице знака %s не найден гороскоп", spec.type, sign_id)
+            results.append(SignResult('failed', sign_id, None, None, None, None))
+    counts = Counter(result.outcome for result in results)
+    logger.info(
+        "Воспроизведение %s гороскопов за %s (%s): страниц %s, разобрано %s",
+        spec.label, fetch_date, horoscope_date, len(pages), counts['fetched']
+    )
+    return ParserRun(spec, fetched_at, horoscope_date, results, counts)
+
+async def _replay(specs, fetch_date):
+    """Записывает разобранный архив по тем же правилам, что и обычный запуск: тип — только целиком."""
+    runs = [run for run in [await replay_parser(spec, fetch_date) for spec in specs] if run]
+    await _write_runs(runs, archive=False)
+
+async def run_parsers(types, archive: bool = False, replay_date=None, archive_keep_days: int = ARCHIVE_KEEP_DAYS):
+    """
+    Парсит указанные типы гороскопов ('daily', 'weekly', 'monthly', 'yearly') в одном цикле событий.
+    archive — сохранять загруженные страницы в архив; replay_date — вместо загрузки
+    разобрать страницы из архива за эту дату загрузки (UTC).
+    """
+    specs = [PARSER_SPECS[t] for t in types]
+    if not os.path.exists('data'):
+        os.makedirs('data')
+    try:
+        await init_horoscope_db()
+        await init_archive_db()
+
+        if replay_date:
+            await _replay(specs, replay_date)
+            return
+
+        # Один контроллер скорости на все типы: запросы идут к одному сайту
+        controller = CrawlController()
+        connector = aiohttp.TCPConnector(limit=CONNECTION_LIMIT, keepalive_timeout=60)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            runs = await asyncio.gather(*(run_parser(spec, session, controller) for spec in specs))
+        await _write_runs(runs, archive)
+        total = sum((run.counts for run in runs), Counter())
+        crawl = controller.stats()
+        logger.info(
+            "Итог: загружено %s, не изменилось %s, пропущено %s, ошибок %s",
+            total['fetched'], total['not_modified'], total['skipped'], total['failed']
+        )
+        logger.info(
+            "Скорость обхода: %s запросов за %s с (%s запр./с), средний ответ %s мс, "
+            "ошибок %s, 429 %s; итоговые потоки %s, интервал %s с",
+            crawl['requests'], crawl['elapsed_s'], crawl['rate_per_s'], crawl['avg_latency_ms'],
+            crawl['errors'], crawl['throttled'], crawl['concurrency'], crawl['delay_s']
+        )
+        if archive:
+            await prune_archive(archive_keep_days)
+    finally:
+        shutdown_parse_executor()
+        await close_all_pools()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Парсинг гороскопов с globalmsk.ru.")
+    parser.add_argument('types', nargs='*', metavar='TYPE',
+                        help=f"типы гороскопов: {', '.join(PARSER_SPECS)} или all (по умолчанию)")
+    parser.add_argument('--archive', action='store_true', help="сохранять загруженные страницы в архив")
+    parser.add_argument('--archive-keep-days', type=int, default=ARCHIVE_KEEP_DAYS, metavar='DAYS',
+                        help="сколько дней хранить архив")
+    parser.add_argument('--replay', type=date.fromisoformat, metavar='YYYY-MM-DD',
+                        help="разобрать страницы из архива за дату загрузки (UTC) без обращения к сайту")
+    args = parser.parse_args()
+    unknown = set(args.types) - {*PARSER_SPECS, 'all'}
+    if unknown:
+        parser.error(f"неизвестные типы: {', '.join(sorted(unknown))}")
+    if not args.types or 'all' in args.types:
+        args.types = list(PARSER_SPECS)
+    else:
+        args.types = list(dict.fromkeys(args.types))
+    return args
+
+if __name__ == "__main__":
+    setup_parser_logger('ParserRunner')
+    args = parse_args()
+    asyncio.run(run_parsers(args.types, archive=args.archive, replay_date=args.replay,
+                            archive_keep_days=args.archive_keep_days))
@@ -1,12 +1,18 @@
-import aiosqlite
+import asyncio
+import hashlib
 import logging
-import os
-from logging.handlers import TimedRotatingFileHandler
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 import aiohttp
 import random
-from bs4 import BeautifulSoup
-from constants import DB_HOROSCOPES, GENERAL_BLOCK_CLASS, SUB_CONTAINER_CLASS, BUSINESS_BLOCK_CLASS, RATE_BLOCK_CLASS, HOROSCOPE_ITEMS_CLASS
+from horoscope_extract import extract_horoscope
+from horoscope_fetcher import invalidate_horoscope_cache
+from db_pool import horoscopes_pool
+from transits import init_transits_db
+from logging_setup import setup_logging
 
 # ИСПРАВЛЕНИЕ: Расширенный список USER_AGENTS
 USER_AGENTS = [
@@ -17,28 +23,15 @@ USER_AGENTS = [
     'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Edge/91.0.864.59'
 ]
 
-def setup_parser_logger(name: str):
-    logger = logging.getLogger(name)
-    if not logger.handlers:
-        logger.setLevel(logging.INFO)
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-
-        # Указываем путь и создаем папку, если ее нет
-        log_dir = 'logs'
-        os.makedirs(log_dir, exist_ok=True)
-        log_file_path = os.path.join(log_dir, 'parsers.log')
+PARSER_LOG_FILE = 'parsers.log'
 
-        fh = TimedRotatingFileHandler(log_file_path, when='midnight', backupCount=7)
-        fh.setFormatter(formatter)
-        logger.addHandler(fh)
-
-        ch = logging.StreamHandler()
-        ch.setFormatter(formatter)
-        logger.addHandler(ch)
-    return logger
+def setup_parser_logger(name: str):
+    """Логгер парсеров: консоль и logs/parsers.log через общую очередь логирования процесса."""
+    setup_logging(log_file=PARSER_LOG_FILE)
+    return logging.getLogger(name)
 
 async def init_horoscope_db():
-    async with aiosqlite.connect(DB_HOROSCOPES) as db:
+    async with horoscopes_pool.writer() as db:
         await db.execute('''
             CREATE TABLE IF NOT EXISTS horoscopes (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -57,98 +50,160 @@ async def init_horoscope_db():
             ON horoscopes (sign_id, type, date)
         ''')
         
-        # --- НОВАЯ ТАБЛИЦА ДЛЯ КЭША ТРАНЗИТОВ ---
+
+        # Валидаторы последней загрузки каждой страницы для условных запросов
         await db.execute('''
-            CREATE TABLE IF NOT EXISTS transits_cache (
-                transit_date DATE PRIMARY KEY,
-                planet_data TEXT
+            CREATE TABLE IF NOT EXISTS fetch_state (
+                type TEXT,
+                sign_id INTEGER,
+                etag TEXT,
+                last_modified TEXT,
+                content_hash TEXT,
+                fetched_at TIMESTAMP,
+                PRIMARY KEY (type, sign_id)
             )
         ''')
-        # --- КОНЕЦ НОВОГО КОДА ---
-        
-        await db.commit()
+    await init_transits_db()
 
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=30), retry=retry_if_exception_type(aiohttp.ClientError))
-async def parse_horoscope(sign_id: int, base_url: str, session: aiohttp.ClientSession):
+async def load_fetch_state(horoscope_type: str):
+    """Возвращает {sign_id: строка fetch_state} для типа гороскопа."""
+    async with horoscopes_pool.reader() as db:
+        cursor = await db.execute("SELECT * FROM fetch_state WHERE type = ?", (horoscope_type,))
+        return {row['sign_id']: dict(row) for row in await cursor.fetchall()}
+
+async def save_fetch_states(db, rows):
+    """rows — итерируемое из (type, sign_id, etag, last_modified, content_hash); пишет в транзакции db."""
+    fetched_at = datetime.now()
+    await db.executemany(
+        """INSERT OR REPLACE INTO fetch_state
+           (type, sign_id, etag, last_modified, content_hash, fetched_at)
+           VALUES (?, ?, ?, ?, ?, ?)""",
+        [(*row, fetched_at) for row in rows]
+    )
+
+async def get_stored_sign_ids(horoscope_type: str, horoscope_date):
+    """ID знаков, для которых гороскоп на дату уже сохранен."""
+    async with horoscopes_pool.reader() as db:
+        cursor = await db.execute(
+            "SELECT sign_id FROM horoscopes WHERE type = ? AND date = ?",
+            (horoscope_type, horoscope_date)
+        )
+        return {row[0] for row in await cursor.fetchall()}
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+class Throttled(Exception):
+    """Сайт попросил снизить частоту запросов (429 или 503 с Retry-After)."""
+
+    def __init__(self, status: int, retry_after: float = None):
+        super().__init__(f"HTTP {status}, Retry-After: {retry_after}")
+        self.status = status
+        self.retry_after = retry_after
+
+def parse_retry_after(value: str):
+    """Retry-After бывает числом секунд или HTTP-датой; возвращает секунды или None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+# Повторов здесь нет: parser_runner повторяет запрос через CrawlController, чтобы
+# каждая неудачная попытка замедляла обход и не держала место контроллера во время паузы
+async def fetch_page(sign_id: int, base_url: str, session: aiohttp.ClientSession, fetch_state: dict = None):
+    """
+    Загружает страницу знака. Если передано fetch_state, запрос условный
+    (If-None-Match / If-Modified-Since). Возвращает (status, text, etag, last_modified);
+    при 304 text равен None. Если сайт просит подождать, бросает Throttled.
+    """
     url = base_url + str(sign_id)
     headers = {'User-Agent': random.choice(USER_AGENTS)}
+    if fetch_state:
+        if fetch_state.get('etag'):
+            headers['If-None-Match'] = fetch_state['etag']
+        if fetch_state.get('last_modified'):
+            headers['If-Modified-Since'] = fetch_state['last_modified']
     async with session.get(url, headers=headers, timeout=120) as response:
+        if response.status == 304:
+            return 304, None, fetch_state.get('etag'), fetch_state.get('last_modified')
+        # 429/503 не повторяем здесь: паузу по Retry-After выдерживает вызывающий код
+        if response.status == 429 or (response.status == 503 and 'Retry-After' in response.headers):
+            raise Throttled(response.status, parse_retry_after(response.headers.get('Retry-After')))
         response.raise_for_status()
         text = await response.text()
-    
-    soup = BeautifulSoup(text, 'html.parser')
-    
-    # Инициализируем словарь для всех полей
-    result = {
-        "general_text": None, "business_text": None, "business_rating": None,
-        "health_text": None, "health_rating": None, "love_text": None,
-        "love_rating": None, "lunar_text": None, "lunar_rating": None,
-    }
-
-    # 1. Парсим общий гороскоп
-    general_block = soup.find("div", class_=GENERAL_BLOCK_CLASS)
-    if general_block:
-        result["general_text"] = general_block.get_text(" ", strip=True)
-
-    # 2. Парсим все остальные блоки (Бизнес, Здоровье и т.д.)
-    container = soup.find("div", class_=SUB_CONTAINER_CLASS)
-    if container:
-        blocks = container.find_all("div", class_=BUSINESS_BLOCK_CLASS)
-        for block in blocks:
-            title_elem = block.find("h2")
-            if not title_elem:
-                continue
-            title = title_elem.get_text(strip=True).lower()
-
-            # Извлекаем текст из параграфов <p>
-            items_block = block.find("div", class_=HOROSCOPE_ITEMS_CLASS)
-            text_parts = []
-            if items_block:
-                paragraphs = items_block.find_all("p")
-                for p in paragraphs:
-                    p_text = p.get_text(strip=True)
-                    # ИСПРАВЛЕНИЕ: Игнорируем лишний текст в лунном календаре
-                    if "лун" in title and p_text.startswith('Сегодня'):
-                        break
-                    text_parts.append(p_text)
-            text = " ".join(text_parts)
-
-            # Извлекаем рейтинг
-            rate_block = block.find("div", class_=RATE_BLOCK_CLASS)
-            rating = None
-            if rate_block:
-                rate_parts = [r.get_text(strip=True) for r in rate_block.find_all("div") if r.get_text(strip=True)]
-                rating = '/'.join(rate_parts)
-
-            # Распределяем данные по ключам
-            if "бизнес" in title:
-                result["business_text"] = text
-                result["business_rating"] = rating
-            elif "здоров" in title:
-                result["health_text"] = text
-                result["health_rating"] = rating
-            elif "любов" in title:
-                result["love_text"] = text
-                result["love_rating"] = rating
-            elif "лун" in title:
-                result["lunar_text"] = text
-                result["lunar_rating"] = rating
-                
-    return result
-
-async def insert_horoscope(sign_id: int, horoscope_type: str, horoscope_date, data: dict):
-    async with aiosqlite.connect(DB_HOROSCOPES) as db:
-        # Обновляем запрос для сохранения всех полей
-        await db.execute(
-            """INSERT OR REPLACE INTO horoscopes 
-               (sign_id, type, date, general_text, business_text, business_rating, 
-                health_text, health_rating, love_text, love_rating, lunar_text, lunar_rating) 
-               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-            (
-                sign_id, horoscope_type, horoscope_date,
-                data.get('general_text'), data.get('business_text'), data.get('business_rating'),
-                data.get('health_text'), data.get('health_rating'), data.get('love_text'),
-                data.get('love_rating'), data.get('lunar_text'), data.get('lunar_rating')
-            )
+        return response.status, text, response.headers.get('ETag'), response.headers.get('Last-Modified')
+
+@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=30), retry=retry_if_exception_type(aiohttp.ClientError))
+async def parse_horoscope(sign_id: int, base_url: str, session: aiohttp.ClientSession):
+    _, text, _, _ = await fetch_page(sign_id, base_url, session)
+    return await extract_horoscope_async(text)
+
+# --- ИЗВЛЕЧЕНИЕ ДАННЫХ ИЗ HTML ---
+# Сам разбор — в horoscope_extract: рабочие процессы пула импортируют только его.
+PARSE_WORKERS = 2
+
+_parse_executor = None
+
+def _get_parse_executor():
+    global _parse_executor
+    if _parse_executor is None:
+        # spawn: дочерние процессы не наследуют потоки aiosqlite родителя
+        _parse_executor = ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return _parse_executor
+
+def shutdown_parse_executor():
+    global _parse_executor
+    if _parse_executor is not None:
+        _parse_executor.shutdown()
+        _parse_executor = None
+
+async def extract_horoscope_async(text: str) -> dict:
+    """extract_horoscope в пуле процессов, чтобы разбор HTML не блокировал цикл событий."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_parse_executor(), extract_horoscope, text)
+
+async def insert_horoscopes(rows, db=None) -> int:
+    """
+    Сохраняет гороскопы одним executemany. rows — итерируемое из
+    (sign_id, type, date, data). Если передано соединение db, запись идет в его
+    текущей транзакции; иначе — в своей, после которой сбрасывается кэш бота.
+    Возвращает число записанных строк.
+    """
+    if db is None:
+        async with horoscopes_pool.writer() as db:
+            written = await insert_horoscopes(rows, db=db)
+        # Если парсер работает в одном процессе с ботом, кэш обновится сразу;
+        # иначе бот заметит изменение файла БД при следующей проверке.
+        invalidate_horoscope_cache()
+        return written
+
+    params = [
+        (
+            sign_id, horoscope_type, horoscope_date,
+            data.get('general_text'), data.get('business_text'), data.get('business_rating'),
+            data.get('health_text'), data.get('health_rating'), data.get('love_text'),
+            data.get('love_rating'), data.get('lunar_text'), data.get('lunar_rating')
         )
-        await db.commit()
+        for sign_id, horoscope_type, horoscope_date, data in rows
+    ]
+    await db.executemany(
+        """INSERT OR REPLACE INTO horoscopes 
+           (sign_id, type, date, general_text, business_text, business_rating, 
+            health_text, health_rating, love_text, love_rating, lunar_text, lunar_rating) 
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        params
+    )
+    return len(params)
+
+async def insert_horoscope(sign_id: int, horoscope_type: str, horoscope_date, data: dict, db=None):
+    """Сохраняет один гороскоп (см. insert_horoscopes)."""
+    await insert_horoscopes([(sign_id, horoscope_type, horoscope_date, data)], db=db)
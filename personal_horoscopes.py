@@ -0,0 +1,276 @@
+import argparse
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from tenacity import AsyncRetrying, stop_after_attempt, wait_exponential
+from config import GENERATION_BACKEND, GEMINI_API_KEY, GEMINI_MODEL
+from constants import RUSSIAN_SIGNS, ZODIAC_SIGNS_EN
+from db_pool import horoscopes_pool, users_pool, close_all_pools
+from horoscope_fetcher import get_transits, get_horoscope_from_db
+from message_cache import format_personal_message
+from natal import get_natal_chart_by_hash, shutdown_natal_executor
+from logging_setup import setup_logging
+
+logger = logging.getLogger(__name__)
+
+# --- ПЕРСОНАЛЬНЫЕ ГОРОСКОПЫ ---
+# Тексты генерируются заранее (ночная задача), а не при отправке: рассылка
+# не ждет модель. Запросы к модели дедуплицируются по ключу
+# (знак, дата, сводка транзитов, натальная группа), так что стоимость растет
+# с числом различных запросов, а не пользователей. Результаты лежат
+# в personal_horoscopes; send_daily_horoscope_job вычисляет ключ пользователя
+# (транзиты и натальные карты читаются из кэшей в памяти) и берет готовый текст.
+GENERATION_CONCURRENCY = 4
+GENERATION_RETRIES = 3
+GENERATION_WRITE_BATCH = 50  # готовых текстов на одну транзакцию
+USER_PAGE_SIZE = 1000
+TEXT_CACHE_SIZE = 5000
+SUMMARY_PLANETS = ('Sun', 'Moon', 'Mercury', 'Venus', 'Mars')
+
+async def init_personal_db():
+    async with horoscopes_pool.writer() as db:
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS personal_horoscopes (
+                prompt_key TEXT PRIMARY KEY,
+                sign TEXT,
+                horoscope_date DATE,
+                transit_summary TEXT,
+                natal_bucket TEXT,
+                text TEXT,
+                backend TEXT,
+                created_at TIMESTAMP
+            ) WITHOUT ROWID
+        ''')
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_personal_date ON personal_horoscopes (horoscope_date)"
+        )
+
+# --- БЭКЕНДЫ ГЕНЕРАЦИИ ---
+class FakeBackend:
+    """Локальная заглушка: детерминированный текст без сети, для тестов и нагрузочных прогонов."""
+    name = 'fake'
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+
+    async def generate(self, prompt: str) -> str:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        digest = hashlib.blake2b(prompt.encode('utf-8'), digest_size=4).hexdigest()
+        return f"Тестовый персональный прогноз {digest}: {prompt.splitlines()[0]}"
+
+class GeminiBackend:
+    name = 'gemini'
+
+    def __init__(self, api_key: str = GEMINI_API_KEY, model: str = GEMINI_MODEL):
+        if not api_key:
+            raise ValueError("Не найден GEMINI_API_KEY в .env файле!")
+        # Импорт здесь: библиотека тяжелая и нужна только при генерации
+        import google.generativeai as genai
+        genai.configure(api_key=api_key)
+        self._model = genai.GenerativeModel(model)
+
+    async def generate(self, prompt: str) -> str:
+        response = await self._model.generate_content_async(prompt)
+        return response.text.strip()
+
+BACKENDS = {'fake': FakeBackend, 'gemini': GeminiBackend}
+
+def get_backend(name: str = GENERATION_BACKEND):
+    if name not in BACKENDS:
+        raise ValueError(f"Неизвестный бэкенд генерации: {name!r} (доступны: {', '.join(BACKENDS)})")
+    return BACKENDS[name]()
+
+# --- КЛЮЧ ЗАПРОСА ---
+def transit_summary(transits) -> str:
+    return ', '.join(f"{planet} {transits.sign(planet)}" for planet in SUMMARY_PLANETS)
+
+def natal_bucket(chart) -> str:
+    """Натальная группа: Луна и асцендент; '' — без натальной карты (общий текст знака)."""
+    if chart is None:
+        return ''
+    return f"Moon {chart.sign('Moon')}, Asc {chart.ascendant or '-'}"
+
+def prompt_key(sign: str, horoscope_date, summary: str, bucket: str) -> str:
+    raw = '|'.join([sign, str(horoscope_date), summary, bucket])
+    return hashlib.blake2b(raw.encode('utf-8'), digest_size=12).hexdigest()
+
+def build_prompt(sign: str, horoscope_date, summary: str, bucket: str, base_text: str = None) -> str:
+    lines = [
+        f"Персональный гороскоп на {horoscope_date.strftime('%d.%m.%Y')} для знака {RUSSIAN_SIGNS.get(sign, sign)}.",
+        f"Положения планет в этот день: {summary}.",
+    ]
+    if bucket:
+        lines.append(f"Натальная карта читателя: {bucket}.")
+    if base_text:
+        lines.append(f"Общий гороскоп знака на этот день: {base_text}")
+    lines.append("Напиши 3–4 предложения на русском языке, дружелюбно и без markdown-разметки.")
+    return '\n'.join(lines)
+
+# --- НОЧНАЯ ГЕНЕРАЦИЯ ---
+async def _collect_prompts(horoscope_date, transits):
+    """Различные запросы на дату: общий текст каждого знака и по одному на натальную группу знака."""
+    summary = transit_summary(transits)
+    prompts = {}
+    for sign in ZODIAC_SIGNS_EN:
+        prompts[prompt_key(sign, horoscope_date, summary, '')] = (sign, summary, '')
+
+    users = 0
+    last_user_id = 0
+    while True:
+        async with users_pool.reader() as db:
+            cursor = await db.execute(
+                """SELECT user_id, zodiac_sign, natal_hash FROM users
+                   WHERE user_id > ? AND is_active = TRUE AND zodiac_sign IS NOT NULL AND natal_hash IS NOT NULL
+                   ORDER BY user_id LIMIT ?""",
+                (last_user_id, USER_PAGE_SIZE)
+            )
+            rows = await cursor.fetchall()
+        if not rows:
+            break
+        last_user_id = rows[-1]['user_id']
+        users += len(rows)
+        for row in rows:
+            bucket = natal_bucket(await get_natal_chart_by_hash(row['natal_hash']))
+            key = prompt_key(row['zodiac_sign'], horoscope_date, summary, bucket)
+            prompts.setdefault(key, (row['zodiac_sign'], summary, bucket))
+    return prompts, users
+
+async def _existing_keys(horoscope_date) -> set:
+    async with horoscopes_pool.reader() as db:
+        cursor = await db.execute(
+            "SELECT prompt_key FROM personal_horoscopes WHERE horoscope_date = ?", (horoscope_date,)
+        )
+        return {row[0] for row in await cursor.fetchall()}
+
+async def _write_texts(rows):
+    async with horoscopes_pool.writer() as db:
+        await db.executemany(
+            """INSERT OR REPLACE INTO personal_horoscopes
+               (prompt_key, sign, horoscope_date, transit_summary, natal_bucket, text, backend, created_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+            rows
+        )
+
+async def generate_for_date(horoscope_date, backend, concurrency: int = GENERATION_CONCURRENCY):
+    """Генерирует недостающие персональные тексты на дату; возвращает число сгенерированных."""
+    transits = await get_transits(horoscope_date)
+    if transits is None:
+        logger.warning("Нет транзитов на %s: персональные гороскопы не генерируются.", horoscope_date)
+        return 0
+
+    started = time.perf_counter()
+    prompts, users = await _collect_prompts(horoscope_date, transits)
+    existing = await _existing_keys(horoscope_date)
+    todo = {key: spec for key, spec in prompts.items() if key not in existing}
+    logger.info(
+        "Персональные гороскопы на %s: пользователей с картой %s, "
+        "различных запросов %s, уже готово %s, к генерации %s.",
+        horoscope_date, users, len(prompts), len(prompts) - len(todo), len(todo)
+    )
+
+    semaphore = asyncio.Semaphore(concurrency)
+    pending_rows = []
+    counts = {'generated': 0, 'failed': 0}
+
+    async def generate(key, sign, summary, bucket):
+        base = await get_horoscope_from_db(sign, 'daily')
+        base_text = base['general_text'] if base and base['date'] == horoscope_date else None
+        prompt = build_prompt(sign, horoscope_date, summary, bucket, base_text)
+        async with semaphore:
+            try:
+                async for attempt in AsyncRetrying(stop=stop_after_attempt(GENERATION_RETRIES),
+                                                   wait=wait_exponential(multiplier=1, min=2, max=30), reraise=True):
+                    with attempt:
+                        text = await backend.generate(prompt)
+            except Exception as e:
+                counts['failed'] += 1
+                logger.error("Не удалось сгенерировать гороскоп %s / %s: %s", sign, bucket or 'общий', e)
+                return
+        counts['generated'] += 1
+        pending_rows.append((key, sign, horoscope_date, summary, bucket, text, backend.name, datetime.now()))
+        if len(pending_rows) >= GENERATION_WRITE_BATCH:
+            batch = pending_rows[:]
+            pending_rows.clear()
+            await _write_texts(batch)
+
+    await asyncio.gather(*(generate(key, *spec) for key, spec in todo.items()))
+    if pending_rows:
+        await _write_texts(pending_rows)
+    logger.info(
+        "Персональные гороскопы на %s: сгенерировано %s, ошибок %s за %.1f с (бэкенд %s).",
+        horoscope_date, counts['generated'], counts['failed'], time.perf_counter() - started, backend.name
+    )
+    return counts['generated']
+
+async def generate_personal_horoscopes(dates=None, backend_name: str = GENERATION_BACKEND):
+    """
+    Ночная задача: тексты на сегодня и завтра. Пользователи, у которых местная
+    дата еще вчерашняя (западные часовые пояса), получают текст, сгенерированный
+    прошлой ночью; без текста рассылка отправляет общий гороскоп знака.
+    """
+    try:
+        backend = get_backend(backend_name)
+        await init_personal_db()
+        for horoscope_date in dates or [date.today(), date.today() + timedelta(days=1)]:
+            await generate_for_date(horoscope_date, backend)
+    except Exception as e:
+        logger.error("Ошибка генерации персональных гороскопов: %s", e, exc_info=True)
+
+# --- ЧТЕНИЕ ПРИ РАССЫЛКЕ ---
+_texts = OrderedDict()   # prompt_key -> text
+_stats = {"hits": 0, "misses": 0, "fallbacks": 0}
+
+async def _get_text(key: str):
+    text = _texts.get(key)
+    if text is not None:
+        _texts.move_to_end(key)
+        _stats["hits"] += 1
+        return text
+    _stats["misses"] += 1
+    async with horoscopes_pool.reader() as db:
+        cursor = await db.execute("SELECT text FROM personal_horoscopes WHERE prompt_key = ?", (key,))
+        row = await cursor.fetchone()
+    if row is None:
+        return None
+    _texts[key] = row[0]
+    if len(_texts) > TEXT_CACHE_SIZE:
+        _texts.popitem(last=False)
+    return row[0]
+
+async def get_personal_message(user: dict, horoscope_date):
+    """Готовое сообщение с персональным гороскопом пользователя на дату или None."""
+    sign = user.get('zodiac_sign')
+    transits = await get_transits(horoscope_date)
+    if not sign or transits is None:
+        return None
+    summary = transit_summary(transits)
+    chart = await get_natal_chart_by_hash(user['natal_hash']) if user.get('natal_hash') else None
+    bucket = natal_bucket(chart)
+    text = await _get_text(prompt_key(sign, horoscope_date, summary, bucket))
+    if text is None and bucket:
+        # Карта могла измениться после ночной генерации — берем общий текст знака
+        _stats["fallbacks"] += 1
+        text = await _get_text(prompt_key(sign, horoscope_date, summary, ''))
+    return format_personal_message(sign, horoscope_date, text) if text else None
+
+def get_personal_cache_stats():
+    return {**_stats, "size": len(_texts)}
+
+async def _main(args):
+    try:
+        await generate_personal_horoscopes(args.date and [args.date], args.backend)
+    finally:
+        shutdown_natal_executor()
+        await close_all_pools()
+
+if __name__ == "__main__":
+    setup_logging()
+    parser = argparse.ArgumentParser(description="Ночная генерация персональных гороскопов.")
+    parser.add_argument('--date', type=date.fromisoformat, metavar='YYYY-MM-DD', help="дата (по умолчанию сегодня и завтра)")
+    parser.add_argument('--backend', choices=list(BACKENDS), default=GENERATION_BACKEND or None,
+                        required=not GENERATION_BACKEND, help="по умолчанию GENERATION_BACKEND из .env")
+    asyncio.run(_main(parser.parse_args()))
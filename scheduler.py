@@ -1,94 +1,63 @@
+import asyncio
 import logging
 import pytz
-import json
-import aiosqlite
-from datetime import date, timedelta
-from telegram import Bot
+import time
+from datetime import date, datetime, timedelta, timezone
 from telegram.error import Forbidden
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 
-# --- ИСПРАВЛЕННЫЙ ИМПОРТ (v5.0.2 - ФИНАЛ!) ---
-# 1. Модель для ЗАПРОСА данных (из kerykeion/kr_types/kr_models.py)
-from kerykeion.kr_types.kr_models import KerykeionSubjectRequestModel
-# 2. Фабрика для расчета (из kerykeion/chart_data_factory.py)
-from kerykeion.chart_data_factory import ChartDataFactory
-# --- КОНЕЦ ИСПРАВЛЕНИЯ ---
-
-from config import BOT_TOKEN
-from constants import DB_JOBS, RUSSIAN_SIGNS, DB_HOROSCOPES
-from database import get_user_data, save_user_data
-from horoscope_fetcher import get_horoscope_from_db
+from config import DELIVERY_MODE, GENERATION_BACKEND
+from constants import DB_JOBS, TIMEZONES, NOTIFICATION_TIMES
+from database import get_user_data, save_user_data, iter_due_users, iter_scheduled_users, utc_minute_for
+from message_cache import format_horoscope_message, get_horoscope_message
+from outbound import get_bot, PRIORITY_SCHEDULED
+from personal_horoscopes import get_personal_message
+from metrics import DELIVERY_SECONDS, DELIVERY_LAG_SECONDS
+from logging_setup import LogSummary
 
 logger = logging.getLogger(__name__)
-bot = Bot(token=BOT_TOKEN)
-scheduler = AsyncIOScheduler(jobstores={'default': SQLAlchemyJobStore(url=DB_JOBS)})
-
-# --- НОВАЯ ФУНКЦИЯ КЭШИРОВАНИЯ (НА ChartDataFactory) ---
-async def cache_daily_transits():
-    """
-    Рассчитывает транзиты на завтра и сохраняет их в кэш (БД).
-    Использует kerykeion (v5.0.2).
-    """
-    try:
-        logger.info("[КЭШЕР]: Начинаю кэширование транзитов на завтра...")
-
-        # 1. Получаем дату "завтра"
-        tomorrow_date = date.today() + timedelta(days=1)
-
-        # --- ИСПРАВЛЕННАЯ ЛОГИКА (v5.0.2 API - ФИНАЛ!) ---
-
-        # 2. Создаем "объект запроса" pydantic (используя KerykeionSubjectRequestModel)
-        # Это модель ВХОДНЫХ данных
-        request_data = KerykeionSubjectRequestModel(
-            # name="Transits", # 'name' не нужен для этой модели
-            day=tomorrow_date.day,
-            month=tomorrow_date.month,
-            year=tomorrow_date.year,
-            hour=12,
-            minute=0,
-            city="London",
-            nation="UK"
-        )
-
-        # 3. Создаем "фабрику" для расчетов (ПУСТУЮ)
-        factory = ChartDataFactory()
-
-        # 4. Получаем рассчитанный объект ("субъект"), ВЫЗЫВАЯ МЕТОД .create_chart_data()
-        # и ПЕРЕДАВАЯ ему ОБЪЕКТ ЗАПРОСА в аргумент 'request'
-        subject = factory.create_chart_data(request=request_data)
-
-        # --- КОНЕЦ ИСПРАВЛЕНИЯ ---
-
-        # 5. Собираем данные в словарь
-        planet_data = {}
-
-        # Собираем положения 10 основных планет
-        planets = ['sun', 'moon', 'mercury', 'venus', 'mars', 'jupiter', 'saturn', 'uranus', 'neptune', 'pluto']
-        for p_name in planets:
-            # Используем getattr, чтобы получить subject.sun, subject.moon и т.д.
-            planet_obj = getattr(subject, p_name)
-            planet_data[p_name.capitalize()] = { # Сохраняем с большой буквы (Sun, Moon)
-                "sign": planet_obj.sign,       # Знак (напр., 'Aries')
-                "lon": round(planet_obj.lon, 2) # Градус в знаке
-            }
-
-        # 6. Превращаем в JSON и сохраняем в БД
-        data_json = json.dumps(planet_data)
-
-        async with aiosqlite.connect(DB_HOROSCOPES) as db:
-            await db.execute(
-                "INSERT OR REPLACE INTO transits_cache (transit_date, planet_data) VALUES (?, ?)",
-                (tomorrow_date, data_json)
-            )
-            await db.commit()
-
-        logger.info(f"[КЭШЕР]: Транзиты на {tomorrow_date} успешно закэшированы (kerykeion v5+).")
-
-    except Exception as e:
-        logger.error(f"[КЭШЕР]: Ошибка при кэшировании транзитов: {e}", exc_info=True)
-# --- КОНЕЦ НОВОЙ ФУНКЦИИ ---
-
+bot = get_bot()
+
+# Планировщик создается при первом обращении: SQLAlchemy и хранилище задач
+# APScheduler импортируются только тогда (ядро APScheduler импортирует уже
+# telegram.ext), а хранилище задач открывается в start_scheduler(),
+# который main вызывает в фоне, когда бот уже принимает обновления.
+_scheduler = None
+# Изменения задач пользователей, пришедшие до запуска планировщика
+_deferred_job_changes = []
+
+# Сколько отправок одного слота выполняется одновременно
+SLOT_SEND_CONCURRENCY = 20
+# Успешные отправки логируются сводкой; подробности по пользователю — на уровне DEBUG
+_sent_summary = LogSummary(logger, "Отправлено ежедневных гороскопов")
+
+def get_scheduler():
+    global _scheduler
+    if _scheduler is None:
+        from apscheduler.schedulers.asyncio import AsyncIOScheduler
+        from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+        _scheduler = AsyncIOScheduler(jobstores={'default': SQLAlchemyJobStore(url=DB_JOBS)})
+    return _scheduler
+
+def start_scheduler():
+    """Открывает хранилище задач, запускает планировщик и применяет отложенные изменения задач."""
+    scheduler = get_scheduler()
+    scheduler.start()
+    for change in _deferred_job_changes:
+        change(scheduler)
+    if _deferred_job_changes:
+        logger.info("Применено %s отложенных изменений задач.", len(_deferred_job_changes))
+    _deferred_job_changes.clear()
+
+def shutdown_scheduler():
+    if _scheduler is not None and _scheduler.running:
+        _scheduler.shutdown()
+
+def _apply_job_change(change):
+    """Выполняет change(scheduler) сейчас или, пока планировщик запускается, сразу после start()."""
+    if _scheduler is not None and _scheduler.running:
+        change(_scheduler)
+    else:
+        _deferred_job_changes.append(change)
 
 def get_pytz_timezone(tz_str: str):
     """УЛУЧШЕНИЕ: Более надежная конвертация строки UTC в объект pytz."""
@@ -101,68 +70,172 @@ def get_pytz_timezone(tz_str: str):
     flipped_sign = '-' if sign == '+' else '+'
     return pytz.timezone(f"Etc/GMT{flipped_sign}{offset}")
 
-def format_horoscope_message(horoscope_data, sign_name, h_type_rus):
-    """Создает красивое форматированное сообщение для отправки в Telegram."""
-    sign_name_rus = RUSSIAN_SIGNS.get(sign_name, sign_name)
-
-    if not horoscope_data or not horoscope_data.get('general_text'):
-        return f"К сожалению, {h_type_rus} гороскоп для знака {sign_name_rus} еще не готов. Попробуйте позже."
-
-    horoscope_date = horoscope_data['date']
-
-    if h_type_rus == 'ежедневный':
-        date_display = horoscope_date.strftime('%d.%m.%Y')
-    elif h_type_rus == 'еженедельный':
-        date_display = f"неделю с {horoscope_date.strftime('%d.%m.%Y')}"
-    elif h_type_rus == 'ежемесячный':
-        date_display = horoscope_date.strftime('%Y-%m')
-    elif h_type_rus == 'годовой':
-        date_display = f"{horoscope_date.year} год"
-    else:
-        date_display = horoscope_date.strftime('%Y-%m-%d')
-
-    message_parts = [
-        f"🔮 *{h_type_rus.capitalize()} гороскоп для знака {sign_name_rus} на {date_display}*\n",
-        f"*{horoscope_data.get('general_text', 'Нет данных.')}*\n"
-    ]
-
-    sections = {
-        "business": f"💼 *Бизнес ({horoscope_data.get('business_rating', '-')})*",
-        "health": f"💪 *Здоровье ({horoscope_data.get('health_rating', '-')})*",
-        "love": f"❤️ *Любовь ({horoscope_data.get('love_rating', '-')})*",
-        "lunar": f"🌙 *Лунный календарь ({horoscope_data.get('lunar_rating', '-')})*"
-    }
-
-    for key, title in sections.items():
-        text_key = f"{key}_text"
-        if horoscope_data.get(text_key):
-            message_parts.append(f"{title}\n{horoscope_data[text_key]}\n")
-
-    return "\n".join(message_parts)
+def get_delivery_lag(user: dict, now: datetime):
+    """Секунды от времени рассылки пользователя (последнего наступившего) до now (UTC) или None."""
+    utc_minute = utc_minute_for(user.get('timezone'), user.get('notification_time'))
+    if utc_minute is None:
+        return None
+    scheduled = now.replace(hour=utc_minute // 60, minute=utc_minute % 60, second=0, microsecond=0)
+    if scheduled > now:
+        scheduled -= timedelta(days=1)
+    return (now - scheduled).total_seconds()
 
 async def send_daily_horoscope_job(user_id: int):
+    started = time.perf_counter()
+    result = 'error'
     try:
         user = await get_user_data(user_id)
-        if not user or not user.get('is_active') or not user.get('zodiac_sign'): return
-
-        horoscope = await get_horoscope_from_db(user['zodiac_sign'], 'daily')
-        message = format_horoscope_message(horoscope, user['zodiac_sign'], 'ежедневный')
-
-        await bot.send_message(chat_id=user_id, text=message, parse_mode='Markdown')
-        logger.info(f"Отправлен ежедневный гороскоп для {user_id}")
+        if not user or not user.get('is_active') or not user.get('zodiac_sign'):
+            result = 'skipped'
+            return
+
+        # Персональный текст на местную дату пользователя, если он сгенерирован заранее;
+        # без бэкенда генерации текстов нет и искать их незачем
+        message = None
+        if GENERATION_BACKEND:
+            local_date = datetime.now(get_pytz_timezone(user['timezone'])).date() if user.get('timezone') else date.today()
+            message = await get_personal_message(user, local_date)
+        if message is None:
+            message = await get_horoscope_message(user['zodiac_sign'], 'daily')
+        if message is None:
+            message = format_horoscope_message(None, user['zodiac_sign'], 'ежедневный')
+
+        await bot.send_message(
+            chat_id=user_id, text=message, parse_mode='Markdown',
+            rate_limit_args={'priority': PRIORITY_SCHEDULED}
+        )
+        result = 'sent'
+        lag = get_delivery_lag(user, datetime.now(timezone.utc))
+        if lag is not None:
+            DELIVERY_LAG_SECONDS.observe(lag)
+        _sent_summary.record()
+        logger.debug("Отправлен ежедневный гороскоп для %s", user_id)
     except Forbidden:
-        logger.warning(f"Пользователь {user_id} заблокировал бота. Деактивация.")
+        result = 'blocked'
+        logger.warning("Пользователь %s заблокировал бота. Деактивация.", user_id)
         await save_user_data(user_id, is_active=False)
     except Exception as e:
-        logger.error(f"Ошибка отправки гороскопа для {user_id}: {e}", exc_info=True)
+        logger.error("Ошибка отправки гороскопа для %s: %s", user_id, e, exc_info=True)
+    finally:
+        DELIVERY_SECONDS.observe(time.perf_counter() - started, result)
+
+async def send_due_horoscopes_job(utc_minute: int):
+    """Рассылает ежедневный гороскоп всем подписчикам с минутой рассылки utc_minute (UTC)."""
+    semaphore = asyncio.Semaphore(SLOT_SEND_CONCURRENCY)
+
+    async def send(user_id: int):
+        async with semaphore:
+            await send_daily_horoscope_job(user_id)
+
+    label = f"{utc_minute // 60:02d}:{utc_minute % 60:02d} UTC"
+    total = 0
+    # Страницами: в памяти не больше одной страницы ID
+    async for user_ids in iter_due_users(utc_minute):
+        total += len(user_ids)
+        await asyncio.gather(*(send(user_id) for user_id in user_ids))
+    if total:
+        logger.info("Слот %s: рассылка завершена для %s пользователей", label, total)
+
+def get_slot_job_id(utc_minute: int) -> str:
+    return f'due_{utc_minute // 60:02d}{utc_minute % 60:02d}'
+
+def get_slot_minutes():
+    """Минуты UTC, на которые может прийтись рассылка при выборе из TIMEZONES и NOTIFICATION_TIMES."""
+    return sorted({utc_minute_for(tz, time) for tz in TIMEZONES for time in NOTIFICATION_TIMES})
+
+def _is_user_job_id(job_id: str) -> bool:
+    return job_id.startswith('daily_') and job_id[len('daily_'):].isdigit()
+
+def setup_slot_jobs():
+    """
+    Регистрирует по одной задаче на каждую минуту рассылки по UTC
+    и удаляет устаревшие задачи 'daily_{user_id}' и 'slot_{tz}_{time}' из хранилища.
+    Вызывается после start_scheduler(), когда хранилище задач уже открыто.
+    """
+    scheduler = get_scheduler()
+    existing_ids = {job.id for job in scheduler.get_jobs()}
+
+    # 'daily_' без числа — служебные задачи (например, daily_transit_cacher), их не трогаем
+    legacy_ids = [
+        job_id for job_id in existing_ids
+        if job_id.startswith('slot_') or _is_user_job_id(job_id)
+    ]
+    for job_id in legacy_ids:
+        scheduler.remove_job(job_id)
+    if legacy_ids:
+        logger.info("Удалено %s устаревших задач рассылки.", len(legacy_ids))
+
+    minutes = get_slot_minutes()
+    added = 0
+    for utc_minute in minutes:
+        job_id = get_slot_job_id(utc_minute)
+        if job_id in existing_ids:
+            continue
+        scheduler.add_job(
+            send_due_horoscopes_job, 'cron', hour=utc_minute // 60, minute=utc_minute % 60,
+            timezone=pytz.utc, id=job_id, args=[utc_minute],
+            coalesce=True, misfire_grace_time=60*10
+        )
+        added += 1
+    logger.info("Задачи слотов готовы: добавлено %s, всего %s.", added, len(minutes))
+
+async def setup_user_jobs():
+    """
+    Режим per_user: удаляет задачи слотов ('due_*', 'slot_*'), оставшиеся после
+    работы в режиме slots, и создает 'daily_{user_id}' всем активным подписчикам,
+    у которых такой задачи нет (в режиме slots они удаляются).
+    Вызывается после start_scheduler(), когда хранилище задач уже открыто.
+    """
+    scheduler = get_scheduler()
+    existing_ids = {job.id for job in scheduler.get_jobs()}
+
+    slot_ids = [job_id for job_id in existing_ids if job_id.startswith(('due_', 'slot_'))]
+    for job_id in slot_ids:
+        scheduler.remove_job(job_id)
+    if slot_ids:
+        logger.info("Удалено %s задач слотов.", len(slot_ids))
+
+    added = 0
+    async for users in iter_scheduled_users():
+        for user_id, tz, notification_time in users:
+            job_id = f'daily_{user_id}'
+            if job_id in existing_ids:
+                continue
+            hour, minute = map(int, notification_time.split(':'))
+            scheduler.add_job(
+                send_daily_horoscope_job, 'cron', hour=hour, minute=minute,
+                timezone=get_pytz_timezone(tz), id=job_id, args=[user_id], replace_existing=True
+            )
+            added += 1
+    logger.info("Задачи пользователей готовы: добавлено %s, всего %s.",
+                added, added + sum(1 for job_id in existing_ids if _is_user_job_id(job_id)))
 
 def update_user_jobs(user_id: int, tz: str, time: str):
+    if DELIVERY_MODE == 'slots':
+        # В режиме слотов расписание задается колонкой utc_minute в БД
+        logger.info("Слот для %s обновлен: %s %s (минута UTC %s)", user_id, tz, time, utc_minute_for(tz, time))
+        return
+
     job_id = f'daily_{user_id}'
     hour, minute = map(int, time.split(':'))
-    if scheduler.get_job(job_id):
-        scheduler.remove_job(job_id)
-    scheduler.add_job(
-        send_daily_horoscope_job, 'cron', hour=hour, minute=minute,
-        timezone=get_pytz_timezone(tz), id=job_id, args=[user_id]
-    )
-    logger.info(f"Задача для {user_id} обновлена: {tz} {time}")
+
+    def change(scheduler):
+        if scheduler.get_job(job_id):
+            scheduler.remove_job(job_id)
+        scheduler.add_job(
+            send_daily_horoscope_job, 'cron', hour=hour, minute=minute,
+            timezone=get_pytz_timezone(tz), id=job_id, args=[user_id]
+        )
+    _apply_job_change(change)
+    logger.info("Задача для %s обновлена: %s %s", user_id, tz, time)
+
+def remove_user_jobs(user_id: int):
+    if DELIVERY_MODE == 'slots':
+        # Неактивные пользователи отфильтровываются запросом слота
+        return
+    job_id = f'daily_{user_id}'
+
+    def change(scheduler):
+        if scheduler.get_job(job_id):
+            scheduler.remove_job(job_id)
+    _apply_job_change(change)
@@ -0,0 +1,55 @@
+import logging
+import time
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+# --- ЗАМЕРЫ ЗАПУСКА ---
+# Запуск делится на фазы: обязательные (без них бот не может принять
+# обновление) и фоновые (прогрев кэшей, хранилище задач, транзиты). Для
+# каждой фазы запоминается смещение от старта процесса и длительность;
+# отчет пишется в лог одной строкой и отдается в /metrics как startup_*.
+
+class StartupTimer:
+    def __init__(self, started: float = None):
+        # Отсчет — с первой строки main.py; запуск самого интерпретатора не учитывается
+        self.started = started if started is not None else time.perf_counter()
+        self.phases = {}       # имя -> (смещение от старта, длительность), в порядке завершения
+        self.marks = {}        # имя -> смещение от старта
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def record(self, name: str, begun: float):
+        """Записывает фазу, начавшуюся в момент begun (perf_counter)."""
+        self.phases[name] = (begun - self.started, time.perf_counter() - begun)
+
+    @asynccontextmanager
+    async def phase(self, name: str):
+        """Замеряет фазу; ошибка фазы пробрасывается, длительность все равно записывается."""
+        begun = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, begun)
+
+    def mark(self, name: str) -> bool:
+        """Отмечает однократное событие (например, первое обновление); False, если уже отмечено."""
+        if name in self.marks:
+            return False
+        self.marks[name] = self.elapsed()
+        return True
+
+    def report(self) -> str:
+        parts = [f"{name} {duration * 1000:.0f} мс" for name, (_, duration) in self.phases.items()]
+        parts.extend(f"{name} на {offset:.3f} с" for name, offset in self.marks.items())
+        return ", ".join(parts)
+
+    def log(self, title: str):
+        logger.info("%s (%.3f с от старта): %s", title, self.elapsed(), self.report())
+
+    def stats(self):
+        return {
+            'phase_seconds': {name: duration for name, (_, duration) in self.phases.items()},
+            'mark_seconds': dict(self.marks),
+        }
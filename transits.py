@@ -0,0 +1,107 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, timedelta
+from db_pool import horoscopes_pool
+
+logger = logging.getLogger(__name__)
+
+# --- ПРЕДРАСЧЕТ ТРАНЗИТОВ ---
+# Положения планет считаются в пуле процессов (kerykeion занимает процессор
+# на сотни миллисекунд) на скользящее окно дат вперед. Считаются только даты,
+# которых еще нет в transits_cache; результат пишется одной транзакцией.
+# Координаты фиксированы (Гринвич, полдень UTC), поэтому сеть для поиска
+# города не нужна. Формат planet_data прежний: {"Sun": {"sign": ..., "lon": ...}}.
+TRANSIT_WINDOW_DAYS = 30
+TRANSIT_WORKERS = 2
+TRANSIT_LAT = 51.4779        # Гринвичская обсерватория
+TRANSIT_LNG = -0.0015
+TRANSIT_TZ = 'Etc/UTC'
+TRANSIT_HOUR = 12
+PLANETS = ['sun', 'moon', 'mercury', 'venus', 'mars', 'jupiter', 'saturn', 'uranus', 'neptune', 'pluto']
+
+async def init_transits_db():
+    async with horoscopes_pool.writer() as db:
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS transits_cache (
+                transit_date DATE PRIMARY KEY,
+                planet_data TEXT
+            )
+        ''')
+
+def compute_transits(transit_date: date) -> str:
+    """Положения планет на дату в JSON для transits_cache. Выполняется в дочернем процессе."""
+    # Импорт здесь: kerykeion тяжелый и нужен только рабочим процессам
+    from kerykeion import AstrologicalSubjectFactory
+
+    subject = AstrologicalSubjectFactory.from_birth_data(
+        "Transits", transit_date.year, transit_date.month, transit_date.day, TRANSIT_HOUR, 0,
+        lng=TRANSIT_LNG, lat=TRANSIT_LAT, tz_str=TRANSIT_TZ, online=False
+    )
+    planet_data = {}
+    for p_name in PLANETS:
+        planet_obj = getattr(subject, p_name)
+        planet_data[p_name.capitalize()] = {  # Сохраняем с большой буквы (Sun, Moon)
+            "sign": planet_obj.sign,            # Знак (напр., 'Ari')
+            "lon": round(planet_obj.position, 2)  # Градус в знаке
+        }
+    return json.dumps(planet_data)
+
+async def get_missing_transit_dates(start: date, days: int):
+    end = start + timedelta(days=days - 1)
+    async with horoscopes_pool.reader() as db:
+        cursor = await db.execute(
+            "SELECT transit_date FROM transits_cache WHERE transit_date BETWEEN ? AND ?",
+            (start, end)
+        )
+        cached = {row[0] for row in await cursor.fetchall()}
+    return [start + timedelta(days=i) for i in range(days) if start + timedelta(days=i) not in cached]
+
+async def fill_transit_window(days: int = TRANSIT_WINDOW_DAYS, start: date = None):
+    """Досчитывает транзиты, которых нет в кэше, на days дней начиная с start (по умолчанию — сегодня)."""
+    start = start or date.today()
+    try:
+        await init_transits_db()
+        missing = await get_missing_transit_dates(start, days)
+        if not missing:
+            logger.info("[КЭШЕР]: Транзиты на %s дн. с %s уже в кэше.", days, start)
+            return 0
+
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        # Пул создается на один расчет: между ежедневными запусками процессы не держат память
+        # spawn: дочерние процессы не наследуют потоки aiosqlite родителя
+        executor = ProcessPoolExecutor(
+            max_workers=min(TRANSIT_WORKERS, len(missing)), mp_context=multiprocessing.get_context('spawn')
+        )
+        try:
+            results = await asyncio.gather(
+                *(loop.run_in_executor(executor, compute_transits, day) for day in missing),
+                return_exceptions=True
+            )
+        finally:
+            executor.shutdown(wait=False)
+
+        rows = []
+        for day, result in zip(missing, results):
+            if isinstance(result, Exception):
+                logger.error("[КЭШЕР]: Ошибка расчета транзитов на %s: %s", day, result)
+            else:
+                rows.append((day, result))
+        if rows:
+            async with horoscopes_pool.writer() as db:
+                await db.executemany(
+                    "INSERT OR REPLACE INTO transits_cache (transit_date, planet_data) VALUES (?, ?)",
+                    rows
+                )
+        logger.info(
+            "[КЭШЕР]: Закэшированы транзиты на %s из %s недостающих дат (%s — %s) за %.1f с.",
+            len(rows), len(missing), missing[0], missing[-1], time.perf_counter() - started
+        )
+        return len(rows)
+    except Exception as e:
+        logger.error("[КЭШЕР]: Ошибка при кэшировании транзитов: %s", e, exc_info=True)
+        return 0
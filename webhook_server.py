@@ -0,0 +1,86 @@
+import hashlib
+import hmac
+import logging
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+
+from config import (
+    BOT_TOKEN, WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH,
+    WEBHOOK_SECRET, WEBHOOK_MAX_CONNECTIONS
+)
+
+logger = logging.getLogger(__name__)
+
+# --- ПРИЕМ ОБНОВЛЕНИЙ ЧЕРЕЗ WEBHOOK ---
+# Telegram присылает каждое обновление POST-запросом; сервер только проверяет
+# секрет, разбирает JSON и кладет Update в application.update_queue — обработка
+# идет в Application с ограничением UPDATE_CONCURRENCY. При остановке webhook
+# не удаляется: пока бот перезапускается, Telegram копит обновления и
+# доставит их, как только сервер снова ответит 200.
+
+def get_webhook_secret() -> str:
+    """Секрет для X-Telegram-Bot-Api-Secret-Token; по умолчанию выводится из токена, чтобы не меняться между перезапусками."""
+    return WEBHOOK_SECRET or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32]
+
+class WebhookServer:
+    def __init__(self, application: Application, listen: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT,
+                 path: str = WEBHOOK_PATH):
+        self.application = application
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self._secret = get_webhook_secret().encode()
+        self._runner = None
+        self.received = 0
+        self.rejected = 0
+
+    async def _handle_update(self, request: web.Request):
+        secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '').encode()
+        if not hmac.compare_digest(secret, self._secret):
+            self.rejected += 1
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(await request.json(), self.application.bot)
+        except Exception as e:
+            # 200, иначе Telegram будет бесконечно повторять битое обновление
+            logger.error("Не удалось разобрать обновление: %s", e)
+            return web.Response()
+        self.received += 1
+        await self.application.update_queue.put(update)
+        return web.Response()
+
+    async def _handle_health(self, request: web.Request):
+        return web.json_response(self.stats())
+
+    async def start(self):
+        """Запускает HTTP-сервер и регистрирует webhook (накопленные обновления не сбрасываются)."""
+        app = web.Application()
+        app.router.add_post(self.path, self._handle_update)
+        app.router.add_get('/healthz', self._handle_health)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.listen, self.port).start()
+        # Сервер уже слушает, когда Telegram начнет досылать накопленные обновления
+        await self.application.bot.set_webhook(
+            url=f"{WEBHOOK_URL.rstrip('/')}{self.path}",
+            secret_token=self._secret.decode(),
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=False,
+        )
+        logger.info("Webhook-сервер слушает %s:%s%s", self.listen, self.port, self.path)
+
+    async def stop(self):
+        """Перестает принимать запросы; уже принятые обновления обработает application.stop()."""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+            logger.info("Webhook-сервер остановлен: принято %s, отклонено %s запросов.", self.received, self.rejected)
+
+    def stats(self):
+        return {
+            'received': self.received,
+            'rejected': self.rejected,
+            'queued': self.application.update_queue.qsize(),
+        }